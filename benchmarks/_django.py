@@ -0,0 +1,30 @@
+"""Helpers to run benchmarks in-process against a throwaway test database."""
+
+import os
+
+
+def setup(test_database=None):
+    """
+    Configure Django and create a test database, in memory unless a
+    `test_database` file is given. Returns a teardown callable.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "urlshortener.settings")
+
+    import django
+
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    if test_database is not None:
+        # A file lets the flush threads write while requests are served
+        connection.settings_dict["TEST"]["NAME"] = test_database
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    def teardown():
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    return teardown
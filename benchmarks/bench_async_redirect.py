@@ -0,0 +1,147 @@
+"""
+Compare redirect throughput and latency of the sync WSGI fast path, served
+by a pool of worker threads, with the async ASGI fast path on one event
+loop, when every client is slow to read its response.
+
+    python -m benchmarks.bench_async_redirect --requests 2000 --threads 32
+
+All requests arrive at once. `--client-delay` is the time spent writing a
+response to a slow client: a WSGI worker thread is held for that long, the
+event loop only awaits it.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._django import setup
+
+
+def summary(latencies, seconds):
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": len(latencies),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        "p50_ms": round(quantiles[49] * 1000, 1),
+        "p99_ms": round(quantiles[98] * 1000, 1),
+    }
+
+
+def run_wsgi(application, environ, requests, threads, client_delay):
+    def start_response(status, headers):
+        pass
+
+    def request(start):
+        body = b"".join(application(dict(environ), start_response))
+        # Writing the response to a slow client blocks the worker thread
+        time.sleep(client_delay)
+        return time.perf_counter() - start, body
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(request, start) for _ in range(requests)]
+        latencies = [future.result()[0] for future in futures]
+    return summary(latencies, time.perf_counter() - start)
+
+
+async def run_asgi(application, scope, requests, client_delay):
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            # Writing the response to a slow client only suspends the task
+            await asyncio.sleep(client_delay)
+
+    async def request(start):
+        await application(dict(scope), receive, send)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(request(start) for _ in range(requests)))
+    return summary(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument(
+        "--client-delay", type=float, default=0.02, help="seconds per response"
+    )
+    args = parser.parse_args()
+
+    teardown = setup()
+    try:
+        from django.core.handlers.asgi import ASGIHandler
+        from django.core.handlers.wsgi import WSGIHandler
+        from django.utils import timezone
+
+        from urlshortenerapp.accesslogs import access_log_buffer
+        from urlshortenerapp.counters import visit_counter
+        from urlshortenerapp.fastpath import AsyncRedirectApp, RedirectApp
+        from urlshortenerapp.models import ShortenedURL
+
+        ShortenedURL.objects.create(
+            original_url="https://example.com",
+            code="bench1",
+            expiration_at=timezone.now() + timezone.timedelta(days=1),
+        )
+        # Keep the flush threads idle, the in-memory test database does not
+        # take concurrent writers. Buffers are flushed between runs.
+        visit_counter.flush_interval = access_log_buffer.flush_interval = 3600
+        access_log_buffer.max_size = 2 * args.requests + 100
+        access_log_buffer.batch_size = access_log_buffer.max_size
+
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": "/bench1/",
+            "QUERY_STRING": "",
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "8000",
+            "REMOTE_ADDR": "127.0.0.1",
+            "HTTP_HOST": "localhost",
+            "HTTP_USER_AGENT": "bench",
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+        }
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/bench1/",
+            "query_string": b"",
+            "headers": [(b"host", b"localhost"), (b"user-agent", b"bench")],
+            "client": ("127.0.0.1", 50000),
+        }
+        wsgi_app = RedirectApp(WSGIHandler())
+        asgi_app = AsyncRedirectApp(ASGIHandler())
+        # Load the link into the resolve cache
+        b"".join(wsgi_app(dict(environ), lambda status, headers: None))
+
+        wsgi = run_wsgi(
+            wsgi_app, environ, args.requests, args.threads, args.client_delay
+        )
+        asgi = asyncio.run(run_asgi(asgi_app, scope, args.requests, args.client_delay))
+        visit_counter.flush()
+        access_log_buffer.flush()
+        print(
+            json.dumps(
+                {
+                    "client_delay_ms": args.client_delay * 1000,
+                    f"wsgi_{args.threads}_threads": wsgi,
+                    "asgi_event_loop": asgi,
+                },
+                indent=2,
+            )
+        )
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare creating links one request at a time through /shorten with a
+single NDJSON request to /shorten/bulk.
+
+    python -m benchmarks.bench_bulk_shorten --count 2000
+"""
+
+import argparse
+import json
+import time
+
+from benchmarks._django import setup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=1000)
+    args = parser.parse_args()
+
+    teardown = setup()
+    try:
+        from django.test import Client
+
+        client = Client()
+
+        start = time.perf_counter()
+        for i in range(args.count):
+            client.post(
+                "/shorten",
+                {"original_url": f"https://single.example.com/{i}"},
+                content_type="application/json",
+            )
+        single = time.perf_counter() - start
+
+        body = "\n".join(
+            json.dumps({"original_url": f"https://bulk.example.com/{i}"})
+            for i in range(args.count)
+        )
+        start = time.perf_counter()
+        response = client.post(
+            "/shorten/bulk", body, content_type="application/x-ndjson"
+        )
+        b"".join(response.streaming_content)
+        bulk = time.perf_counter() - start
+
+        print(
+            json.dumps(
+                {
+                    "count": args.count,
+                    "single_links_per_sec": round(args.count / single),
+                    "bulk_links_per_sec": round(args.count / bulk),
+                    "speedup": round(single / bulk, 1),
+                },
+                indent=2,
+            )
+        )
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
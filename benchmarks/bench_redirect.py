@@ -0,0 +1,96 @@
+"""
+Measure the per-request overhead of a redirect through the full Django
+stack (DRF view, swagger decorators, MIDDLEWARE) and through the lean
+RedirectApp fast path mounted in urlshortener.wsgi.
+
+    python -m benchmarks.bench_redirect --requests 20000
+"""
+
+import argparse
+import io
+import json
+import time
+
+from benchmarks._django import setup
+
+
+def run(application, environ, requests):
+    from urlshortenerapp.accesslogs import access_log_buffer
+    from urlshortenerapp.counters import visit_counter
+
+    def start_response(status, headers):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        b"".join(application(dict(environ), start_response))
+    seconds = time.perf_counter() - start
+    # Write buffered visits outside the timed loop, the in-memory test
+    # database does not take concurrent writers
+    visit_counter.flush()
+    access_log_buffer.flush()
+    return seconds / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=10000)
+    args = parser.parse_args()
+
+    teardown = setup()
+    try:
+        from django.core.handlers.wsgi import WSGIHandler
+        from django.utils import timezone
+
+        from urlshortenerapp.accesslogs import access_log_buffer
+        from urlshortenerapp.counters import visit_counter
+        from urlshortenerapp.fastpath import RedirectApp
+        from urlshortenerapp.models import ShortenedURL
+
+        ShortenedURL.objects.create(
+            original_url="https://example.com",
+            code="bench1",
+            expiration_at=timezone.now() + timezone.timedelta(days=1),
+        )
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": "/bench1/",
+            "QUERY_STRING": "",
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "8000",
+            "REMOTE_ADDR": "127.0.0.1",
+            "HTTP_HOST": "localhost",
+            "HTTP_USER_AGENT": "bench",
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+        }
+        # Keep the flush threads idle, run() flushes between measurements
+        visit_counter.flush_interval = access_log_buffer.flush_interval = 3600
+        access_log_buffer.max_size = args.requests + 100
+        access_log_buffer.batch_size = access_log_buffer.max_size
+
+        django_app = WSGIHandler()
+        fast_app = RedirectApp(django_app)
+        # Warm up the resolve cache and lazy imports on both paths
+        run(django_app, environ, 100)
+        run(fast_app, environ, 100)
+
+        django_seconds = run(django_app, environ, args.requests)
+        fast_seconds = run(fast_app, environ, args.requests)
+        print(
+            json.dumps(
+                {
+                    "requests": args.requests,
+                    "django_stack_us_per_request": round(django_seconds * 1e6, 1),
+                    "fast_path_us_per_request": round(fast_seconds * 1e6, 1),
+                    "speedup": round(django_seconds / fast_seconds, 1),
+                },
+                indent=2,
+            )
+        )
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Measure how long a fresh worker takes to boot and answer its first
+requests, for each SERVER_PROFILE.
+
+    python -m benchmarks.bench_startup --runs 10 --profile full redirect
+
+Every run is a new interpreter using a throwaway SQLite file, migrated
+once beforehand. It times django.setup(), the import of urlshortener.wsgi
+(middleware, URLconf, fast path, background services), a first redirect
+and a first request through Django. Reports medians.
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def environ(path):
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8000",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": "localhost",
+        "HTTP_USER_AGENT": "bench",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+    }
+
+
+def request(application, path):
+    statuses = []
+
+    def start_response(status, headers):
+        statuses.append(status)
+
+    b"".join(application(environ(path), start_response))
+    return statuses[0]
+
+
+def configure(database):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "urlshortener.settings")
+    from django.conf import settings
+
+    settings.DATABASES["default"]["NAME"] = database
+
+
+def create_database(database):
+    """Migrate `database` and add the link the runs visit."""
+    configure(database)
+    import django
+
+    django.setup()
+
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from urlshortenerapp.models import ShortenedURL
+
+    call_command("migrate", verbosity=0)
+    ShortenedURL.objects.create(
+        original_url="https://example.com",
+        code="boot1",
+        expiration_at=timezone.now() + timezone.timedelta(days=365),
+    )
+
+
+def boot(database):
+    """Boot a worker in this process. Returns its timings in milliseconds."""
+    timings = {}
+    start = time.perf_counter()
+    configure(database)
+    import django
+
+    django.setup()
+    timings["setup_ms"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from urlshortener.wsgi import application
+
+    timings["application_ms"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert request(application, "/boot1/").startswith("302")
+    timings["first_redirect_ms"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert request(application, "/metrics").startswith("200")
+    timings["first_django_request_ms"] = time.perf_counter() - start
+
+    timings = {name: seconds * 1000 for name, seconds in timings.items()}
+    timings["modules"] = len(sys.modules)
+    return timings
+
+
+def child(*args, profile="full"):
+    env = {**os.environ, "SERVER_PROFILE": profile}
+    return subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_startup", *args],
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+
+
+def measure(database, profile, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = child("--boot", database, profile=profile)
+        timings = json.loads(output.splitlines()[-1])
+        timings["process_ms"] = (time.perf_counter() - start) * 1000
+        samples.append(timings)
+    return {
+        name: round(statistics.median(sample[name] for sample in samples), 1)
+        for name in samples[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--profile", nargs="+", default=["full", "redirect"], help="SERVER_PROFILE"
+    )
+    parser.add_argument("--create", help=argparse.SUPPRESS)
+    parser.add_argument("--boot", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.create:
+        create_database(args.create)
+        return
+    if args.boot:
+        print(json.dumps(boot(args.boot)))
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "db.sqlite3")
+        child("--create", database)
+        results = {
+            profile: measure(database, profile, args.runs) for profile in args.profile
+        }
+    print(json.dumps({"runs": args.runs, **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""
+Record and replay request traces, reporting throughput and latency
+percentiles per endpoint as JSON.
+
+Generate a Zipf-distributed workload and replay it in-process:
+
+    python -m benchmarks.loadtest generate --requests 20000 --links 1000 \\
+        --trace benchmarks/traces/zipf.jsonl
+    python -m benchmarks.loadtest replay --trace benchmarks/traces/zipf.jsonl \\
+        --target wsgi --output before.json
+
+Replay against a running server, record what a server receives, and
+compare two results (e.g. before and after a commit):
+
+    python -m benchmarks.loadtest replay --trace benchmarks/traces/zipf.jsonl \\
+        --target http://127.0.0.1:8000 --concurrency 16
+    python -m benchmarks.loadtest record --trace benchmarks/traces/recorded.jsonl
+    python -m benchmarks.loadtest compare before.json after.json
+
+The "wsgi" target calls urlshortener.wsgi.application in-process, including
+the redirect fast path. The "client" target goes through the Django test
+client. Both run against a throwaway test database. A URL target sends
+HTTP requests to runserver, gunicorn or any other server.
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+from benchmarks import workload
+from benchmarks._django import setup
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BOUNDS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+CREATE_BATCH_SIZE = 1000
+
+
+def percentile(latencies, fraction):
+    """Nearest-rank percentile of sorted `latencies`."""
+    index = max(0, round(fraction * len(latencies) + 0.5) - 1)
+    return latencies[min(index, len(latencies) - 1)]
+
+
+def histogram(latencies):
+    counts = Counter()
+    for latency in latencies:
+        ms = latency * 1000
+        bound = next((b for b in HISTOGRAM_BOUNDS_MS if ms <= b), None)
+        counts[
+            f"<={bound}" if bound is not None else f">{HISTOGRAM_BOUNDS_MS[-1]}"
+        ] += 1
+    labels = [f"<={b}" for b in HISTOGRAM_BOUNDS_MS] + [f">{HISTOGRAM_BOUNDS_MS[-1]}"]
+    return {label: counts[label] for label in labels if counts[label]}
+
+
+class Results:
+    """Latencies and statuses of replayed requests, per endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, status, seconds):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][str(status)] += 1
+
+    def report(self, seconds):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            statuses = self.statuses[endpoint]
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": statuses["error"]
+                + sum(
+                    count
+                    for status, count in statuses.items()
+                    if status.isdigit() and int(status) >= 500
+                ),
+                "statuses": dict(sorted(statuses.items())),
+                "requests_per_second": round(len(latencies) / seconds, 1),
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+                "max_ms": round(latencies[-1] * 1000, 3),
+                "histogram_ms": histogram(latencies),
+            }
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "requests": requests,
+            "seconds": round(seconds, 3),
+            "requests_per_second": round(requests / seconds, 1),
+            "endpoints": endpoints,
+        }
+
+
+class HTTPSender:
+    """Sends requests over one keep-alive connection per replay thread."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._local = threading.local()
+
+    def send(self, method, path, content_type=None, body=None):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self._local.connection = connection
+        headers = {"Content-Type": content_type} if content_type else {}
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            connection.close()
+            self._local.connection = None
+            raise
+
+
+class WSGISender:
+    """Calls a WSGI application in-process."""
+
+    def __init__(self, application):
+        self.application = application
+
+    def send(self, method, path, content_type=None, body=None):
+        path, _, query = path.partition("?")
+        body = (body or "").encode()
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "8000",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": "127.0.0.1",
+            "HTTP_HOST": "localhost",
+            "HTTP_USER_AGENT": "loadtest",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": io.StringIO(),
+        }
+        if content_type:
+            environ["CONTENT_TYPE"] = content_type
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split()[0])
+
+        content = b"".join(self.application(environ, start_response))
+        return response["status"], content
+
+
+class ClientSender:
+    """Sends requests through the Django test client, one per thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def send(self, method, path, content_type=None, body=None):
+        from django.test import Client
+
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client()
+        response = client.generic(
+            method,
+            path,
+            data=body or "",
+            content_type=content_type or "application/octet-stream",
+        )
+        if response.streaming:
+            return response.status_code, b"".join(response.streaming_content)
+        return response.status_code, response.content
+
+
+def create_links(sender, count):
+    """Create `count` links through /shorten/bulk and return their codes."""
+    codes = []
+    for start in range(0, count, CREATE_BATCH_SIZE):
+        items = [
+            {"original_url": f"https://loadtest.example.com/{time.time_ns()}/{i}"}
+            for i in range(start, min(start + CREATE_BATCH_SIZE, count))
+        ]
+        status, body = sender.send(
+            "POST", "/shorten/bulk", "application/json", json.dumps(items)
+        )
+        if status != 200:
+            raise RuntimeError(f"Creating links failed with status {status}")
+        for line in body.decode().splitlines():
+            result = json.loads(line)
+            if result["status"] != 201:
+                raise RuntimeError(f"Creating a link failed: {result}")
+            codes.append(result["short_url"].rstrip("/").rsplit("/", 1)[-1])
+    return codes
+
+
+def replay(sender, requests, concurrency, rate=None):
+    """
+    Send `requests` from `concurrency` threads, as fast as possible or at
+    `rate` requests per second. With a rate, latency is measured from the
+    time a request was due, so a slow server is not hidden by late sends.
+    """
+    results = Results()
+    position = iter(range(len(requests)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(position, None)
+            if index is None:
+                return
+            request = requests[index]
+            if rate:
+                begin = start + index / rate
+                delay = begin - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                begin = time.perf_counter()
+            path = request["path"]
+            if request.get("query"):
+                path = f"{path}?{request['query']}"
+            try:
+                status, _ = sender.send(
+                    request["method"],
+                    path,
+                    request.get("content_type"),
+                    request.get("body"),
+                )
+            except Exception:
+                status = "error"
+            endpoint = request.get("endpoint") or workload.endpoint_of(
+                request["method"], request["path"]
+            )
+            results.add(endpoint, status, time.perf_counter() - begin)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.report(time.perf_counter() - start)
+
+
+def run_replay(args):
+    requests = list(workload.read_trace(args.trace))
+    if args.limit:
+        requests = requests[: args.limit]
+    teardown = None
+    if args.target in ("wsgi", "client"):
+        directory = tempfile.mkdtemp()
+        teardown = setup(os.path.join(directory, "loadtest.sqlite3"))
+    try:
+        if args.target == "wsgi":
+            from urlshortener.wsgi import application
+
+            sender = WSGISender(application)
+        elif args.target == "client":
+            sender = ClientSender()
+        else:
+            sender = HTTPSender(args.target)
+
+        codes = create_links(sender, workload.links_used(requests))
+        requests = [workload.resolve_links(request, codes) for request in requests]
+        if args.warmup:
+            replay(sender, requests[: args.warmup], args.concurrency)
+        report = replay(sender, requests, args.concurrency, args.rate)
+    finally:
+        if teardown is not None:
+            from urlshortenerapp.accesslogs import access_log_buffer
+            from urlshortenerapp.counters import visit_counter
+
+            visit_counter.shutdown()
+            access_log_buffer.shutdown()
+            teardown()
+
+    report = {
+        "trace": args.trace,
+        "target": args.target,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        **report,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+class TraceRecorder:
+    """WSGI middleware appending every request it sees to a trace file."""
+
+    def __init__(self, application, path):
+        self.application = application
+        self.trace = open(path, "a")
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+        environ["wsgi.input"] = io.BytesIO(body)
+        method, path = environ["REQUEST_METHOD"], environ.get("PATH_INFO", "/")
+        request = {
+            "endpoint": workload.endpoint_of(method, path),
+            "method": method,
+            "path": path,
+        }
+        if environ.get("QUERY_STRING"):
+            request["query"] = environ["QUERY_STRING"]
+        if body:
+            request["content_type"] = environ.get("CONTENT_TYPE", "")
+            request["body"] = body.decode("utf-8", "replace")
+        with self._lock:
+            self.trace.write(json.dumps(request) + "\n")
+            self.trace.flush()
+        return self.application(environ, start_response)
+
+
+def run_record(args):
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, make_server
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "urlshortener.settings")
+    from urlshortener.wsgi import application
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    server = make_server(
+        args.host,
+        args.port,
+        TraceRecorder(application, args.trace),
+        server_class=ThreadingWSGIServer,
+    )
+    print(f"Recording requests to {args.trace} on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_generate(args):
+    count = workload.write_trace(
+        args.trace,
+        workload.generate(
+            args.requests,
+            args.links,
+            exponent=args.zipf,
+            shorten_ratio=args.shorten_ratio,
+            unknown_ratio=args.unknown_ratio,
+            analytics_ratio=args.analytics_ratio,
+            seed=args.seed,
+        ),
+    )
+    print(f"Wrote {count} requests over {args.links} links to {args.trace}")
+
+
+def change(before, after):
+    return round((after - before) / before * 100, 1) if before else None
+
+
+def run_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    comparison = {}
+    for endpoint, stats in after["endpoints"].items():
+        if endpoint not in before["endpoints"]:
+            continue
+        base = before["endpoints"][endpoint]
+        comparison[endpoint] = {
+            metric: {
+                "before": base[metric],
+                "after": stats[metric],
+                "change_percent": change(base[metric], stats[metric]),
+            }
+            for metric in ["requests_per_second", "p50_ms", "p95_ms", "p99_ms"]
+        }
+    print(json.dumps(comparison, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Write a Zipf workload trace.")
+    generate.add_argument("--trace", required=True)
+    generate.add_argument("--requests", type=int, default=10000)
+    generate.add_argument("--links", type=int, default=1000)
+    generate.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent.")
+    generate.add_argument("--shorten-ratio", type=float, default=0.05)
+    generate.add_argument("--unknown-ratio", type=float, default=0.01)
+    generate.add_argument("--analytics-ratio", type=float, default=0.0)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.set_defaults(run=run_generate)
+
+    replay_parser = commands.add_parser("replay", help="Replay a trace.")
+    replay_parser.add_argument("--trace", required=True)
+    replay_parser.add_argument(
+        "--target", default="wsgi", help='"wsgi", "client" or a server URL.'
+    )
+    replay_parser.add_argument("--concurrency", type=int, default=1)
+    replay_parser.add_argument(
+        "--rate", type=float, help="Requests per second, default as fast as possible."
+    )
+    replay_parser.add_argument("--limit", type=int, help="Replay the first N only.")
+    replay_parser.add_argument(
+        "--warmup", type=int, default=0, help="Unreported requests sent first."
+    )
+    replay_parser.add_argument("--output", help="Also write the report here.")
+    replay_parser.set_defaults(run=run_replay)
+
+    record = commands.add_parser(
+        "record", help="Serve the project and record the requests it receives."
+    )
+    record.add_argument("--trace", required=True)
+    record.add_argument("--host", default="127.0.0.1")
+    record.add_argument("--port", type=int, default=8000)
+    record.set_defaults(run=run_record)
+
+    compare = commands.add_parser("compare", help="Compare two replay reports.")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.set_defaults(run=run_compare)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
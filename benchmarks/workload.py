@@ -0,0 +1,130 @@
+"""
+Request traces for benchmarks.loadtest.
+
+A trace is a JSON lines file with one request per line:
+
+    {"endpoint": "redirect", "method": "GET", "path": "/{link:3}/"}
+    {"endpoint": "shorten", "method": "POST", "path": "/shorten",
+     "content_type": "application/json", "body": "{...}"}
+
+`{link:N}` stands for the code of the N-th link the replay creates before
+sending the trace, so generated traces run against any database. Recorded
+traces contain the real codes of the database they were recorded on.
+"""
+
+import itertools
+import json
+import os
+import random
+import re
+
+LINK_RE = re.compile(r"\{link:(\d+)\}")
+
+VISIT_PATH_RE = re.compile(r"/[^/]+/")
+
+
+def endpoint_of(method, path):
+    """Name of the endpoint a request is reported under."""
+    if path == "/shorten/bulk":
+        return "bulk_shorten"
+    if path == "/shorten":
+        return "shorten"
+    if path.startswith("/analytics/"):
+        return "analytics"
+    if path == "/":
+        return "home"
+    if method == "GET" and VISIT_PATH_RE.fullmatch(path):
+        return "redirect"
+    return "other"
+
+
+def read_trace(path):
+    with open(path) as trace:
+        for line in trace:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_trace(path, requests):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    count = 0
+    with open(path, "w") as trace:
+        for request in requests:
+            trace.write(json.dumps(request) + "\n")
+            count += 1
+    return count
+
+
+def links_used(requests):
+    """Number of links a trace refers to through `{link:N}`."""
+    used = 0
+    for request in requests:
+        for match in LINK_RE.finditer(request["path"]):
+            used = max(used, int(match[1]) + 1)
+    return used
+
+
+def resolve_links(request, codes):
+    """Return `request` with its `{link:N}` placeholders replaced by codes."""
+    if "{link:" not in request["path"]:
+        return request
+    return {**request, "path": LINK_RE.sub(lambda m: codes[int(m[1])], request["path"])}
+
+
+def zipf_weights(count, exponent):
+    """Cumulative weights of ranks 1..count under a Zipf distribution."""
+    return list(
+        itertools.accumulate(1 / rank**exponent for rank in range(1, count + 1))
+    )
+
+
+def generate(
+    requests,
+    links,
+    exponent=1.1,
+    shorten_ratio=0.05,
+    unknown_ratio=0.01,
+    analytics_ratio=0.0,
+    seed=0,
+):
+    """
+    Yield `requests` requests: visits to `links` links with Zipf-distributed
+    popularity (link 0 is the hottest), plus the given fractions of link
+    creations, visits to unknown codes and analytics queries.
+    """
+    rng = random.Random(seed)
+    weights = zipf_weights(links, exponent)
+    ranks = range(links)
+    for i in range(requests):
+        roll = rng.random()
+        if roll < shorten_ratio:
+            yield {
+                "endpoint": "shorten",
+                "method": "POST",
+                "path": "/shorten",
+                "content_type": "application/json",
+                "body": json.dumps(
+                    {"original_url": f"https://loadtest.example.com/new/{seed}/{i}"}
+                ),
+            }
+            continue
+        roll -= shorten_ratio
+        if roll < unknown_ratio:
+            code = "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=10))
+            yield {"endpoint": "redirect", "method": "GET", "path": f"/{code}/"}
+            continue
+        roll -= unknown_ratio
+        link = rng.choices(ranks, cum_weights=weights)[0]
+        if roll < analytics_ratio:
+            yield {
+                "endpoint": "analytics",
+                "method": "GET",
+                "path": f"/analytics/{{link:{link}}}",
+            }
+        else:
+            yield {
+                "endpoint": "redirect",
+                "method": "GET",
+                "path": f"/{{link:{link}}}/",
+            }
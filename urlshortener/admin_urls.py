@@ -0,0 +1,11 @@
+"""
+Admin site, loaded on its first request. The admin app is installed with
+SimpleAdminConfig, so the ModelAdmins of every app are registered here
+rather than when the worker boots.
+"""
+
+from django.contrib import admin
+
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
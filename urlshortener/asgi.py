@@ -14,3 +14,23 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "urlshortener.settings")
 
 application = get_asgi_application()
+
+from urlshortenerapp.fastpath import AsyncRedirectApp
+
+# Answer GET /<code>/ on the event loop, before Django's handler
+application = AsyncRedirectApp(application)
+
+from urlshortenerapp.reaper import expiry_reaper
+
+# Reap expired links in the background when REAPER_INTERVAL is set
+expiry_reaper.start()
+
+from urlshortenerapp.bloom import code_filter
+
+# Load the short code filter so unknown codes 404 without a query
+code_filter.start()
+
+from urlshortenerapp.metrics import metrics
+
+# Share this worker's metrics with the others when METRICS_DIR is set
+metrics.start()
@@ -0,0 +1,13 @@
+"""
+URL configuration of redirect-only nodes, used when SERVER_PROFILE is
+"redirect". They answer visits and serve their metrics, nothing else.
+"""
+
+from django.urls import path
+
+from urlshortenerapp import redirect_views
+
+urlpatterns = [
+    path("metrics", redirect_views.metrics, name="metrics"),
+    path("<str:short_url>/", redirect_views.visit, name="visit_shortened_url"),
+]
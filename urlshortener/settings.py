@@ -45,9 +45,20 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
 ]
 CORS_ALLOW_ALL_ORIGINS = True
+
+# Server profile
+# "full" nodes serve everything. "redirect" nodes only answer visits and
+# /metrics, with views that do not need DRF: they leave out DRF, the admin,
+# sessions, messages, static files, swagger and CORS, with their
+# middleware, so that workers boot faster. In both profiles, swagger and
+# the admin are loaded by their first request.
+
+SERVER_PROFILE = os.environ.get("SERVER_PROFILE", "full")
+
 INSTALLED_APPS = [
     "urlshortenerapp",
-    "django.contrib.admin",
+    # Leaves admin.autodiscover() to urlshortener.admin_urls
+    "django.contrib.admin.apps.SimpleAdminConfig",
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "django.contrib.sessions",
@@ -59,6 +70,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "urlshortenerapp.middleware.MetricsMiddleware",
+    "urlshortenerapp.middleware.ReplicaPinMiddleware",
+    "urlshortenerapp.middleware.RateLimitMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -72,6 +86,21 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "urlshortener.urls"
 
+if SERVER_PROFILE == "redirect":
+    INSTALLED_APPS = [
+        "urlshortenerapp",
+        "django.contrib.auth",
+        "django.contrib.contenttypes",
+    ]
+    MIDDLEWARE = [
+        "urlshortenerapp.middleware.MetricsMiddleware",
+        "urlshortenerapp.middleware.ReplicaPinMiddleware",
+        "urlshortenerapp.middleware.RateLimitMiddleware",
+        "django.middleware.security.SecurityMiddleware",
+        "django.middleware.common.CommonMiddleware",
+    ]
+    ROOT_URLCONF = "urlshortener.redirect_urls"
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -98,9 +127,58 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Keep connections open between requests, checked before reuse
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Read replicas
+# Redirect and analytics reads go round-robin to the databases listed in
+# REPLICA_DATABASES, writes go to "default". After a write, reads stay on
+# "default" for REPLICA_PIN_SECONDS, for the rest of the request and for
+# the client's next requests, so clients read their own writes despite
+# replication lag. DATABASE_REPLICAS lists SQLite files standing in for
+# replicas locally, `manage.py sync_sqlite_replicas` copies the primary to
+# them.
+
+DATABASE_REPLICAS = [
+    name for name in os.environ.get("DATABASE_REPLICAS", "").split(",") if name
+]
+
+REPLICA_DATABASES = []
+for index, name in enumerate(DATABASE_REPLICAS, start=1):
+    DATABASES[f"replica{index}"] = {
+        **DATABASES["default"],
+        "NAME": name,
+        "TEST": {"MIRROR": "default"},
+    }
+    REPLICA_DATABASES.append(f"replica{index}")
+
+REPLICA_PIN_SECONDS = 5
+
+# Shards
+# Links are spread over SHARD_DATABASES by a hash of their short code, with
+# their access logs, rollups and archived copies on the same shard. The
+# short code sequence, sessions and users only live on "default", which is
+# always the first shard, and replicas only replicate "default".
+# DATABASE_SHARDS lists SQLite files for the other shards. After changing
+# it, migrate the new shards and run `manage.py rebalance_shards`.
+
+DATABASE_SHARDS = [
+    name for name in os.environ.get("DATABASE_SHARDS", "").split(",") if name
+]
+
+SHARD_DATABASES = ["default"]
+for index, name in enumerate(DATABASE_SHARDS, start=1):
+    DATABASES[f"shard{index}"] = {**DATABASES["default"], "NAME": name}
+    SHARD_DATABASES.append(f"shard{index}")
+
+DATABASE_ROUTERS = [
+    "urlshortenerapp.routers.ShardRouter",
+    "urlshortenerapp.routers.ReplicaRouter",
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -142,3 +220,209 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Resolve cache
+# Per-worker LRU cache used by the redirect view to avoid a database lookup
+# for every visit. Entries are also capped at the link's expiration_at.
+# Expired links are cached for RESOLVE_CACHE_EXPIRED_TTL seconds only, as
+# shortening their URL again revives them on every worker.
+
+RESOLVE_CACHE_MAX_ENTRIES = 10000
+
+RESOLVE_CACHE_TTL = 300  # seconds
+
+RESOLVE_CACHE_EXPIRED_TTL = 5  # seconds
+
+# Shared link table
+# With LINK_TABLE_PATH set, resolve cache misses are looked up in a table
+# in that memory-mapped file before the database, and links loaded from the
+# database are added to it. Every worker of a host maps the same file, so a
+# link is loaded once per host instead of once per worker. The table is the
+# "links" cache, a Django cache backend.
+
+LINK_TABLE_PATH = os.environ.get("LINK_TABLE_PATH") or None
+
+LINK_TABLE_SLOTS = 1 << 18
+
+LINK_TABLE_ARENA_BYTES = 128 << 20
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+
+if LINK_TABLE_PATH:
+    CACHES["links"] = {
+        "BACKEND": "urlshortenerapp.sharedtable.SharedMemoryCache",
+        "LOCATION": LINK_TABLE_PATH,
+        "TIMEOUT": RESOLVE_CACHE_TTL,
+        "OPTIONS": {
+            "SLOTS": LINK_TABLE_SLOTS,
+            "ARENA_BYTES": LINK_TABLE_ARENA_BYTES,
+        },
+    }
+
+RESOLVE_SHARED_CACHE = "links" if LINK_TABLE_PATH else None
+
+# Redirect caching
+# Redirects of links without a password may be cached by browsers and CDNs
+# for REDIRECT_MAX_AGE seconds, never past the link's expiration_at. Visits
+# answered by a cache do not reach the app, `manage.py import_edge_logs`
+# counts them from the CDN's logs. 0 makes clients revalidate every visit.
+
+REDIRECT_MAX_AGE = int(os.environ.get("REDIRECT_MAX_AGE", 0))  # seconds
+
+# Rate limits
+# With RATE_LIMIT_ENABLED, each worker limits the requests of every client
+# to the routes in RATE_LIMITS, by URL name: a client may send `burst`
+# requests at once, then `rate` requests per second, and gets a 429 with
+# Retry-After beyond that. Clients are told apart by REMOTE_ADDR, or by the
+# RATE_LIMIT_KEY_HEADER header if set and its value is one of
+# RATE_LIMIT_API_KEYS. Idle clients are forgotten every
+# RATE_LIMIT_SWEEP_INTERVAL seconds. At most RATE_LIMIT_MAX_CLIENTS are
+# tracked per route, the least recently seen make room for new ones.
+
+RATE_LIMIT_ENABLED = bool(int(os.environ.get("RATE_LIMIT_ENABLED", 0)))
+
+RATE_LIMITS = {
+    # route: (rate per second, burst)
+    "shorten_url": (5, 20),
+    "shorten_url_bulk": (0.5, 5),
+    "visit_shortened_url": (50, 200),
+}
+
+RATE_LIMIT_KEY_HEADER = None  # e.g. "X-Api-Key"
+
+RATE_LIMIT_API_KEYS = [
+    key for key in os.environ.get("RATE_LIMIT_API_KEYS", "").split(",") if key
+]
+
+RATE_LIMIT_SWEEP_INTERVAL = 60  # seconds
+
+RATE_LIMIT_MAX_CLIENTS = 100000
+
+# Write-behind visit counter
+# Visits are counted in memory and written back at most VISIT_FLUSH_INTERVAL
+# seconds later (the durability window), or as soon as VISIT_FLUSH_THRESHOLD
+# links have pending visits. An interval of 0 writes through on every visit.
+
+VISIT_FLUSH_INTERVAL = 5  # seconds
+
+VISIT_FLUSH_THRESHOLD = 1000
+
+# Access log buffer
+# Access logs are queued in memory and written with bulk_create every
+# ACCESS_LOG_FLUSH_INTERVAL seconds or once ACCESS_LOG_BATCH_SIZE entries are
+# queued. When ACCESS_LOG_QUEUE_SIZE entries are waiting, new entries are
+# dropped ("drop_newest") or replace the oldest ones ("drop_oldest").
+# Batches that fail to write are spooled to ACCESS_LOG_SPOOL_DIR and loaded
+# by `manage.py drain_access_logs`.
+
+ACCESS_LOG_QUEUE_SIZE = 10000
+
+ACCESS_LOG_BATCH_SIZE = 500
+
+ACCESS_LOG_FLUSH_INTERVAL = 1  # seconds
+
+ACCESS_LOG_DROP_POLICY = "drop_newest"
+
+ACCESS_LOG_SPOOL_DIR = BASE_DIR / "spool"
+
+# Access log compaction
+# `manage.py compact_access_logs` moves access logs of calendar months that
+# ended more than ACCESS_LOG_RETENTION_DAYS days ago out of AccessLog, into
+# compressed columnar segments of at most ACCESS_LOG_SEGMENT_ROWS logs per
+# link and month. Analytics read both.
+
+ACCESS_LOG_RETENTION_DAYS = 90
+
+ACCESS_LOG_SEGMENT_ROWS = 50000
+
+# Unique visitors
+# Visitor IPs of each link and rollup bucket are counted by HyperLogLog
+# sketches of 2 ** HLL_PRECISION registers (4 to 16). The standard error is
+# 1.04 / sqrt(2 ** HLL_PRECISION), 1.6% at 12, for at most 4 KB per sketch;
+# sketches of few visitors are stored sparse and are much smaller. Sketches
+# of different precisions merge at the lower one, so a change applies to
+# existing links after `manage.py backfill_rollups`.
+
+HLL_PRECISION = 12
+
+# Bulk shorten
+# Number of items validated and inserted per bulk_create by /shorten/bulk
+
+BULK_SHORTEN_BATCH_SIZE = 500
+
+# Short code allocation
+# SHORT_CODE_ALLOCATOR is the class generating short codes. CounterAllocator
+# hands out base62 codes from blocks of SHORT_CODE_BLOCK_SIZE IDs leased from
+# the database, so codes never collide. HashAllocator takes a prefix of the
+# URL's SHA-256 digest and collides at scale.
+
+SHORT_CODE_ALLOCATOR = "urlshortenerapp.allocators.CounterAllocator"
+
+SHORT_CODE_LENGTH = 8
+
+SHORT_CODE_BLOCK_SIZE = 1000
+
+# Expiry reaper
+# Links that expired more than REAPER_GRACE_PERIOD seconds ago are deleted,
+# with their access logs and rollups, by `manage.py reap_expired_links` or
+# every REAPER_INTERVAL seconds by a thread in each web worker (0 disables
+# it, schedule the command instead). Rows are deleted REAPER_BATCH_SIZE at a
+# time with a pause of REAPER_BATCH_PAUSE seconds between transactions.
+# With REAPER_ARCHIVE, links are copied to ArchivedURL before deletion.
+
+REAPER_INTERVAL = 0  # seconds
+
+REAPER_BATCH_SIZE = 500
+
+REAPER_BATCH_PAUSE = 0.05  # seconds
+
+REAPER_GRACE_PERIOD = 3600  # seconds
+
+REAPER_ARCHIVE = False
+
+# Short code filter
+# Each worker keeps a Bloom filter of all short codes so that visits to
+# unknown codes get a 404 without a database query. It is built at startup,
+# sized for BLOOM_FALSE_POSITIVE_RATE but capped at BLOOM_MAX_BYTES, and
+# rebuilt every BLOOM_REBUILD_INTERVAL seconds to forget deleted codes.
+# Codes created by other workers are read by a background thread every
+# BLOOM_SYNC_INTERVAL seconds, a link may 404 on other workers for that long
+# after creation. Rejecting a code never queries the database.
+
+BLOOM_FILTER_ENABLED = True
+
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+BLOOM_MAX_BYTES = 16 * 1024 * 1024
+
+BLOOM_SYNC_INTERVAL = 0.5  # seconds
+
+BLOOM_REBUILD_INTERVAL = 3600  # seconds
+
+# Metrics
+# Request latency, status and SQL query metrics are served at /metrics in
+# the Prometheus text format. Set METRICS_DIR to a directory shared by the
+# gunicorn workers of a host: each worker writes its metrics there every
+# METRICS_WRITE_INTERVAL seconds and /metrics adds up all of them. Empty it
+# when the server restarts.
+
+METRICS_LATENCY_BUCKETS = [
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+]  # seconds
+
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+
+METRICS_WRITE_INTERVAL = 5  # seconds
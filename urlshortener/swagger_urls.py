@@ -0,0 +1,31 @@
+"""
+Swagger UI, loaded on its first request. Importing urlshortenerapp.schema
+documents the views.
+"""
+
+from django.urls import path
+from drf_yasg import openapi
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+import urlshortenerapp.schema  # noqa: F401
+
+schema_view = get_schema_view(
+    openapi.Info(
+        title="URL Shortener API",
+        default_version="v1",
+        description="A simple URL shortener API",
+        terms_of_service="https://www.google.com/policies/terms/",
+        contact=openapi.Contact(email="krtkrathee@gmail.com"),
+    ),
+    public=True,
+    permission_classes=(permissions.AllowAny,),
+)
+
+urlpatterns = [
+    path(
+        "",
+        schema_view.with_ui("swagger", cache_timeout=0),
+        name="schema-swagger-ui",
+    ),
+]
@@ -15,36 +15,31 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
-from django.contrib import admin
-from django.urls import path
-from drf_yasg import openapi
-from drf_yasg.views import get_schema_view
-from rest_framework import permissions
+from django.urls import URLResolver, path
+from django.urls.resolvers import RoutePattern
 
-from urlshortenerapp import views
+from urlshortenerapp import redirect_views, views
+
+
+def lazy_include(route, urlconf, namespace=None):
+    """
+    Like path(route, include(urlconf)), but `urlconf` is imported when a
+    request first reaches `route` rather than when the worker boots.
+    """
+    return URLResolver(
+        RoutePattern(route), urlconf, app_name=namespace, namespace=namespace
+    )
 
-# Swagger documentation
-schema_view = get_schema_view(
-    openapi.Info(
-        title="URL Shortener API",
-        default_version="v1",
-        description="A simple URL shortener API",
-        terms_of_service="https://www.google.com/policies/terms/",
-        contact=openapi.Contact(email="krtkrathee@gmail.com"),
-    ),
-    public=True,
-    permission_classes=(permissions.AllowAny,),
-)
 
 urlpatterns = [
-    path(
-        "swagger/",
-        schema_view.with_ui("swagger", cache_timeout=0),
-        name="schema-swagger-ui",
-    ),
-    path("admin/", admin.site.urls),
+    # Swagger documentation
+    lazy_include("swagger/", "urlshortener.swagger_urls"),
+    lazy_include("admin/", "urlshortener.admin_urls", namespace="admin"),
     path("", views.home, name="home"),
     path("shorten", views.shorten_url, name="shorten_url"),
+    path("shorten/bulk", views.shorten_url_bulk, name="shorten_url_bulk"),
+    path("metrics", redirect_views.metrics, name="metrics"),
+    path("export", views.export_access_logs, name="export_access_logs"),
     path("<str:short_url>/", views.visit_shortened_url, name="visit_shortened_url"),
     path("analytics/<path:short_url>", views.analytics, name="log_access_to_url"),
 ]
@@ -11,24 +11,26 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
-from .settings import BASE_DIR
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "urlshortener.settings")
 
-STATIC_URL = "/static/"
+application = get_wsgi_application()
 
-# The directory where static files will be collected
-STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
+from urlshortenerapp.fastpath import RedirectApp
 
-# Optionally, add the directories where static files are stored
-STATICFILES_DIRS = [
-    os.path.join(BASE_DIR, "static"),
-]
+# Answer GET /<code>/ before the Django handler and its middleware stack
+application = RedirectApp(application)
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "urlshortener.settings")
+from urlshortenerapp.reaper import expiry_reaper
 
-application = get_wsgi_application()
+# Reap expired links in the background when REAPER_INTERVAL is set
+expiry_reaper.start()
+
+from urlshortenerapp.bloom import code_filter
+
+# Load the short code filter so unknown codes 404 without a query
+code_filter.start()
 
-from whitenoise import WhiteNoise
+from urlshortenerapp.metrics import metrics
 
-application = WhiteNoise(
-    application, root=os.path.join(os.path.dirname(__file__), "staticfiles")
-)
+# Share this worker's metrics with the others when METRICS_DIR is set
+metrics.start()
@@ -0,0 +1,346 @@
+import atexit
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    DataError,
+    IntegrityError,
+    close_old_connections,
+    transaction,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import rollups
+from .models import AccessLog, ShortenedURL
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT_MAX_LENGTH = AccessLog._meta.get_field("user_agent").max_length
+
+REFERRER_MAX_LENGTH = AccessLog._meta.get_field("referrer").max_length
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+
+# Stored for clients without a valid address, e.g. an empty REMOTE_ADDR
+UNKNOWN_IP = "0.0.0.0"
+
+
+def normalize_ip(ip_address):
+    try:
+        return str(ipaddress.ip_address(ip_address))
+    except ValueError:
+        return UNKNOWN_IP
+
+
+def entry_record(entry):
+    """JSON-serializable dict of a queued entry, as stored in spool files."""
+    short_url_id, ip_address, user_agent, referrer, accessed_at, shard = entry
+    return {
+        "short_url_id": short_url_id,
+        "ip_address": ip_address,
+        "user_agent": user_agent,
+        "referrer": referrer,
+        "accessed_at": accessed_at.isoformat(),
+        "shard": shard,
+    }
+
+
+def record_entry(record):
+    """Queued entry of a spool file record. Raises ValueError if invalid."""
+    try:
+        accessed_at = parse_datetime(record["accessed_at"])
+        entry = (
+            int(record["short_url_id"]),
+            record["ip_address"],
+            record["user_agent"],
+            record.get("referrer", ""),
+            accessed_at,
+            record.get("shard", DEFAULT_DB_ALIAS),
+        )
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid spooled access log: {e!r}")
+    if accessed_at is None:
+        raise ValueError("Invalid spooled access log: no accessed_at")
+    return entry
+
+
+class AccessLogBuffer:
+    """
+    Bounded in-memory queue of access log entries.
+
+    Entries are written with bulk_create by a background thread, every
+    `flush_interval` seconds or as soon as `batch_size` entries are queued.
+    When the queue holds `max_size` entries new ones are dropped
+    (DROP_NEWEST) or replace the oldest queued entry (DROP_OLDEST).
+    Batches that cannot be written are spilled to `spool_dir`, from where
+    `manage.py drain_access_logs` loads them. Entries the database refuses
+    are left out of their batch and counted as rejected. A `flush_interval`
+    of 0 writes through on every submit.
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, drop_policy, spool_dir):
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"Unknown access log drop policy: {drop_policy}")
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.spool_dir = Path(spool_dir)
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.spilled = 0
+        self.rejected = 0
+
+    def submit(
+        self,
+        short_url_id,
+        ip_address,
+        user_agent,
+        referrer="",
+        accessed_at=None,
+        shard=DEFAULT_DB_ALIAS,
+    ):
+        """
+        Queue an access log entry for the link `short_url_id` on the database
+        `shard`. Returns False if it was dropped.
+        """
+        entry = (
+            short_url_id,
+            normalize_ip(ip_address),
+            (user_agent or "")[:USER_AGENT_MAX_LENGTH],
+            (referrer or "")[:REFERRER_MAX_LENGTH],
+            accessed_at or timezone.now(),
+            shard,
+        )
+        with self._lock:
+            if len(self._queue) >= self.max_size:
+                self.dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    return False
+                self._queue.popleft()
+            self._queue.append(entry)
+            self.submitted += 1
+            queued = len(self._queue)
+        if not self.flush_interval:
+            self.flush()
+            return True
+        self._ensure_started()
+        if queued >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """Write every queued entry to the database in batches."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [
+                        self._queue.popleft()
+                        for _ in range(min(self.batch_size, len(self._queue)))
+                    ]
+                if not batch:
+                    break
+                try:
+                    rejected = self._write_valid(batch)
+                except Exception:
+                    logger.exception("Failed to write %d access logs", len(batch))
+                    self.spill(batch)
+                else:
+                    written += len(batch) - len(rejected)
+        self.written += written
+        return written
+
+    def _write_valid(self, batch):
+        """
+        Write a batch, leaving out the entries the database refuses, found
+        by writing halves of the batch. Returns those entries.
+        """
+        try:
+            self._write(batch)
+            return []
+        except (IntegrityError, DataError):
+            if len(batch) == 1:
+                logger.exception("Rejected access log %r", batch[0])
+                self.rejected += 1
+                return batch
+        middle = len(batch) // 2
+        return self._write_valid(batch[:middle]) + self._write_valid(batch[middle:])
+
+    def spill(self, entries):
+        """Write entries to a spool file for drain_access_logs to load."""
+        if not entries:
+            return None
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        name = f"accesslogs-{os.getpid()}-{time.time_ns()}.ndjson"
+        path = self.spool_dir / name
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as spool:
+            for entry in entries:
+                spool.write(json.dumps(entry_record(entry)) + "\n")
+        # Rename last so the drain command never sees a partial file
+        os.replace(tmp_path, path)
+        self.spilled += len(entries)
+        return path
+
+    def drain_spool(self):
+        """
+        Load spooled entries into the database, skipping entries whose link
+        has been deleted since. Lines that cannot be loaded are moved to a
+        "rejected-" file next to their spool file, so that they do not hold
+        up the rest. Returns the number of rows written.
+        """
+        written = 0
+        for path in sorted(self.spool_dir.glob("accesslogs-*.ndjson")):
+            with open(path) as spool:
+                lines = spool.readlines()
+            entries = []
+            invalid = []
+            for line in lines:
+                try:
+                    entries.append(record_entry(json.loads(line)))
+                except ValueError:
+                    invalid.append(line)
+            lines = [json.dumps(entry_record(entry)) + "\n" for entry in entries]
+            if invalid:
+                self._quarantine(path, invalid)
+                self._rewrite(path, lines)
+            for i in range(0, len(entries), self.batch_size):
+                batch = entries[i : i + self.batch_size]
+                existing = set()
+                for shard in {entry[5] for entry in batch}:
+                    existing.update(
+                        (shard, pk)
+                        for pk in ShortenedURL.objects.using(shard)
+                        .filter(pk__in={entry[0] for entry in batch})
+                        .values_list("pk", flat=True)
+                    )
+                batch = [entry for entry in batch if (entry[5], entry[0]) in existing]
+                rejected = self._write_valid(batch)
+                self._quarantine(
+                    path,
+                    [json.dumps(entry_record(entry)) + "\n" for entry in rejected],
+                )
+                written += len(batch) - len(rejected)
+                # Drop the committed batch from the file, so that a drain
+                # failing on a later one does not write it again
+                self._rewrite(path, lines[i + self.batch_size :])
+            path.unlink(missing_ok=True)
+        return written
+
+    def _rewrite(self, path, lines):
+        if not lines:
+            path.unlink()
+            return
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as spool:
+            spool.writelines(lines)
+        os.replace(tmp_path, path)
+
+    def _quarantine(self, path, lines):
+        if lines:
+            logger.warning("Moving %d invalid access logs out of %s", len(lines), path)
+            with open(path.with_name(f"rejected-{path.name}"), "a") as rejected:
+                rejected.writelines(lines)
+
+    def shutdown(self):
+        """Stop the background thread and write whatever is still queued."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            "queued": len(self._queue),
+            "max_size": self.max_size,
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "written": self.written,
+            "spilled": self.spilled,
+            "rejected": self.rejected,
+        }
+
+    def _write(self, batch):
+        by_shard = defaultdict(list)
+        for entry in batch:
+            by_shard[entry[5]].append(entry)
+        # One transaction per shard, all of them must commit for the batch
+        # to count as written
+        with ExitStack() as stack:
+            for shard, entries in by_shard.items():
+                stack.enter_context(transaction.atomic(using=shard))
+                AccessLog.objects.using(shard).bulk_create(
+                    [
+                        AccessLog(
+                            short_url_id=short_url_id,
+                            ip_address=ip_address,
+                            user_agent=user_agent,
+                            referrer=referrer,
+                            accessed_at=accessed_at,
+                        )
+                        for short_url_id, ip_address, user_agent, referrer, accessed_at, _ in entries
+                    ]
+                )
+                # Same transaction, so a batch is never counted twice on retry
+                rollups.record(
+                    (
+                        (short_url_id, ip_address, referrer, accessed_at)
+                        for short_url_id, ip_address, _, referrer, accessed_at, _ in entries
+                    ),
+                    using=shard,
+                )
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="access-log-flush", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped:
+                # shutdown() does the final flush in the calling thread
+                break
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush access logs")
+            finally:
+                close_old_connections()
+
+
+access_log_buffer = AccessLogBuffer(
+    max_size=settings.ACCESS_LOG_QUEUE_SIZE,
+    batch_size=settings.ACCESS_LOG_BATCH_SIZE,
+    flush_interval=settings.ACCESS_LOG_FLUSH_INTERVAL,
+    drop_policy=settings.ACCESS_LOG_DROP_POLICY,
+    spool_dir=settings.ACCESS_LOG_SPOOL_DIR,
+)
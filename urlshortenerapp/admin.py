@@ -1,3 +1,59 @@
 from django.contrib import admin
+from django.contrib.admin.utils import quote, unquote
+from django.contrib.admin.views.main import ChangeList
+from django.urls import reverse
 
-# Register your models here.
+from .models import ShortenedURL
+from .routers import shard_for
+
+
+class ShardedChangeList(ChangeList):
+    def url_for_result(self, result):
+        # Primary keys are only unique within a shard, codes are unique
+        opts = self.opts
+        return reverse(
+            f"admin:{opts.app_label}_{opts.model_name}_change",
+            args=(quote(result.code),),
+            current_app=self.model_admin.admin_site.name,
+        )
+
+
+@admin.register(ShortenedURL)
+class ShortenedURLAdmin(admin.ModelAdmin):
+    """
+    Lists links of every shard, merged, and opens them by short code. Bulk
+    actions select rows by primary key, which is ambiguous across shards, so
+    they are disabled. Links are created through the API only, which
+    allocates their codes.
+    """
+
+    list_display = [
+        "code",
+        "original_url",
+        "created_at",
+        "expiration_at",
+        "visits",
+        "shard",
+    ]
+    search_fields = ["code", "original_url"]
+    ordering = ["-created_at"]
+    actions = None
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).all_shards()
+
+    def get_changelist(self, request, **kwargs):
+        return ShardedChangeList
+
+    def get_object(self, request, object_id, from_field=None):
+        code = unquote(object_id)
+        return (
+            self.get_queryset(request).using(shard_for(code)).filter(code=code).first()
+        )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description="Shard")
+    def shard(self, obj):
+        return shard_for(obj.code)
@@ -0,0 +1,108 @@
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from .models import CodeSequence
+
+BASE62_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Prime multiplier used to scatter sequential IDs over the code space. Being
+# coprime with 62 it maps every ID below 62 ** length to a distinct code.
+SCATTER_MULTIPLIER = 2654435761
+
+
+def base62_encode(number, length):
+    """Encode a non-negative integer as a zero-padded base62 string."""
+    digits = []
+    while number:
+        number, remainder = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[remainder])
+    return "".join(reversed(digits)).rjust(length, BASE62_ALPHABET[0])
+
+
+class HashAllocator:
+    """
+    Derive the code from the SHA-256 digest of the original URL.
+
+    The same URL always gets the same code, but different URLs collide once
+    there are around 16 ** (length / 2) links.
+    """
+
+    def __init__(self, length, block_size=None):
+        self.length = length
+
+    def allocate(self, original_url):
+        return hashlib.sha256(original_url.encode()).hexdigest()[: self.length]
+
+
+class CounterAllocator:
+    """
+    Hand out base62 codes from a counter, hi/lo style.
+
+    Each worker leases a block of `block_size` IDs at a time from the
+    CodeSequence row, so codes are unique across workers and allocating one
+    does not touch the database until the block is used up. IDs are
+    scattered over the code space so consecutive links do not get
+    consecutive codes.
+    """
+
+    sequence_name = "short_code"
+
+    def __init__(self, length, block_size):
+        self.length = length
+        self.block_size = block_size
+        self.capacity = 62**length
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._block_end = 0
+
+    def allocate(self, original_url=None):
+        with self._lock:
+            if self._next_id >= self._block_end:
+                self._lease_block()
+            number = self._next_id
+            self._next_id += 1
+        if number >= self.capacity:
+            raise OverflowError(
+                f"All {self.length}-character short codes are allocated, "
+                "increase SHORT_CODE_LENGTH"
+            )
+        return base62_encode(number * SCATTER_MULTIPLIER % self.capacity, self.length)
+
+    def _lease_block(self):
+        sequence = CodeSequence.objects.filter(name=self.sequence_name)
+        with transaction.atomic():
+            if not sequence.update(next_block=F("next_block") + 1):
+                # First lease ever, concurrent creators end up sharing the row
+                CodeSequence.objects.get_or_create(name=self.sequence_name)
+                sequence.update(next_block=F("next_block") + 1)
+            block = sequence.values_list("next_block", flat=True).get() - 1
+        self._next_id = block * self.block_size
+        self._block_end = self._next_id + self.block_size
+
+
+def create_allocator():
+    """Instantiate the SHORT_CODE_ALLOCATOR class from settings."""
+    allocator_class = import_string(settings.SHORT_CODE_ALLOCATOR)
+    return allocator_class(
+        length=settings.SHORT_CODE_LENGTH,
+        block_size=settings.SHORT_CODE_BLOCK_SIZE,
+    )
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_allocator():
+    """Return the per-worker allocator, creating it on first use."""
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                _allocator = create_allocator()
+    return _allocator
@@ -0,0 +1,167 @@
+import base64
+import heapq
+import itertools
+import json
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Q
+from django.utils.dateparse import parse_datetime
+
+from . import hll, segments
+from .models import AccessLog, DailyClickRollup, HourlyClickRollup, VisitorSketch
+
+ROLLUP_MODELS = {"hour": HourlyClickRollup, "day": DailyClickRollup}
+
+TOP_N = 10
+
+STREAM_CHUNK_SIZE = 2000
+
+# Fields of an access log in analytics responses
+LOG_FIELDS = ["ip_address", "user_agent", "accessed_at"]
+
+
+def encode_cursor(accessed_at, log_id):
+    value = f"{accessed_at.isoformat()}|{log_id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (accessed_at, id) position encoded in a cursor."""
+    try:
+        accessed_at, log_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        accessed_at = parse_datetime(accessed_at)
+        log_id = int(log_id)
+    except ValueError:
+        accessed_at = None
+    if accessed_at is None:
+        raise ValidationError("The cursor is not valid.")
+    return accessed_at, log_id
+
+
+def paginate_logs(shortened_url, cursor=None, limit=100):
+    """
+    Return one page of access logs, newest first, and the cursor of the next
+    page (None on the last page). Seeks on the (short_url, accessed_at)
+    index rather than using OFFSET, so deep pages cost the same as the first.
+    """
+    logs = AccessLog.objects.for_code(shortened_url.code).filter(
+        short_url=shortened_url
+    )
+    position = None
+    if cursor:
+        position = decode_cursor(cursor)
+        accessed_at, log_id = position
+        logs = logs.filter(
+            Q(accessed_at__lt=accessed_at) | Q(accessed_at=accessed_at, id__lt=log_id)
+        )
+    live = logs.order_by("-accessed_at", "-id").values(
+        "id", "ip_address", "user_agent", "accessed_at"
+    )[: limit + 1]
+    # Compacted months continue the page where the table runs out
+    archived = segments.archived_logs(shortened_url, position)
+    merged = heapq.merge(live, archived, key=segments.log_position, reverse=True)
+    rows = list(itertools.islice(merged, limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["accessed_at"], rows[-1]["id"])
+    return [{field: row[field] for field in LOG_FIELDS} for row in rows], next_cursor
+
+
+def clicks_per_bucket(shortened_url, granularity, start=None, end=None):
+    """
+    Clicks, approximate unique IPs with their sketch and top referrers per
+    hour or day, read from the rollup tables instead of scanning access logs.
+    """
+    if granularity not in ROLLUP_MODELS:
+        raise ValidationError("aggregate must be 'hour' or 'day'.")
+    model = ROLLUP_MODELS[granularity]
+    rollups = model.objects.for_code(shortened_url.code).filter(short_url=shortened_url)
+    if start is not None:
+        rollups = rollups.filter(bucket__gte=start)
+    if end is not None:
+        rollups = rollups.filter(bucket__lt=end)
+    return list(
+        rollups.order_by("bucket").values(
+            "bucket", "clicks", "unique_ips", "ip_sketch", "top_referrers"
+        )
+    )
+
+
+def unique_visitors(shortened_url):
+    """Approximate distinct IPs that ever visited a link."""
+    visitors = (
+        VisitorSketch.objects.for_code(shortened_url.code)
+        .filter(short_url=shortened_url)
+        .values_list("unique_visitors", flat=True)
+        .first()
+    )
+    return visitors or 0
+
+
+def unique_ips(buckets):
+    """
+    Approximate distinct IPs over the buckets from clicks_per_bucket,
+    merging their sketches rather than adding up their estimates.
+    """
+    sketches = (bucket["ip_sketch"] for bucket in buckets)
+    return hll.merged(sketches, settings.HLL_PRECISION).count()
+
+
+def top_referrers(buckets, limit=TOP_N):
+    """Merge the referrer counts of the buckets from clicks_per_bucket."""
+    referrers = Counter()
+    for bucket in buckets:
+        referrers.update(bucket["top_referrers"])
+    return [
+        {"referrer": referrer, "clicks": clicks}
+        for referrer, clicks in referrers.most_common(limit)
+    ]
+
+
+def top_values(shortened_url, field, limit=TOP_N):
+    """
+    Most frequent values of `field` with their click counts, in the table
+    and compacted segments. Values outside the top `limit` of both are not
+    considered.
+    """
+    logs = AccessLog.objects.for_code(shortened_url.code).filter(
+        short_url=shortened_url
+    )
+    counts = logs.values_list(field).annotate(clicks=Count("id"))
+    clicks = dict(counts.order_by("-clicks", field)[:limit])
+    archived = segments.archived_value_counts(shortened_url, field)
+    if archived:
+        candidates = [value for value, _ in archived.most_common(limit)]
+        missing = [value for value in candidates if value not in clicks]
+        clicks.update(counts.filter(**{f"{field}__in": missing}))
+        for value in clicks.keys() | set(candidates):
+            clicks[value] = clicks.get(value, 0) + archived[value]
+    ranked = sorted(clicks.items(), key=lambda item: (-item[1], item[0]))
+    return [{field: value, "clicks": count} for value, count in ranked[:limit]]
+
+
+def stream_logs(shortened_url):
+    """
+    Yield every access log as an NDJSON line without loading them all,
+    compacted ones one month at a time.
+    """
+    logs = (
+        AccessLog.objects.for_code(shortened_url.code)
+        .filter(short_url=shortened_url)
+        .order_by("-accessed_at", "-id")
+        .values("id", "ip_address", "user_agent", "accessed_at")
+    )
+    merged = heapq.merge(
+        logs.iterator(chunk_size=STREAM_CHUNK_SIZE),
+        segments.archived_logs(shortened_url),
+        key=segments.log_position,
+        reverse=True,
+    )
+    for row in merged:
+        yield json.dumps(
+            {field: row[field] for field in LOG_FIELDS}, cls=DjangoJSONEncoder
+        ) + "\n"
@@ -0,0 +1,258 @@
+import atexit
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+# Links the filter is sized for, relative to the table size at rebuild time,
+# so that codes added until the next rebuild keep the false positive rate
+CAPACITY_HEADROOM = 2
+
+MIN_CAPACITY = 1024
+
+# Rows below the highest primary key read by a rebuild that the next sync
+# reads again, to pick up rows whose transaction committed during the build
+SYNC_OVERLAP = 1000
+
+# Primary keys below the highest seen that were missing, read again by each
+# sync in case their transaction commits late, for at most HOLE_TTL seconds
+MAX_HOLES = 500
+
+HOLE_TTL = 60
+
+REBUILD_CHUNK_SIZE = 10000
+
+
+class BloomFilter:
+    """
+    Set membership with no false negatives, sized for `capacity` items at
+    `false_positive_rate` but never larger than `max_bytes`.
+    """
+
+    def __init__(self, capacity, false_positive_rate, max_bytes):
+        num_bits = math.ceil(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        self.num_bits = max(8, min(num_bits, max_bytes * 8))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.num_bits / 8))
+
+    def _positions(self, item):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def false_positive_rate(self):
+        """Current false positive rate, from the fraction of bits set."""
+        set_bits = int.from_bytes(self.bits, "little").bit_count()
+        return (set_bits / self.num_bits) ** self.num_hashes
+
+
+class CodeFilter:
+    """
+    Per-worker negative cache of short codes.
+
+    A Bloom filter of every code in ShortenedURL lets the redirect path
+    answer 404 for unknown codes without a database query. Codes created by
+    this worker are added as they are saved. A background thread picks up
+    codes created by other workers every `sync_interval` seconds, with
+    sync(), and rebuilds the filter every `rebuild_interval` seconds to drop
+    deleted codes. Until the first build, every code may exist.
+    """
+
+    def __init__(
+        self, enabled, false_positive_rate, max_bytes, sync_interval, rebuild_interval
+    ):
+        self.enabled = enabled
+        self.false_positive_rate = false_positive_rate
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self._filter = None
+        # Shard -> highest primary key seen
+        self._max_pk = {}
+        # Shard -> {missing primary key below it: when it was found missing}
+        self._holes = {}
+        self._rebuilding = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.rejected = 0
+        self.syncs = 0
+        self.rebuilds = 0
+
+    def might_exist(self, code):
+        """False only if `code` was not a ShortenedURL code at the last sync."""
+        bloom = self._filter
+        if bloom is None or code in bloom:
+            return True
+        self.rejected += 1
+        return False
+
+    async def amight_exist(self, code):
+        """Async version of might_exist() for the ASGI redirect path."""
+        return self.might_exist(code)
+
+    def add(self, code):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(code)
+            if self._rebuilding is not None:
+                self._rebuilding.append(code)
+
+    def sync(self):
+        """Add codes of rows created by other workers since the last sync."""
+        for shard in settings.SHARD_DATABASES:
+            self.sync_shard(shard)
+
+    def sync_shard(self, shard):
+        """
+        Add codes of rows past the highest primary key seen on `shard`, and
+        of rows filling the holes below it.
+        """
+        from .models import ShortenedURL
+
+        with self._sync_lock:
+            now = time.monotonic()
+            max_pk = self._max_pk.get(shard, 0)
+            holes = self._holes.setdefault(shard, {})
+            # Holes are kept in the order they were found
+            while holes and next(iter(holes.values())) < now - HOLE_TTL:
+                del holes[next(iter(holes))]
+            rows = list(
+                ShortenedURL.objects.using(shard)
+                .filter(Q(pk__gt=max_pk) | Q(pk__in=list(holes)))
+                .values_list("pk", "code")
+            )
+            seen = set()
+            with self._lock:
+                for pk, code in rows:
+                    self._filter.add(code)
+                    if self._rebuilding is not None:
+                        self._rebuilding.append(code)
+                    seen.add(pk)
+                    holes.pop(pk, None)
+            new_max_pk = max(seen, default=max_pk)
+            # Rows of transactions that committed after a later one
+            first = max(max_pk + 1, new_max_pk - MAX_HOLES + 1)
+            for pk in range(first, new_max_pk):
+                if pk not in seen:
+                    holes[pk] = now
+            while len(holes) > MAX_HOLES:
+                del holes[next(iter(holes))]
+            self._max_pk[shard] = max(max_pk, new_max_pk)
+            self.syncs += 1
+
+    def rebuild(self):
+        """Build a new filter from the whole table and swap it in."""
+        from .models import ShortenedURL
+
+        # Read from the shards themselves, sync() as well: a lagging replica
+        # would hide new codes
+        with self._lock:
+            self._rebuilding = []
+        try:
+            links = sum(
+                ShortenedURL.objects.using(shard).count()
+                for shard in settings.SHARD_DATABASES
+            )
+            capacity = max(MIN_CAPACITY, links * CAPACITY_HEADROOM)
+            bloom = BloomFilter(capacity, self.false_positive_rate, self.max_bytes)
+            max_pk = {}
+            for shard in settings.SHARD_DATABASES:
+                max_pk[shard] = 0
+                rows = ShortenedURL.objects.using(shard).values_list("pk", "code")
+                for pk, code in rows.iterator(chunk_size=REBUILD_CHUNK_SIZE):
+                    bloom.add(code)
+                    max_pk[shard] = max(max_pk[shard], pk)
+            with self._lock:
+                # Codes saved by this worker while the table was being read
+                for code in self._rebuilding:
+                    bloom.add(code)
+                self._filter = bloom
+                self._max_pk = {
+                    shard: max(0, pk - SYNC_OVERLAP) for shard, pk in max_pk.items()
+                }
+                self._holes = {}
+        finally:
+            with self._lock:
+                self._rebuilding = None
+        self.rebuilds += 1
+
+    def start(self):
+        """Build the filter and keep it up to date in a background thread."""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="code-filter", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        bloom = self._filter
+        if bloom is None:
+            return {"ready": False, "rejected": self.rejected}
+        return {
+            "ready": True,
+            "bytes": len(bloom.bits),
+            "hashes": bloom.num_hashes,
+            "false_positive_rate": bloom.false_positive_rate(),
+            "rejected": self.rejected,
+            "syncs": self.syncs,
+            "rebuilds": self.rebuilds,
+        }
+
+    def _run(self):
+        rebuild_at = 0.0
+        while not self._stopped:
+            try:
+                if time.monotonic() >= rebuild_at:
+                    rebuild_at = time.monotonic() + self.rebuild_interval
+                    self.rebuild()
+                else:
+                    self.sync()
+            except Exception:
+                logger.exception("Failed to update the short code filter")
+            finally:
+                close_old_connections()
+            self._wakeup.wait(self.sync_interval)
+
+
+code_filter = CodeFilter(
+    enabled=settings.BLOOM_FILTER_ENABLED,
+    false_positive_rate=settings.BLOOM_FALSE_POSITIVE_RATE,
+    max_bytes=settings.BLOOM_MAX_BYTES,
+    sync_interval=settings.BLOOM_SYNC_INTERVAL,
+    rebuild_interval=settings.BLOOM_REBUILD_INTERVAL,
+)
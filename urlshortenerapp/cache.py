@@ -0,0 +1,245 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import Http404
+from django.utils import timezone
+
+from .bloom import code_filter
+from .routers import shard_for
+
+
+def shared_key(code):
+    return f"link:{code}"
+
+
+class CachedLink:
+    """Snapshot of the ShortenedURL fields the redirect path needs."""
+
+    __slots__ = (
+        "pk",
+        "code",
+        "original_url",
+        "password",
+        "expiration_at",
+        "redirect_type",
+        "etag",
+        "deadline",
+    )
+
+    def __init__(
+        self,
+        pk,
+        code,
+        original_url,
+        password,
+        expiration_at,
+        redirect_type,
+        deadline,
+    ):
+        self.pk = pk
+        self.code = code
+        self.original_url = original_url
+        self.password = password
+        self.expiration_at = expiration_at
+        self.redirect_type = redirect_type
+        # Changes whenever the redirect does
+        digest = hashlib.blake2b(
+            f"{redirect_type} {original_url}".encode(), digest_size=8
+        )
+        self.etag = f'"{digest.hexdigest()}"'
+        self.deadline = deadline
+
+    @property
+    def short_url(self):
+        return f"{settings.BASE_URL}/{self.code}"
+
+    def is_expired(self):
+        """Check if the shortened URL has expired."""
+        return self.expiration_at is not None and timezone.now() > self.expiration_at
+
+
+class ResolveCache:
+    """
+    Bounded per-worker LRU cache of short code -> CachedLink.
+
+    Entries live for at most `ttl` seconds and never past the link's
+    `expiration_at`, so a link flips to "expired" on time even while hot.
+    Expired links live for at most `expired_ttl` seconds: shortening their
+    URL again revives them, and other workers must notice.
+    With `shared`, the alias of a Django cache shared by the workers, misses
+    are looked up there before the database, and links loaded from the
+    database are added to it for the same time.
+    """
+
+    def __init__(self, max_entries, ttl, shared=None, expired_ttl=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.expired_ttl = expired_ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so that a load racing with a write
+        # does not put the stale row back into the cache.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def get(self, code):
+        now = time.monotonic()
+        with self._lock:
+            link = self._entries.get(code)
+            if link is None or link.deadline <= now:
+                if link is not None:
+                    del self._entries[code]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(code)
+            self.hits += 1
+            return link
+
+    def put(self, instance, generation=None):
+        """Cache the redirect fields of a ShortenedURL instance."""
+        ttl = self.ttl
+        if instance.expiration_at is not None:
+            remaining = (instance.expiration_at - timezone.now()).total_seconds()
+            # insert_or_fetch() extends expired links, which only invalidates
+            # this worker's entry and the shared one
+            ttl = min(ttl, remaining if remaining > 0 else self.expired_ttl)
+        fields = (
+            instance.pk,
+            instance.code,
+            instance.original_url,
+            instance.password,
+            instance.expiration_at,
+            instance.redirect_type,
+        )
+        link = self._store(CachedLink(*fields, time.monotonic() + ttl), generation)
+        if self.shared is not None and generation in (None, self._generation):
+            value = (*fields, time.time() + ttl)
+            caches[self.shared].set(shared_key(link.code), value, ttl)
+        return link
+
+    def get_shared(self, code):
+        """Load `code` from the shared cache into this one, None if missing."""
+        if self.shared is None:
+            return None
+        generation = self._generation
+        value = caches[self.shared].get(shared_key(code))
+        if value is None:
+            return None
+        *fields, expires = value
+        # Only for as long as the shared entry was stored for
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return None
+        self.shared_hits += 1
+        return self._store(
+            CachedLink(*fields, time.monotonic() + remaining), generation
+        )
+
+    def _store(self, link, generation):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return link
+            self._entries[link.code] = link
+            self._entries.move_to_end(link.code)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return link
+
+    def invalidate(self, code):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(code, None)
+        if self.shared is not None:
+            caches[self.shared].delete(shared_key(code))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+        if self.shared is not None:
+            caches[self.shared].clear()
+
+    def resolve(self, code):
+        """
+        Return the CachedLink for `code`, loading it from the database on a
+        miss. Raises Http404 if the link does not exist.
+        """
+        link = self.get(code) or self.get_shared(code)
+        if link is not None:
+            return link
+
+        # Codes that were never created are rejected without a query
+        if not code_filter.might_exist(code):
+            raise Http404("No ShortenedURL matches the given query.")
+
+        generation = self._generation
+        queryset, db, shard = self._queryset(code)
+        instance = queryset.first()
+        if instance is None and db != shard:
+            # The link may be too new to have reached the replica
+            instance = queryset.using(shard).first()
+        if instance is None:
+            raise Http404("No ShortenedURL matches the given query.")
+        return self.put(instance, generation)
+
+    async def aresolve(self, code):
+        """Async version of resolve() for the ASGI redirect path."""
+        link = self.get(code) or self.get_shared(code)
+        if link is not None:
+            return link
+
+        if not await code_filter.amight_exist(code):
+            raise Http404("No ShortenedURL matches the given query.")
+
+        generation = self._generation
+        queryset, db, shard = self._queryset(code)
+        instance = await queryset.afirst()
+        if instance is None and db != shard:
+            instance = await queryset.using(shard).afirst()
+        if instance is None:
+            raise Http404("No ShortenedURL matches the given query.")
+        return self.put(instance, generation)
+
+    @staticmethod
+    def _queryset(code):
+        """The query loading `code`, the database it reads and the shard."""
+        from .models import ShortenedURL
+
+        db = ShortenedURL.objects.for_code(code).db
+        queryset = (
+            ShortenedURL.objects.using(db)
+            .filter(code=code)
+            .only("code", "original_url", "password", "expiration_at", "redirect_type")
+        )
+        return queryset, db, shard_for(code)
+
+    def stats(self):
+        """Counters for tuning RESOLVE_CACHE_MAX_ENTRIES and RESOLVE_CACHE_TTL."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "shared_hits": self.shared_hits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+resolve_cache = ResolveCache(
+    max_entries=settings.RESOLVE_CACHE_MAX_ENTRIES,
+    ttl=settings.RESOLVE_CACHE_TTL,
+    shared=settings.RESOLVE_SHARED_CACHE,
+    expired_ttl=settings.RESOLVE_CACHE_EXPIRED_TTL,
+)
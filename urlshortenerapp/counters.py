@@ -0,0 +1,135 @@
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+
+from .routers import shard_for
+
+logger = logging.getLogger(__name__)
+
+# Keeps the IN (...) list of a single UPDATE under SQLite's parameter limit
+UPDATE_CHUNK_SIZE = 500
+
+
+class VisitCounter:
+    """
+    Write-behind accumulator for ShortenedURL.visits.
+
+    Visits are counted in memory per short code and written back by a
+    background thread at most `flush_interval` seconds later (the durability
+    window), or as soon as `flush_threshold` links have pending visits.
+    A `flush_interval` of 0 writes through on every increment.
+    """
+
+    def __init__(self, flush_interval, flush_threshold):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.flushes = 0
+        self.flushed_visits = 0
+
+    def increment(self, code, count=1):
+        with self._lock:
+            self._pending[code] += count
+            pending_links = len(self._pending)
+        if not self.flush_interval:
+            self.flush()
+            return
+        self._ensure_started()
+        if pending_links >= self.flush_threshold:
+            self._wakeup.set()
+
+    def pending(self, code):
+        """Visits counted for `code` that are not in the database yet."""
+        return self._pending.get(code, 0)
+
+    def flush(self):
+        """Write all pending visits back, one UPDATE per shard and delta."""
+        from .models import ShortenedURL
+
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        if not pending:
+            return 0
+
+        # Links on the same shard with the same delta share an UPDATE
+        by_shard = defaultdict(lambda: defaultdict(list))
+        for code, delta in pending.items():
+            by_shard[shard_for(code)][delta].append(code)
+        written = set()
+        try:
+            for db, by_delta in by_shard.items():
+                with transaction.atomic(using=db):
+                    for delta, codes in by_delta.items():
+                        for i in range(0, len(codes), UPDATE_CHUNK_SIZE):
+                            ShortenedURL.objects.using(db).filter(
+                                code__in=codes[i : i + UPDATE_CHUNK_SIZE]
+                            ).update(visits=F("visits") + delta)
+                written.add(db)
+        except Exception:
+            # Put the unwritten deltas back so they are retried on the next flush
+            with self._lock:
+                for code, delta in pending.items():
+                    if shard_for(code) not in written:
+                        self._pending[code] += delta
+            raise
+
+        visits = sum(pending.values())
+        self.flushes += 1
+        self.flushed_visits += visits
+        return visits
+
+    def shutdown(self):
+        """Stop the background thread and flush whatever is still pending."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            "pending_links": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_visits": self.flushed_visits,
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="visit-counter-flush", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped:
+                # shutdown() does the final flush in the calling thread
+                break
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush visit counts")
+            finally:
+                close_old_connections()
+
+
+visit_counter = VisitCounter(
+    flush_interval=settings.VISIT_FLUSH_INTERVAL,
+    flush_threshold=settings.VISIT_FLUSH_THRESHOLD,
+)
@@ -0,0 +1,100 @@
+"""
+Visits answered from a CDN cache, counted from the CDN's logs.
+
+With REDIRECT_MAX_AGE set, edges answer repeat visits with the redirect
+they cached and the app never sees them. Their logs, exported as CSV or
+NDJSON with the columns below, are replayed into visit counts, access logs
+and rollups like visits served here:
+
+    path          request path, e.g. /abc123/ (or a "code" column)
+    accessed_at   ISO 8601 datetime or Unix timestamp of the request
+    ip_address, user_agent, referrer
+    cache_status  e.g. HIT or MISS
+
+Only requests the edge answered itself are counted, the others reached the
+app and were counted then.
+"""
+
+from django.core.exceptions import ValidationError
+from django.http import Http404
+
+from .accesslogs import access_log_buffer
+from .cache import resolve_cache
+from .counters import visit_counter
+from .imports import BatchImporter, parse_timestamp, text_field
+from .models import SHORT_CODE_RE, ShortenedURL
+from .visits import record_visit
+
+# Cache statuses of requests answered by the edge, upper case
+HIT_STATUSES = ["HIT"]
+
+
+class EdgeVisit:
+    __slots__ = ("code", "hit", "ip_address", "user_agent", "referrer", "accessed_at")
+
+    def __init__(self, code, hit, ip_address, user_agent, referrer, accessed_at):
+        self.code = code
+        self.hit = hit
+        self.ip_address = ip_address
+        self.user_agent = user_agent
+        self.referrer = referrer
+        self.accessed_at = accessed_at
+
+
+class EdgeLogImporter(BatchImporter):
+    """
+    Records the visits of edge log records whose cache status is one of
+    `hit_statuses`, `batch_size` records at a time. Each batch is written
+    before the next is read, so a checkpoint taken after a batch is exact.
+    Visits to links that no longer exist are counted as "unknown".
+    """
+
+    counters = ("visits", "misses", "unknown")
+
+    def __init__(self, batch_size=500, hit_statuses=HIT_STATUSES):
+        # Queued access logs beyond the buffer's size would be dropped
+        super().__init__(min(batch_size, access_log_buffer.max_size))
+        self.hit_statuses = {status.upper() for status in hit_statuses}
+
+    def normalize(self, record):
+        if not isinstance(record, dict):
+            raise ValidationError("Not a JSON object.")
+        code = text_field(record, "code") or ShortenedURL.code_from_short_url(
+            text_field(record, "path").split("?", 1)[0]
+        )
+        if not SHORT_CODE_RE.fullmatch(code):
+            raise ValidationError(f"Not a short code: {code!r}")
+        accessed_at = parse_timestamp(record.get("accessed_at"), "accessed_at")
+        if accessed_at is None:
+            raise ValidationError("accessed_at is missing.")
+        return EdgeVisit(
+            code,
+            text_field(record, "cache_status").upper() in self.hit_statuses,
+            text_field(record, "ip_address"),
+            text_field(record, "user_agent"),
+            text_field(record, "referrer"),
+            accessed_at,
+        )
+
+    def insert(self, visits):
+        counts = {"visits": 0, "misses": 0, "unknown": 0}
+        for visit in visits:
+            if not visit.hit:
+                counts["misses"] += 1
+                continue
+            try:
+                link = resolve_cache.resolve(visit.code)
+            except Http404:
+                counts["unknown"] += 1
+                continue
+            record_visit(
+                link,
+                visit.ip_address,
+                visit.user_agent,
+                visit.referrer,
+                accessed_at=visit.accessed_at,
+            )
+            counts["visits"] += 1
+        visit_counter.flush()
+        access_log_buffer.flush()
+        return counts
@@ -0,0 +1,157 @@
+"""
+Raw access log exports, for billing and offline analysis.
+
+Rows are read one shard at a time: first the shard's compacted logs, one
+segment at a time, then its AccessLog table in chunks ordered by time.
+Memory use does not grow with the size of the export, but rows are only
+in time order within each of those parts.
+"""
+
+import csv
+import json
+import zlib
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import segments
+from .models import AccessLog, AccessLogSegment
+from .routers import shard_for
+
+EXPORT_FIELDS = ["id", "code", "accessed_at", "ip_address", "user_agent", "referrer"]
+
+CONTENT_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+EXPORT_CHUNK_SIZE = 2000
+
+# Segments hold up to ACCESS_LOG_SEGMENT_ROWS logs each, fetch few at a time
+SEGMENT_CHUNK_SIZE = 10
+
+# Encoded lines are joined into chunks of about this size before being
+# compressed or written
+OUTPUT_CHUNK_BYTES = 64 * 1024
+
+
+def parse_bound(value, name):
+    """Parse an ISO 8601 date or datetime, assuming UTC if naive."""
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value) or parse_datetime(f"{value}T00:00:00")
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError(f"{name} must be an ISO 8601 date or datetime.")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def export_rows(start=None, end=None, code=None):
+    """
+    Yield the access logs from `start` to `end` (exclusive), of the link
+    with short code `code` or of every link, as dicts of EXPORT_FIELDS.
+    """
+    shards = [shard_for(code)] if code else settings.SHARD_DATABASES
+    for shard in shards:
+        archived = AccessLogSegment.objects.on_shard(shard)
+        logs = AccessLog.objects.on_shard(shard)
+        if code:
+            archived = archived.filter(short_url__code=code)
+            logs = logs.filter(short_url__code=code)
+        if start is not None:
+            archived = archived.filter(last_accessed_at__gte=start)
+            logs = logs.filter(accessed_at__gte=start)
+        if end is not None:
+            archived = archived.filter(first_accessed_at__lt=end)
+            logs = logs.filter(accessed_at__lt=end)
+
+        archived = archived.order_by("month", "first_accessed_at", "pk")
+        for link_code, data in archived.values_list("short_url__code", "data").iterator(
+            chunk_size=SEGMENT_CHUNK_SIZE
+        ):
+            for row in segments.decode(data):
+                accessed_at = row["accessed_at"]
+                if (start is None or accessed_at >= start) and (
+                    end is None or accessed_at < end
+                ):
+                    row["code"] = link_code
+                    yield row
+
+        rows = logs.order_by("accessed_at", "id").values(
+            "id",
+            "accessed_at",
+            "ip_address",
+            "user_agent",
+            "referrer",
+            code=F("short_url__code"),
+        )
+        yield from rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+class _Line:
+    """File-like object csv.writer writes a line to, returned as is."""
+
+    def write(self, line):
+        return line
+
+
+def encode_rows(rows, format):
+    """Yield export rows as CSV lines after a header, or as NDJSON lines."""
+    if format == "csv":
+        writer = csv.writer(_Line())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(
+                [
+                    (
+                        row["accessed_at"].isoformat()
+                        if field == "accessed_at"
+                        else row[field]
+                    )
+                    for field in EXPORT_FIELDS
+                ]
+            )
+        return
+    for row in rows:
+        yield json.dumps(
+            {field: row[field] for field in EXPORT_FIELDS}, cls=DjangoJSONEncoder
+        ) + "\n"
+
+
+def chunked(lines):
+    """Join lines into UTF-8 chunks of about OUTPUT_CHUNK_BYTES."""
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= OUTPUT_CHUNK_BYTES:
+            yield "".join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+def gzipped(chunks):
+    """Compress a stream of byte chunks into a gzip stream on the fly."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(start=None, end=None, code=None, format="csv", compress=False):
+    """Byte chunks of an export, gzipped if `compress`."""
+    if format not in CONTENT_TYPES:
+        raise ValidationError("format must be 'csv' or 'ndjson'.")
+    chunks = chunked(encode_rows(export_rows(start, end, code), format))
+    return gzipped(chunks) if compress else chunks
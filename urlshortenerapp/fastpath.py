@@ -0,0 +1,205 @@
+import json
+import re
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.urls import get_resolver
+
+from .cache import resolve_cache
+from .metrics import metrics
+from .ratelimit import TOO_MANY_REQUESTS, rate_limiter, retry_after
+from .visits import (
+    VisitDenied,
+    arecord_visit,
+    aresolve_visit,
+    record_visit,
+    redirect_response,
+    resolve_visit,
+)
+
+VISIT_URL_NAME = "visit_shortened_url"
+
+# Route label of the visits answered here, the view name Django would report
+VISIT_ROUTE = VISIT_URL_NAME
+
+# Same shape as the "<str:short_url>/" route of the visit view
+VISIT_PATH_RE = re.compile(r"/([^/]+)/")
+
+JSON_HEADERS = [("Content-Type", "application/json")]
+
+
+def status_line(status):
+    return f"{status} {HTTPStatus(status).phrase}"
+
+
+def reserved_segments(urlpatterns):
+    """
+    First path segments of the routes listed before the visit view, which
+    would otherwise look like short codes (e.g. "swagger" and "admin").
+    """
+    segments = set()
+    for pattern in urlpatterns:
+        if getattr(pattern, "name", None) == VISIT_URL_NAME:
+            break
+        segment = str(pattern.pattern).split("/", 1)[0]
+        if segment and "<" not in segment:
+            segments.add(segment)
+    return segments
+
+
+class RedirectApp:
+    """
+    WSGI application answering GET /<code>/ directly, without Django's
+    request handler, middleware stack, DRF or swagger. Every other request,
+    and visits made from the swagger UI, are passed to `application`.
+    """
+
+    def __init__(self, application, urlpatterns=None):
+        self.application = application
+        if urlpatterns is None:
+            urlpatterns = get_resolver().url_patterns
+        self.reserved = reserved_segments(urlpatterns)
+
+    def visit_code(self, path):
+        """Return the short code if `path` routes to the visit view, else None."""
+        match = VISIT_PATH_RE.fullmatch(path)
+        if match is None or match[1] in self.reserved:
+            return None
+        return match[1]
+
+    def match(self, method, path, referrer):
+        """Return the short code if this fast path answers the request."""
+        if method != "GET" or "swagger" in referrer:
+            return None
+        return self.visit_code(path)
+
+    def __call__(self, environ, start_response):
+        code = self.match(
+            environ["REQUEST_METHOD"],
+            environ.get("PATH_INFO", ""),
+            environ.get("HTTP_REFERER", ""),
+        )
+        if code is None:
+            return self.application(environ, start_response)
+
+        start = time.perf_counter()
+        wait = rate_limiter.check(
+            VISIT_URL_NAME, rate_limiter.client_from_environ(environ)
+        )
+        if wait:
+            return self.too_many_requests(start_response, wait, start)
+        misses = resolve_cache.misses
+        try:
+            password = parse_qs(environ.get("QUERY_STRING", "")).get("password")
+            link = resolve_visit(code, password[-1] if password else None)
+            record_visit(
+                link,
+                environ.get("REMOTE_ADDR", ""),
+                environ.get("HTTP_USER_AGENT", ""),
+                environ.get("HTTP_REFERER", ""),
+            )
+        except VisitDenied as e:
+            return self.json(start_response, e.status, {"error": e.error}, start)
+        except Exception as e:
+            return self.json(start_response, 500, {"error": str(e)}, start)
+        finally:
+            # Only a cache miss touches the database, release the connection
+            # like Django's handler does at the end of a request
+            if resolve_cache.misses != misses:
+                close_old_connections()
+
+        status, headers = redirect_response(link, environ.get("HTTP_IF_NONE_MATCH", ""))
+        if status != 304:
+            headers.append(("Content-Length", "0"))
+        return self.respond(start_response, status, headers, b"", start)
+
+    def respond(self, start_response, status, headers, body, start):
+        start_response(status_line(status), headers)
+        metrics.observe_request(VISIT_ROUTE, "GET", status, time.perf_counter() - start)
+        return [body]
+
+    def json(self, start_response, status, data, start, headers=()):
+        body = json.dumps(data).encode()
+        headers = JSON_HEADERS + [("Content-Length", str(len(body))), *headers]
+        return self.respond(start_response, status, headers, body, start)
+
+    def too_many_requests(self, start_response, wait, start):
+        headers = [("Retry-After", retry_after(wait))]
+        return self.json(
+            start_response, 429, {"error": TOO_MANY_REQUESTS}, start, headers
+        )
+
+
+class AsyncRedirectApp(RedirectApp):
+    """
+    ASGI counterpart of RedirectApp. Cache hits are answered on the event
+    loop without a thread pool hop, cache misses use the async ORM.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.application(scope, receive, send)
+        headers = dict(scope["headers"])
+        referrer = headers.get(b"referer", b"").decode("latin-1")
+        code = self.match(scope["method"], scope["path"], referrer)
+        if code is None:
+            return await self.application(scope, receive, send)
+
+        start = time.perf_counter()
+        wait = rate_limiter.check(
+            VISIT_URL_NAME, rate_limiter.client_from_scope(scope, headers)
+        )
+        if wait:
+            return await self.asend_json(
+                send,
+                429,
+                {"error": TOO_MANY_REQUESTS},
+                start,
+                [(b"retry-after", retry_after(wait).encode())],
+            )
+        misses = resolve_cache.misses
+        try:
+            query = parse_qs(scope["query_string"].decode("latin-1"))
+            password = query.get("password")
+            link = await aresolve_visit(code, password[-1] if password else None)
+            client = scope.get("client")
+            await arecord_visit(
+                link,
+                client[0] if client else "",
+                headers.get(b"user-agent", b"").decode("latin-1"),
+                referrer,
+            )
+        except VisitDenied as e:
+            return await self.asend_json(send, e.status, {"error": e.error}, start)
+        except Exception as e:
+            return await self.asend_json(send, 500, {"error": str(e)}, start)
+        finally:
+            if resolve_cache.misses != misses:
+                await sync_to_async(close_old_connections)()
+
+        status, headers = redirect_response(
+            link, headers.get(b"if-none-match", b"").decode("latin-1")
+        )
+        headers = [(name.lower().encode(), value.encode()) for name, value in headers]
+        if status != 304:
+            headers.append((b"content-length", b"0"))
+        await self.asend(send, status, headers, b"", start)
+
+    async def asend(self, send, status, headers, body, start):
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
+        metrics.observe_request(VISIT_ROUTE, "GET", status, time.perf_counter() - start)
+
+    async def asend_json(self, send, status, data, start, headers=()):
+        body = json.dumps(data).encode()
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *headers,
+        ]
+        await self.asend(send, status, headers, body, start)
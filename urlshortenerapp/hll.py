@@ -0,0 +1,202 @@
+"""
+HyperLogLog sketches, estimating the number of distinct values added.
+
+A sketch of precision p has 2**p one-byte registers. A value is hashed to
+64 bits: the first p bits pick a register, which keeps the highest rank
+(position of the first 1 bit) seen in the remaining bits. Merging sketches
+keeps the highest rank of each register, so sketches of time buckets or
+workers add up to the sketch of all their values. The standard error is
+1.04 / sqrt(2**p).
+
+Sketches are stored as:
+
+    format (1 byte) | precision (1 byte) | registers
+
+Dense sketches store every register. Sparse ones, used while few registers
+are set, store 3-byte little-endian (index << 6 | rank) entries for the
+set registers in index order. An empty sketch is stored as b"".
+"""
+
+import hashlib
+import math
+import re
+import struct
+
+DENSE = 1
+SPARSE = 2
+
+HEADER = struct.Struct("<BB")
+
+MIN_PRECISION = 4
+# Register indexes and ranks of sparse entries fit in 3 bytes
+MAX_PRECISION = 16
+
+RANK_BITS = 6
+
+NONZERO = re.compile(rb"[^\x00]")
+
+# 2 ** -rank for every possible rank, summed by the estimator
+INVERSE_POWERS = [2.0**-rank for rank in range(65)]
+
+
+def hash_value(value):
+    """64-bit hash of a string added to sketches."""
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def byte_max(a, b):
+    """
+    Bytewise maximum of two byte strings of the same length, of values
+    below 128, computed on each byte at once as big integers.
+    """
+    size = len(a)
+    high = int.from_bytes(b"\x80" * size, "little")
+    x = int.from_bytes(a, "little")
+    y = int.from_bytes(b, "little")
+    # The high bit of each byte of x | high stays set where x >= y
+    mask = ((((x | high) - y) & high) >> 7) * 0xFF
+    return bytearray(((x & mask) | (y & ~mask)).to_bytes(size, "little"))
+
+
+def alpha(registers):
+    if registers == 16:
+        return 0.673
+    if registers == 32:
+        return 0.697
+    if registers == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / registers)
+
+
+class HyperLogLog:
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision=12):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(
+                f"precision must be between {MIN_PRECISION} and {MAX_PRECISION}"
+            )
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @classmethod
+    def from_bytes(cls, data, precision=12):
+        """
+        Load a stored sketch. An empty one gets `precision`, others keep
+        theirs if it is lower and are folded down to `precision` otherwise.
+        """
+        sketch = cls(precision)
+        if data:
+            sketch.update(data)
+        return sketch
+
+    def add_hash(self, hashed):
+        width = 64 - self.precision
+        index = hashed >> width
+        rank = width - (hashed & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, value):
+        self.add_hash(hash_value(value))
+
+    def fold(self, precision):
+        """Reduce to a lower precision, as if the values were added to it."""
+        if precision >= self.precision:
+            return
+        shift = self.precision - precision
+        registers = bytearray(1 << precision)
+        for index, rank in enumerate(self.registers):
+            if rank:
+                low = index & ((1 << shift) - 1)
+                # The dropped index bits now lead the bits ranks are read from
+                rank = shift - low.bit_length() + 1 if low else shift + rank
+                target = index >> shift
+                if rank > registers[target]:
+                    registers[target] = rank
+        self.precision = precision
+        self.registers = registers
+
+    def merge(self, other):
+        """Add the values of another sketch to this one."""
+        if other.precision < self.precision:
+            self.fold(other.precision)
+        elif other.precision > self.precision:
+            folded = HyperLogLog(other.precision)
+            folded.registers = bytearray(other.registers)
+            folded.fold(self.precision)
+            other = folded
+        self.registers = byte_max(self.registers, other.registers)
+
+    def update(self, data):
+        """Merge a stored sketch into this one."""
+        data = bytes(data)
+        kind, precision = HEADER.unpack_from(data)
+        if kind not in (DENSE, SPARSE):
+            raise ValueError(f"Unknown HyperLogLog format {kind}")
+        if precision != self.precision:
+            other = HyperLogLog(precision)
+            other._load(kind, data)
+            self.merge(other)
+        else:
+            self._load(kind, data)
+
+    def _load(self, kind, data):
+        registers = self.registers
+        if kind == DENSE:
+            payload = data[HEADER.size :]
+            if len(payload) != len(registers):
+                raise ValueError("Truncated HyperLogLog sketch")
+            self.registers = byte_max(registers, payload)
+            return
+        mask = (1 << RANK_BITS) - 1
+        for offset in range(HEADER.size, len(data), 3):
+            entry = int.from_bytes(data[offset : offset + 3], "little")
+            index, rank = entry >> RANK_BITS, entry & mask
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def to_bytes(self):
+        registers = self.registers
+        count = len(registers) - registers.count(0)
+        if not count:
+            return b""
+        if count * 3 >= len(registers):
+            return HEADER.pack(DENSE, self.precision) + bytes(registers)
+        entries = [
+            ((match.start() << RANK_BITS) | registers[match.start()]).to_bytes(
+                3, "little"
+            )
+            for match in NONZERO.finditer(registers)
+        ]
+        return HEADER.pack(SPARSE, self.precision) + b"".join(entries)
+
+    def count(self):
+        """Estimated number of distinct values added."""
+        registers = self.registers
+        m = len(registers)
+        # Counting each rank scans the registers in C, summing them would not
+        harmonic = 0.0
+        remaining = m
+        for rank, power in enumerate(INVERSE_POWERS):
+            count = registers.count(rank)
+            harmonic += count * power
+            remaining -= count
+            if not remaining:
+                break
+        estimate = alpha(m) * m * m / harmonic
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+def merged(sketches, precision=12):
+    """Merge stored sketches, e.g. of a range of rollup buckets."""
+    sketch = HyperLogLog(precision)
+    for data in sketches:
+        if data:
+            sketch.update(data)
+    return sketch
@@ -0,0 +1,263 @@
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from urllib.parse import urlsplit, urlunsplit
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import connections, models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import SHORT_CODE_RE, ShortenedURL
+from .routers import shard_for
+
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+URL_MAX_LENGTH = ShortenedURL._meta.get_field("original_url").max_length
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    return FORMATS.get(os.path.splitext(name)[1])
+
+
+def read_records(path, format):
+    """
+    Yield the records of a CSV file with a header row, or of an NDJSON
+    file, as dicts. Gzipped files are read as they are decompressed. A
+    malformed NDJSON line is yielded as None.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as stream:
+        if format == "csv":
+            yield from csv.DictReader(stream)
+            return
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def text_field(record, name):
+    """The string in a record's `name` field, "" if it is missing."""
+    value = record.get(name)
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ValidationError(f"{name} is not a string: {value!r}")
+    return value
+
+
+def parse_timestamp(value, name):
+    """Parse an ISO 8601 datetime or a Unix timestamp, assuming UTC if naive."""
+    if value in (None, ""):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value, dt_timezone.utc)
+        parsed = parse_datetime(value)
+        if parsed is None:
+            return datetime.fromtimestamp(float(value), dt_timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        # Well-formed but impossible dates and out of range timestamps too
+        raise ValidationError(f"{name} is not a valid timestamp: {value}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+class BatchImporter:
+    """
+    Base of the importers. run() reads records, converts them with
+    normalize(), and hands the valid ones to insert() `batch_size` at a
+    time. normalize() raises ValidationError for invalid records, insert()
+    returns counts that are added to the totals named in `counters`.
+    """
+
+    counters = ()
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+    def normalize(self, record):
+        raise NotImplementedError
+
+    def insert(self, batch):
+        raise NotImplementedError
+
+    def run(self, records, resume=None, on_reject=None):
+        """
+        Import `records`. Yields the running totals after each batch, for
+        progress reports and checkpoints. Given the totals of an interrupted
+        run as `resume`, skips the records it got through and carries on
+        counting from there. `on_reject(number, record, error)` is called
+        for every invalid record, numbered from 0.
+        """
+        start = time.monotonic()
+        totals = {"records": 0, "rejected": 0}
+        totals.update((name, 0) for name in self.counters)
+        totals.update(resume or {})
+        skip = totals["records"]
+        batch = []
+        for number, record in enumerate(records):
+            if number < skip:
+                continue
+            try:
+                batch.append(self.normalize(record))
+            except ValidationError as e:
+                totals["rejected"] += 1
+                if on_reject is not None:
+                    on_reject(number, record, "; ".join(e.messages))
+            totals["records"] = number + 1
+            if (totals["records"] - skip) % self.batch_size == 0:
+                yield self._flush(batch, totals, start, skip)
+                batch = []
+        if (totals["records"] - skip) % self.batch_size:
+            yield self._flush(batch, totals, start, skip)
+
+    def _flush(self, batch, totals, start, skip):
+        for name, count in self.insert(batch).items():
+            totals[name] += count
+        elapsed = time.monotonic() - start
+        rate = (totals["records"] - skip) / elapsed if elapsed else 0
+        return {**totals, "rate": round(rate)}
+
+
+class LinkImporter(BatchImporter):
+    """
+    Loads (original_url, code, expiration_at) records into ShortenedURL,
+    `batch_size` records at a time. Each batch is validated, then inserted
+    with bulk_create(ignore_conflicts=True) in one transaction per shard;
+    codes that already exist are skipped. Links without an expiration_at
+    expire `default_hours` hours after the import, or never if None.
+
+    Imported links get no url_digest: the old shortener may have several
+    codes for one URL, and they must all keep working. Codes as long as
+    SHORT_CODE_LENGTH are counted as "allocatable", the allocator may hand
+    them out again and fail to create that link.
+    """
+
+    counters = ("inserted", "existing", "allocatable")
+
+    def __init__(self, batch_size=5000, default_hours=None, now=None):
+        super().__init__(batch_size)
+        self.default_hours = default_hours
+        self.now = now or timezone.now()
+        self.validate_url = URLValidator(schemes=["http", "https"])
+
+    def normalize(self, record):
+        """Return the unsaved link of a record, or raise ValidationError."""
+        if not isinstance(record, dict):
+            raise ValidationError("Not a JSON object.")
+        original_url = text_field(record, "original_url").strip()
+        code = text_field(record, "code").strip()
+        if not SHORT_CODE_RE.fullmatch(code):
+            raise ValidationError(f"The short code is not well-formed: {code!r}")
+        if len(original_url) > URL_MAX_LENGTH:
+            raise ValidationError(f"The URL is over {URL_MAX_LENGTH} characters.")
+        self.validate_url(original_url)
+        # Scheme and host are case-insensitive
+        parts = urlsplit(original_url)
+        original_url = urlunsplit(
+            parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower())
+        )
+
+        expiration_at = parse_timestamp(record.get("expiration_at"), "expiration_at")
+        if expiration_at is None and self.default_hours is not None:
+            expiration_at = self.now + timedelta(hours=self.default_hours)
+        return ShortenedURL(
+            original_url=original_url,
+            code=code,
+            expiration_at=expiration_at,
+            # Only meaningful for links shortened here
+            expiration_hours=0,
+        )
+
+    def insert(self, links):
+        """Insert a batch of links, skipping codes that already exist."""
+        by_shard = {}
+        for link in links:
+            by_shard.setdefault(shard_for(link.code), {})[link.code] = link
+        inserted = 0
+        for shard, by_code in by_shard.items():
+            table = ShortenedURL.objects.using(shard)
+            with transaction.atomic(using=shard):
+                taken = set(
+                    table.filter(code__in=list(by_code)).values_list("code", flat=True)
+                )
+                new = [link for code, link in by_code.items() if code not in taken]
+                # Concurrent creators can still take a code, those rows are dropped
+                table.bulk_create(new, ignore_conflicts=True)
+            inserted += len(new)
+        return {
+            "inserted": inserted,
+            "existing": len(links) - inserted,
+            "allocatable": sum(
+                len(link.code) == settings.SHORT_CODE_LENGTH for link in links
+            ),
+        }
+
+
+def secondary_indexes(shard):
+    """
+    Indexes of the ShortenedURL table on `shard` that no constraint
+    depends on, which can be dropped during an import and built after it.
+    """
+    table = ShortenedURL._meta.db_table
+    connection = connections[shard]
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    columns = {field.column: field.name for field in ShortenedURL._meta.fields}
+    return [
+        models.Index(fields=[columns[column] for column in info["columns"]], name=name)
+        for name, info in constraints.items()
+        if info["index"] and not info["unique"] and not info["primary_key"]
+    ]
+
+
+def drop_indexes(shard, indexes):
+    with connections[shard].schema_editor() as editor:
+        for index in indexes:
+            editor.remove_index(ShortenedURL, index)
+
+
+def create_indexes(shard, indexes):
+    with connections[shard].schema_editor() as editor:
+        for index in indexes:
+            editor.add_index(ShortenedURL, index)
+
+
+def write_checkpoint(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as checkpoint:
+        json.dump(state, checkpoint)
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+    except FileNotFoundError:
+        return None
+
+
+def reject_writer(stream):
+    """on_reject callback writing rejected records to an NDJSON stream."""
+
+    def on_reject(number, record, error):
+        stream.write(
+            json.dumps({"record": number, "error": error, "data": record}) + "\n"
+        )
+
+    return on_reject
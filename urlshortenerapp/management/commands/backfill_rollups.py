@@ -0,0 +1,48 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from urlshortenerapp import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the hourly and daily click rollups from existing access logs, "
+        "in chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Access logs read and rolled up per transaction.",
+        )
+        parser.add_argument(
+            "--since",
+            help="Only rebuild buckets from this date (YYYY-MM-DD) on.",
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options["since"]:
+            since_date = parse_date(options["since"])
+            if since_date is None:
+                raise CommandError("--since must be a date formatted YYYY-MM-DD")
+            since = timezone.make_aware(
+                datetime(since_date.year, since_date.month, since_date.day)
+            )
+
+        start = time.monotonic()
+        processed = 0
+        for rows in rollups.backfill(options["chunk_size"], since):
+            processed += rows
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Rolled up {processed} access logs")
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            self.style.SUCCESS(f"Rolled up {processed} access logs in {elapsed:.1f}s")
+        )
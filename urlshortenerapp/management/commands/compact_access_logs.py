@@ -0,0 +1,40 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from urlshortenerapp.segments import access_log_compactor
+
+
+class Command(BaseCommand):
+    help = (
+        "Move access logs of months that ended more than "
+        "ACCESS_LOG_RETENTION_DAYS days ago into compressed segments."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=access_log_compactor.retention_days,
+            help="Days of access logs kept in the AccessLog table.",
+        )
+        parser.add_argument(
+            "--segment-rows",
+            type=int,
+            default=access_log_compactor.segment_rows,
+            help="Access logs per segment, and per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        access_log_compactor.retention_days = options["retention_days"]
+        access_log_compactor.segment_rows = options["segment_rows"]
+        run = access_log_compactor.compact()
+        if options["verbosity"] > 1:
+            self.stdout.write(json.dumps(run))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Compacted {run['logs']} access logs of {run['months']} months "
+                f"into {run['segments']} segments ({run['bytes']} bytes) "
+                f"in {run['seconds']}s"
+            )
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from urlshortenerapp.accesslogs import access_log_buffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the batches of access logs that workers spooled to "
+        "ACCESS_LOG_SPOOL_DIR because they failed to write."
+    )
+
+    def handle(self, *args, **options):
+        # Each worker flushes its own queue, this process has none
+        drained = access_log_buffer.drain_spool()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Wrote {drained} access logs from {access_log_buffer.spool_dir}"
+            )
+        )
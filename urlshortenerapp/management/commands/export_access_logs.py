@@ -0,0 +1,66 @@
+import sys
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from urlshortenerapp.exports import CONTENT_TYPES, export, parse_bound
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the access logs of one link, or of every link, within a date "
+        "range as CSV or NDJSON, streamed from the database shard by shard."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--code", help="Short code of the link to export.")
+        parser.add_argument(
+            "--from", dest="start", help="Start of the range (ISO 8601)."
+        )
+        parser.add_argument(
+            "--to", dest="end", help="End of the range, exclusive (ISO 8601)."
+        )
+        parser.add_argument("--format", choices=sorted(CONTENT_TYPES), default="csv")
+        parser.add_argument(
+            "--output",
+            help="File to write, standard output by default. "
+            "Compressed with gzip if it ends in .gz.",
+        )
+        parser.add_argument(
+            "--gzip", action="store_true", help="Compress the export with gzip."
+        )
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        compress = options["gzip"] or bool(output and output.endswith(".gz"))
+        try:
+            chunks = export(
+                parse_bound(options["start"], "--from"),
+                parse_bound(options["end"], "--to"),
+                options["code"],
+                options["format"],
+                compress,
+            )
+        except ValidationError as e:
+            raise CommandError("; ".join(e.messages))
+
+        start = time.monotonic()
+        written = 0
+        stream = open(output, "wb") if output else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                stream.write(chunk)
+                written += len(chunk)
+        finally:
+            if output:
+                stream.close()
+            else:
+                stream.flush()
+        if output:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Wrote {written} bytes to {output} "
+                    f"in {time.monotonic() - start:.3f}s"
+                )
+            )
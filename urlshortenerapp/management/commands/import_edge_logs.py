@@ -0,0 +1,105 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from urlshortenerapp.edgelogs import HIT_STATUSES, EdgeLogImporter
+from urlshortenerapp.imports import (
+    FORMATS,
+    detect_format,
+    read_checkpoint,
+    read_records,
+    reject_writer,
+    write_checkpoint,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the visits a CDN answered from its cache, from its logs as CSV "
+        "or NDJSON with path, accessed_at, ip_address, user_agent, referrer "
+        "and cache_status columns. Progress is saved to a checkpoint file "
+        "after each batch, and an interrupted import resumes from it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Log file to import.")
+        parser.add_argument(
+            "--format",
+            choices=sorted(set(FORMATS.values())),
+            help="Format of the file, guessed from its extension by default.",
+        )
+        parser.add_argument(
+            "--hit-status",
+            default=",".join(HIT_STATUSES),
+            help="Comma-separated cache statuses of requests the CDN answered "
+            "itself.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Records recorded between checkpoints.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="Checkpoint file, <path>.checkpoint by default.",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint and import from the first record. "
+            "Visits already imported are counted again.",
+        )
+        parser.add_argument(
+            "--rejects",
+            help="Append invalid records to this NDJSON file, with the error.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or detect_format(path)
+        if format is None:
+            raise CommandError(f"Unknown file format of {path}, use --format.")
+        if not os.path.exists(path):
+            raise CommandError(f"No such file: {path}")
+        checkpoint_path = options["checkpoint"] or f"{path}.checkpoint"
+        resume = None if options["restart"] else read_checkpoint(checkpoint_path)
+        if resume:
+            self.stdout.write(f"Resuming after record {resume['records']}")
+
+        importer = EdgeLogImporter(
+            batch_size=options["batch_size"],
+            hit_statuses=options["hit_status"].split(","),
+        )
+        rejects = open(options["rejects"], "a") if options["rejects"] else None
+        run = resume
+        try:
+            batches = importer.run(
+                read_records(path, format),
+                resume=resume,
+                on_reject=reject_writer(rejects) if rejects else None,
+            )
+            for run in batches:
+                write_checkpoint(checkpoint_path, run)
+                if options["verbosity"] > 1:
+                    self.stdout.write(
+                        f"{run['records']} records, {run['visits']} visits, "
+                        f"{run['rate']} records/s"
+                    )
+        finally:
+            if rejects is not None:
+                rejects.close()
+
+        if run is None:
+            raise CommandError(f"{path} has no records.")
+        if options["verbosity"] > 1:
+            self.stdout.write(json.dumps(run))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Recorded {run['visits']} cached visits from {run['records']} "
+                f"records, skipped {run['misses']} requests served here and "
+                f"{run['unknown']} to unknown links, rejected {run['rejected']} "
+                "records"
+            )
+        )
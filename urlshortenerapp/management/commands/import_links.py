@@ -0,0 +1,130 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from urlshortenerapp.imports import (
+    FORMATS,
+    LinkImporter,
+    create_indexes,
+    detect_format,
+    drop_indexes,
+    read_checkpoint,
+    read_records,
+    reject_writer,
+    secondary_indexes,
+    write_checkpoint,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import links from a CSV file with original_url, code and "
+        "expiration_at columns, or from an NDJSON file of such objects, "
+        "optionally gzipped. Progress is saved to a checkpoint file after "
+        "each batch, and an interrupted import resumes from it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import.")
+        parser.add_argument(
+            "--format",
+            choices=sorted(set(FORMATS.values())),
+            help="Format of the file, guessed from its extension by default.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Records validated and inserted per transaction.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="Checkpoint file, <path>.checkpoint by default.",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint and import from the first record.",
+        )
+        parser.add_argument(
+            "--rejects",
+            help="Append invalid records to this NDJSON file, with the error.",
+        )
+        parser.add_argument(
+            "--default-hours",
+            type=int,
+            help="Hours until links without an expiration_at expire. "
+            "By default they never expire.",
+        )
+        parser.add_argument(
+            "--drop-indexes",
+            action="store_true",
+            help="Drop the secondary indexes of the links table during the "
+            "import and build them afterwards. Faster for large imports, but "
+            "expiry and lookups by digest are slow meanwhile.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or detect_format(path)
+        if format is None:
+            raise CommandError(f"Unknown file format of {path}, use --format.")
+        if not os.path.exists(path):
+            raise CommandError(f"No such file: {path}")
+        checkpoint_path = options["checkpoint"] or f"{path}.checkpoint"
+        resume = None if options["restart"] else read_checkpoint(checkpoint_path)
+        if resume:
+            self.stdout.write(f"Resuming after record {resume['records']}")
+
+        importer = LinkImporter(
+            batch_size=options["batch_size"], default_hours=options["default_hours"]
+        )
+        rejects = open(options["rejects"], "a") if options["rejects"] else None
+        dropped = {}
+        try:
+            if options["drop_indexes"]:
+                for shard in settings.SHARD_DATABASES:
+                    dropped[shard] = secondary_indexes(shard)
+                    drop_indexes(shard, dropped[shard])
+            run = resume
+            batches = importer.run(
+                read_records(path, format),
+                resume=resume,
+                on_reject=reject_writer(rejects) if rejects else None,
+            )
+            for run in batches:
+                write_checkpoint(checkpoint_path, run)
+                if options["verbosity"] > 0:
+                    self.stdout.write(
+                        f"{run['records']} records, {run['inserted']} inserted, "
+                        f"{run['rejected']} rejected, {run['rate']} records/s"
+                    )
+                    self.stdout.flush()
+        finally:
+            if rejects is not None:
+                rejects.close()
+            for shard, indexes in dropped.items():
+                self.stdout.write(f"Building indexes on {shard}")
+                create_indexes(shard, indexes)
+
+        if run is None:
+            raise CommandError(f"{path} has no records.")
+        if options["verbosity"] > 1:
+            self.stdout.write(json.dumps(run))
+        if run["allocatable"]:
+            self.stderr.write(
+                self.style.WARNING(
+                    f"{run['allocatable']} imported codes are SHORT_CODE_LENGTH "
+                    "characters long. The allocator may hand them out again, "
+                    "and shortening fails when it does."
+                )
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {run['inserted']} links from {run['records']} records, "
+                f"skipped {run['existing']} existing codes and rejected "
+                f"{run['rejected']} records"
+            )
+        )
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from urlshortenerapp.reaper import expiry_reaper
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete links that expired more than REAPER_GRACE_PERIOD seconds ago, "
+        "with their access logs and rollups, in rate limited batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=expiry_reaper.batch_size,
+            help="Rows deleted per transaction.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=expiry_reaper.batch_pause,
+            help="Seconds to sleep between transactions.",
+        )
+        parser.add_argument(
+            "--max-batches",
+            type=int,
+            help="Stop after reaping this many batches of links.",
+        )
+        parser.add_argument(
+            "--archive",
+            action="store_true",
+            default=expiry_reaper.archive,
+            help="Copy the links to ArchivedURL before deleting them.",
+        )
+
+    def handle(self, *args, **options):
+        expiry_reaper.batch_size = options["batch_size"]
+        expiry_reaper.batch_pause = options["pause"]
+        expiry_reaper.archive = options["archive"]
+        run = expiry_reaper.reap(max_batches=options["max_batches"])
+        if options["verbosity"] > 1:
+            self.stdout.write(json.dumps(run))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Reaped {run['links']} expired links ({run['archived']} archived) "
+                f"and {run['access_logs']} access logs in {run['seconds']}s"
+            )
+        )
@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from urlshortenerapp.rebalance import ShardRebalancer
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy links, with their access logs, rollups and archived copies, to "
+        "the shard their code hashes to under the current DATABASE_SHARDS. "
+        "Once every worker runs with the new shards, run again with --prune "
+        "to delete them from the shards they were copied from."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Rows read and copied at a time.",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help=(
+                "Delete links that were copied to their shard, after copying "
+                "the visits recorded on them since."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the rows to copy or delete without changing anything.",
+        )
+
+    def handle(self, *args, **options):
+        rebalancer = ShardRebalancer(
+            batch_size=options["batch_size"], dry_run=options["dry_run"]
+        )
+        if options["prune"]:
+            run = rebalancer.prune()
+            message = (
+                f"Pruned {run['links']} links and {run['archived']} archived "
+                f"links, after copying {run['caught_up']} newer access logs"
+            )
+        else:
+            run = rebalancer.copy()
+            message = (
+                f"Copied {run['links']} links with {run['rows']} rows and "
+                f"{run['archived']} archived links"
+            )
+        if options["dry_run"]:
+            message += " (dry run, nothing changed)"
+        if options["verbosity"] > 1:
+            self.stdout.write(json.dumps(run))
+        self.stdout.write(self.style.SUCCESS(f"{message} in {run['seconds']}s"))
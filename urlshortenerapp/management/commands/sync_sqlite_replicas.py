@@ -0,0 +1,53 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the SQLite primary database to the REPLICA_DATABASES files, "
+        "once or every --interval seconds, to stand in for replication."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Seconds between copies. Copy once if 0.",
+        )
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES[DEFAULT_DB_ALIAS]
+        if primary["ENGINE"] != "django.db.backends.sqlite3":
+            raise CommandError("Only SQLite databases can be synced this way.")
+        if not settings.REPLICA_DATABASES:
+            raise CommandError("Set DATABASE_REPLICAS to the replica file names.")
+        while True:
+            started = time.monotonic()
+            for alias in settings.REPLICA_DATABASES:
+                self.copy(primary["NAME"], settings.DATABASES[alias]["NAME"])
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Copied {primary['NAME']} to "
+                    f"{len(settings.REPLICA_DATABASES)} replicas in "
+                    f"{time.monotonic() - started:.3f}s"
+                )
+            )
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
+
+    @staticmethod
+    def copy(source_name, target_name):
+        source = sqlite3.connect(source_name)
+        target = sqlite3.connect(target_name)
+        try:
+            # Online backup: consistent even while the primary is written to
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
@@ -0,0 +1,321 @@
+import atexit
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "urlshortener_"
+
+# (component, stats() key, metric name, type) exported on every scrape
+COMPONENT_METRICS = [
+    ("resolve_cache", "hits", "resolve_cache_hits_total", "counter"),
+    ("resolve_cache", "misses", "resolve_cache_misses_total", "counter"),
+    ("resolve_cache", "evictions", "resolve_cache_evictions_total", "counter"),
+    ("resolve_cache", "shared_hits", "resolve_cache_shared_hits_total", "counter"),
+    ("resolve_cache", "size", "resolve_cache_entries", "gauge"),
+    ("visit_counter", "flushed_visits", "visits_flushed_total", "counter"),
+    ("visit_counter", "pending_links", "visits_pending_links", "gauge"),
+    ("access_log_buffer", "submitted", "access_logs_submitted_total", "counter"),
+    ("access_log_buffer", "dropped", "access_logs_dropped_total", "counter"),
+    ("access_log_buffer", "written", "access_logs_written_total", "counter"),
+    ("access_log_buffer", "spilled", "access_logs_spilled_total", "counter"),
+    ("access_log_buffer", "rejected", "access_logs_rejected_total", "counter"),
+    ("access_log_buffer", "queued", "access_logs_queued", "gauge"),
+    ("code_filter", "rejected", "code_filter_rejected_total", "counter"),
+    ("expiry_reaper", "reaped_links", "reaped_links_total", "counter"),
+    ("rate_limiter", "limited", "rate_limited_requests_total", "counter"),
+    ("rate_limiter", "evicted", "rate_limit_evicted_clients_total", "counter"),
+    ("rate_limiter", "clients", "rate_limit_clients", "gauge"),
+]
+
+HELP = {
+    "http_requests_total": "Responses by route, method and status.",
+    "http_request_duration_seconds": "Request latency by route.",
+    "http_requests_in_flight": "Requests being handled.",
+    "db_queries_total": "SQL queries run by requests, by route.",
+    "db_query_duration_seconds_total": "Time spent in SQL queries, by route.",
+}
+
+
+class Shard:
+    """Metrics recorded by one thread, so recording never takes a lock."""
+
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        # key -> [bucket counts..., +Inf count, sum]
+        self.histograms = {}
+
+
+class Metrics:
+    """
+    Per-process request metrics. Each thread records into its own shard;
+    snapshot() sums the shards. With a `directory`, a background thread
+    writes the snapshot to `directory`/metrics-<pid>.json every
+    `write_interval` seconds, and render() adds up the files of every
+    worker sharing the directory.
+    """
+
+    def __init__(self, buckets, directory=None, write_interval=5):
+        self.buckets = list(buckets)
+        self.directory = directory
+        self.write_interval = write_interval
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        self._shard().counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        histogram = histograms.get((name, labels))
+        if histogram is None:
+            histogram = histograms[name, labels] = [0] * (len(self.buckets) + 2)
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def observe_request(self, route, method, status, seconds, queries=0, query_time=0):
+        shard = self._shard()
+        shard.counters["http_requests_total", (route, method, str(status))] += 1
+        if queries:
+            shard.counters["db_queries_total", (route,)] += queries
+            shard.counters["db_query_duration_seconds_total", (route,)] += query_time
+        self.observe("http_request_duration_seconds", (route,), seconds)
+
+    def snapshot(self):
+        """This process's metrics, as JSON-serializable lists."""
+        counters = defaultdict(float)
+        histograms = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            # dict.copy() is atomic, the owning thread may be recording
+            for key, value in shard.counters.copy().items():
+                counters[key] += value
+            for key, values in shard.histograms.copy().items():
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(list(values)):
+                    total[i] += value
+        in_flight = counters.pop(("http_requests_in_flight", ()), 0)
+        return {
+            "pid": os.getpid(),
+            "counters": [
+                [name, list(labels), v] for (name, labels), v in counters.items()
+            ],
+            "histograms": [
+                [name, list(labels), values]
+                for (name, labels), values in histograms.items()
+            ],
+            "gauges": [["http_requests_in_flight", [], in_flight]],
+            "components": component_stats(),
+        }
+
+    def write(self):
+        """Write this process's snapshot for the other workers to read."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def snapshots(self):
+        """Snapshots of every worker, this one read live."""
+        own = self.snapshot()
+        snapshots = [own]
+        if not self.directory or not os.path.isdir(self.directory):
+            return snapshots
+        for name in os.listdir(self.directory):
+            if not name.startswith("metrics-") or not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if snapshot["pid"] == own["pid"]:
+                continue
+            if not pid_alive(snapshot["pid"]):
+                # Counters of exited workers still count, their gauges not
+                snapshot["gauges"] = []
+                snapshot["components"] = {}
+            snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format."""
+        return render(self.snapshots(), self.buckets)
+
+    def start(self):
+        if not self.directory or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="metrics-write", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.directory:
+            self.write()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.write_interval)
+            if self._stopped:
+                break
+            try:
+                self.write()
+            except Exception:
+                logger.exception("Failed to write metrics")
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def component_stats():
+    """Numeric stats of this process's caches and buffers."""
+    from .accesslogs import access_log_buffer
+    from .bloom import code_filter
+    from .cache import resolve_cache
+    from .counters import visit_counter
+    from .ratelimit import rate_limiter
+    from .reaper import expiry_reaper
+
+    components = {
+        "resolve_cache": resolve_cache.stats(),
+        "visit_counter": visit_counter.stats(),
+        "access_log_buffer": access_log_buffer.stats(),
+        "code_filter": code_filter.stats(),
+        "expiry_reaper": expiry_reaper.stats(),
+        "rate_limiter": rate_limiter.stats(),
+    }
+    return {
+        f"{component}.{key}": stats[key]
+        for component, key, _, _ in COMPONENT_METRICS
+        if key in (stats := components[component])
+    }
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not values:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+LABEL_NAMES = {
+    "http_requests_total": ("route", "method", "status"),
+    "http_request_duration_seconds": ("route",),
+    "db_queries_total": ("route",),
+    "db_query_duration_seconds_total": ("route",),
+}
+
+
+def render(snapshots, buckets):
+    counters = defaultdict(float)
+    gauges = defaultdict(float)
+    histograms = {}
+    components = defaultdict(float)
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            counters[name, tuple(labels)] += value
+        for name, labels, value in snapshot["gauges"]:
+            gauges[name, tuple(labels)] += value
+        for name, labels, values in snapshot["histograms"]:
+            total = histograms.setdefault((name, tuple(labels)), [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for key, value in snapshot["components"].items():
+            components[key] += value
+
+    lines = []
+
+    def header(name, kind):
+        if name in HELP:
+            lines.append(f"# HELP {PREFIX}{name} {HELP[name]}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    gauges.setdefault(("http_requests_in_flight", ()), 0)
+    for kind, values in [("counter", counters), ("gauge", gauges)]:
+        for name in sorted({name for name, _ in values}):
+            header(name, kind)
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    label_text = format_labels(LABEL_NAMES.get(name, ()), labels)
+                    lines.append(f"{PREFIX}{name}{label_text} {format_value(value)}")
+
+    for name in sorted({name for name, _ in histograms}):
+        header(name, "histogram")
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            names = LABEL_NAMES.get(name, ())
+            cumulative = 0
+            for bound, count in zip(buckets + [math.inf], values):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else format_value(float(bound))
+                label_text = format_labels(names + ("le",), labels + (le,))
+                lines.append(f"{PREFIX}{name}_bucket{label_text} {cumulative}")
+            label_text = format_labels(names, labels)
+            lines.append(f"{PREFIX}{name}_sum{label_text} {format_value(values[-1])}")
+            lines.append(f"{PREFIX}{name}_count{label_text} {cumulative}")
+
+    for component, key, name, kind in COMPONENT_METRICS:
+        if f"{component}.{key}" in components:
+            header(name, kind)
+            lines.append(
+                f"{PREFIX}{name} {format_value(components[f'{component}.{key}'])}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(
+    buckets=settings.METRICS_LATENCY_BUCKETS,
+    directory=settings.METRICS_DIR,
+    write_interval=settings.METRICS_WRITE_INTERVAL,
+)
@@ -0,0 +1,111 @@
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse
+
+from . import routers
+from .metrics import metrics
+from .ratelimit import TOO_MANY_REQUESTS, rate_limiter, retry_after
+
+
+class QueryTimer:
+    """Database execute wrapper counting queries and the time they take."""
+
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """Records latency, status and SQL queries of every request by route."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        metrics.inc("http_requests_in_flight")
+        start = time.perf_counter()
+        try:
+            # Replicas and shards as well as "default"
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timer))
+                response = self.get_response(request)
+        finally:
+            metrics.inc("http_requests_in_flight", value=-1)
+        match = request.resolver_match
+        metrics.observe_request(
+            match.view_name if match else "unmatched",
+            request.method,
+            response.status_code,
+            time.perf_counter() - start,
+            timer.count,
+            timer.seconds,
+        )
+        return response
+
+
+class ReplicaPinMiddleware:
+    """
+    Keeps a client's reads on the primary database for REPLICA_PIN_SECONDS
+    after one of its requests wrote, so that it reads its own writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = routers.begin_request(routers.PIN_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+            if routers.wrote():
+                response.set_cookie(
+                    routers.PIN_COOKIE,
+                    "1",
+                    max_age=settings.REPLICA_PIN_SECONDS,
+                    httponly=True,
+                    samesite="Lax",
+                )
+        finally:
+            routers.end_request(token)
+        return response
+
+
+class RateLimitMiddleware:
+    """
+    Answers 429 to clients over the rate limit of a route, by URL name, see
+    urlshortenerapp.ratelimit. Visits answered by the fast path are limited
+    there.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        wait = rate_limiter.check(
+            request.resolver_match.url_name,
+            rate_limiter.client_from_environ(request.META),
+        )
+        if wait:
+            return JsonResponse(
+                {"error": TOO_MANY_REQUESTS},
+                status=429,
+                headers={"Retry-After": retry_after(wait)},
+            )
+        return None
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0006_alter_accesslog_id_alter_shortenedurl_id"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="accesslog",
+            name="accessed_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
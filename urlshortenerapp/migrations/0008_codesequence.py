@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0007_accesslog_accessed_at_default"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CodeSequence",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=50, primary_key=True, serialize=False),
+                ),
+                ("next_block", models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def populate_codes(apps, schema_editor):
+    ShortenedURL = apps.get_model("urlshortenerapp", "ShortenedURL")
+    db = schema_editor.connection.alias
+    batch = []
+    for shortened_url in ShortenedURL.objects.using(db).only("short_url").iterator():
+        shortened_url.code = shortened_url.short_url.rstrip("/").rsplit("/", 1)[-1]
+        batch.append(shortened_url)
+        if len(batch) >= BATCH_SIZE:
+            ShortenedURL.objects.using(db).bulk_update(batch, ["code"])
+            batch = []
+    ShortenedURL.objects.using(db).bulk_update(batch, ["code"])
+
+
+def populate_short_urls(apps, schema_editor):
+    ShortenedURL = apps.get_model("urlshortenerapp", "ShortenedURL")
+    db = schema_editor.connection.alias
+    batch = []
+    for shortened_url in ShortenedURL.objects.using(db).only("code").iterator():
+        shortened_url.short_url = f"{settings.BASE_URL}/{shortened_url.code}"
+        batch.append(shortened_url)
+        if len(batch) >= BATCH_SIZE:
+            ShortenedURL.objects.using(db).bulk_update(batch, ["short_url"])
+            batch = []
+    ShortenedURL.objects.using(db).bulk_update(batch, ["short_url"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0008_codesequence"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="shortenedurl",
+            name="code",
+            field=models.CharField(default="", max_length=16),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="shortenedurl",
+            name="short_url",
+            field=models.CharField(default="", max_length=50),
+        ),
+        migrations.RunPython(populate_codes, populate_short_urls),
+        migrations.AlterField(
+            model_name="shortenedurl",
+            name="code",
+            field=models.CharField(max_length=16, unique=True),
+        ),
+        migrations.RemoveField(
+            model_name="shortenedurl",
+            name="short_url",
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0009_shortenedurl_code"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="accesslog",
+            index=models.Index(
+                fields=["short_url", "accessed_at"], name="accesslog_link_time_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0010_accesslog_link_time_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="accesslog",
+            name="referrer",
+            field=models.CharField(blank=True, default="", max_length=200),
+        ),
+        migrations.CreateModel(
+            name="DailyClickRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("clicks", models.IntegerField(default=0)),
+                ("unique_ips", models.IntegerField(default=0)),
+                ("ip_sketch", models.BinaryField(default=bytes)),
+                ("top_referrers", models.JSONField(default=dict)),
+                (
+                    "short_url",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="urlshortenerapp.shortenedurl",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "unique_together": {("short_url", "bucket")},
+            },
+        ),
+        migrations.CreateModel(
+            name="HourlyClickRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("clicks", models.IntegerField(default=0)),
+                ("unique_ips", models.IntegerField(default=0)),
+                ("ip_sketch", models.BinaryField(default=bytes)),
+                ("top_referrers", models.JSONField(default=dict)),
+                (
+                    "short_url",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="urlshortenerapp.shortenedurl",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "unique_together": {("short_url", "bucket")},
+            },
+        ),
+    ]
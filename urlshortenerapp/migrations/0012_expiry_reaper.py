@@ -0,0 +1,44 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0011_click_rollups"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedURL",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("code", models.CharField(db_index=True, max_length=16)),
+                ("original_url", models.URLField(max_length=400)),
+                ("created_at", models.DateTimeField()),
+                ("expiration_at", models.DateTimeField()),
+                ("visits", models.IntegerField(default=0)),
+                (
+                    "archived_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="shortenedurl",
+            name="expiration_at",
+            field=models.DateTimeField(
+                blank=True, db_index=True, default=None, null=True
+            ),
+        ),
+    ]
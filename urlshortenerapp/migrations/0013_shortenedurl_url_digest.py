@@ -0,0 +1,61 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:42
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def populate_digests(apps, schema_editor):
+    """
+    Give existing links their digest so that shortening their URL again
+    returns them. Only the oldest of several links with the same URL and
+    options gets it, the others keep a NULL digest.
+    """
+    ShortenedURL = apps.get_model("urlshortenerapp", "ShortenedURL")
+    db = schema_editor.connection.alias
+    seen = set()
+    batch = []
+    links = (
+        ShortenedURL.objects.using(db)
+        .order_by("id")
+        .only("original_url", "password", "expiration_hours")
+    )
+    for shortened_url in links.iterator(chunk_size=BATCH_SIZE):
+        key = json.dumps(
+            [
+                shortened_url.original_url,
+                shortened_url.password or "",
+                shortened_url.expiration_hours,
+            ]
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        shortened_url.url_digest = digest
+        batch.append(shortened_url)
+        if len(batch) >= BATCH_SIZE:
+            ShortenedURL.objects.using(db).bulk_update(batch, ["url_digest"])
+            batch = []
+    ShortenedURL.objects.using(db).bulk_update(batch, ["url_digest"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0012_expiry_reaper"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="shortenedurl",
+            name="url_digest",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True, unique=True
+            ),
+        ),
+        migrations.RunPython(populate_digests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.5 on 2026-10-18 04:52
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0013_shortenedurl_url_digest"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AccessLogSegment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.DateTimeField()),
+                ("first_accessed_at", models.DateTimeField()),
+                ("last_accessed_at", models.DateTimeField()),
+                ("count", models.IntegerField()),
+                ("data", models.BinaryField()),
+                (
+                    "compacted_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="accesslog",
+            index=models.Index(fields=["accessed_at"], name="accesslog_time_idx"),
+        ),
+        migrations.AddField(
+            model_name="accesslogsegment",
+            name="short_url",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                to="urlshortenerapp.shortenedurl",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="accesslogsegment",
+            index=models.Index(
+                fields=["short_url", "month"], name="accesslogseg_link_month"
+            ),
+        ),
+    ]
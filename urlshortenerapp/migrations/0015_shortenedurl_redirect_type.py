@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0014_access_log_segments"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="shortenedurl",
+            name="redirect_type",
+            field=models.PositiveSmallIntegerField(
+                choices=[
+                    (301, "301 Moved Permanently"),
+                    (302, "302 Found"),
+                    (307, "307 Temporary Redirect"),
+                    (308, "308 Permanent Redirect"),
+                ],
+                default=302,
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.5 on 2026-10-18 05:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def clear_linear_sketches(apps, schema_editor):
+    """
+    Drop the linear counting sketches of existing rollups, which HyperLogLog
+    sketches replace. Their unique_ips estimates are kept until
+    backfill_rollups rebuilds the sketches from the access logs.
+    """
+    db = schema_editor.connection.alias
+    for name in ["HourlyClickRollup", "DailyClickRollup"]:
+        model = apps.get_model("urlshortenerapp", name)
+        model.objects.using(db).update(ip_sketch=b"")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0015_shortenedurl_redirect_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VisitorSketch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("unique_visitors", models.IntegerField(default=0)),
+                ("sketch", models.BinaryField(default=bytes)),
+                (
+                    "short_url",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="visitor_sketch",
+                        to="urlshortenerapp.shortenedurl",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(clear_linear_sketches, migrations.RunPython.noop),
+    ]
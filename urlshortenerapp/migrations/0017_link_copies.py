@@ -0,0 +1,33 @@
+# Generated by Django 5.1.5 on 2026-10-18 05:50
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("urlshortenerapp", "0016_visitor_sketches"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LinkCopy",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("code", models.CharField(max_length=16, unique=True)),
+                ("source", models.CharField(max_length=100)),
+                ("access_log_id", models.BigIntegerField(default=0)),
+                ("visits", models.IntegerField(default=0)),
+                ("copied_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
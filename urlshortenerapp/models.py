@@ -1,57 +1,306 @@
+import hashlib
+import json
+import re
 from datetime import timedelta
 
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import F
+from django.db import IntegrityError, connections, models, router, transaction
 from django.utils import timezone
 
+from .bloom import code_filter
+from .cache import resolve_cache
+from .counters import visit_counter
+from .routers import shard_for
+
+# Characters the allocators produce, checked on the redirect path instead of
+# validating a full URL
+SHORT_CODE_RE = re.compile(r"[0-9A-Za-z_-]{1,16}")
+
+# Backends supporting INSERT ... ON CONFLICT ... RETURNING
+UPSERT_VENDORS = ("sqlite", "postgresql")
+
+# Statuses a link can redirect with. Browsers and CDNs keep permanent ones
+# (301, 308) until the Cache-Control max-age of the redirect runs out.
+REDIRECT_TYPES = [
+    (301, "301 Moved Permanently"),
+    (302, "302 Found"),
+    (307, "307 Temporary Redirect"),
+    (308, "308 Permanent Redirect"),
+]
+
+DEFAULT_REDIRECT_TYPE = 302
+
+# Fields ShortenedURL.digest() covers
+DIGEST_FIELDS = ("original_url", "password", "expiration_hours", "redirect_type")
+
+
+class CodeTaken(IntegrityError):
+    """Raised by insert_or_fetch() when another link has the short code."""
+
+
+def sort_key(field):
+    """Key function ordering rows by an order_by() field name."""
+
+    def key(row):
+        if isinstance(row, dict):
+            value = row.get(field)
+        else:
+            value = row
+            for name in field.split("__"):
+                value = getattr(value, name, None)
+        return (value is not None, value)
+
+    return key
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    QuerySet of a sharded model. After all_shards(), and unless narrowed to
+    one database with using(), it is evaluated on every shard and the rows
+    are merged in its ordering. Filtering, ordering by field names, count()
+    and slicing work across shards, which is what the admin needs; updates
+    and deletes only ever run on one database.
+    """
+
+    _fan_out = False
+
+    def all_shards(self):
+        clone = self._chain()
+        clone._fan_out = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._fan_out = self._fan_out
+        return clone
+
+    def _fans_out(self):
+        return self._fan_out and self._db is None and len(settings.SHARD_DATABASES) > 1
+
+    def count(self):
+        if not self._fans_out():
+            return super().count()
+        return sum(self.using(db).count() for db in settings.SHARD_DATABASES)
+
+    def _fetch_all(self):
+        if self._result_cache is None and self._fans_out():
+            low, high = self.query.low_mark, self.query.high_mark
+            rows = []
+            for db in settings.SHARD_DATABASES:
+                shard = self.using(db)
+                # The first `high` rows of every shard hold the merged page
+                shard.query.clear_limits()
+                shard.query.set_limits(0, high)
+                rows.extend(shard)
+            ordering = self.query.order_by or self.model._meta.ordering
+            # Stable sorts from the last ordering field to the first
+            for field in reversed(ordering):
+                if isinstance(field, str) and field != "?":
+                    rows.sort(key=sort_key(field.lstrip("-")), reverse=field[0] == "-")
+            self._result_cache = rows[low:high]
+        super()._fetch_all()
+
+
+class ShardedManager(models.Manager.from_queryset(ShardedQuerySet)):
+    def for_code(self, code):
+        """Rows on the shard of the link with short code `code`."""
+        return self.on_shard(shard_for(code))
+
+    def on_shard(self, shard):
+        if shard == settings.SHARD_DATABASES[0]:
+            # Left to the routers, which may pick a replica for reads
+            return self.get_queryset()
+        return self.get_queryset().using(shard)
+
 
 class ShortenedURL(models.Model):
     original_url = models.URLField(max_length=400)
-    short_url = models.CharField(max_length=50, default="", unique=True)
+    # Bare short code, the full short URL is built from BASE_URL when rendered
+    code = models.CharField(max_length=16, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     expiration_hours = models.IntegerField(default=24)
-    expiration_at = models.DateTimeField(null=True, blank=True, default=None)
+    # Indexed for the expiry reaper, which scans links by expiration_at
+    expiration_at = models.DateTimeField(
+        null=True, blank=True, default=None, db_index=True
+    )
     visits = models.IntegerField(default=0)
+    redirect_type = models.PositiveSmallIntegerField(
+        choices=REDIRECT_TYPES, default=DEFAULT_REDIRECT_TYPE
+    )
     password = models.CharField(
         max_length=255, blank=True, null=True
     )  # Optional password to access the URL
+    # digest() of the URL and its options, set by insert_or_fetch() so that
+    # shortening the same URL with the same options returns the same link
+    url_digest = models.CharField(
+        max_length=64, unique=True, null=True, blank=True, editable=False
+    )
+
+    objects = ShardedManager()
+
+    @property
+    def short_url(self):
+        return f"{settings.BASE_URL}/{self.code}"
+
+    @short_url.setter
+    def short_url(self, value):
+        self.code = self.code_from_short_url(value)
+
+    @staticmethod
+    def code_from_short_url(short_url):
+        """Return the code of a full short URL, or the value if it is a code."""
+        return short_url.rstrip("/").rsplit("/", 1)[-1]
 
     def save(self, *args, **kwargs):
-        existing_url = ShortenedURL.objects.filter(short_url=self.short_url).first()
-        # Update operation
-        if existing_url:
-            updated_fields = {}
-            for field in self._meta.fields:
-                field_name = field.name
-                if field_name != "created_at" and field_name != "short_url":
-                    new_value = getattr(existing_url, field_name)
-                    updated_fields[field_name] = new_value
-
-            # Update the fields in the database using the short_url to find the existing record
-            existing_url.__class__.objects.filter(
-                short_url=existing_url.short_url
-            ).update(**updated_fields)
+        adding = self._state.adding
+        if not adding and self.url_digest is not None:
+            # E.g. an admin edit of the URL or its options
+            self.refresh_digest(
+                kwargs.get("using") or router.db_for_write(ShortenedURL, instance=self)
+            )
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None and set(update_fields) & set(DIGEST_FIELDS):
+                kwargs["update_fields"] = {*update_fields, "url_digest"}
+        super().save(*args, **kwargs)
+        if adding:
+            code_filter.add(self.code)
+        resolve_cache.invalidate(self.code)
 
-        else:
-            # Create operation
-            super().save(*args, **kwargs)
+    @staticmethod
+    def digest(
+        original_url,
+        password=None,
+        expiration_hours=24,
+        redirect_type=DEFAULT_REDIRECT_TYPE,
+    ):
+        """Fixed-width key of a URL and the options it was shortened with."""
+        options = [original_url, password or "", expiration_hours]
+        # Only other redirect types are part of the key, which keeps the
+        # digests of links created before redirect types existed
+        if redirect_type != DEFAULT_REDIRECT_TYPE:
+            options.append(redirect_type)
+        key = json.dumps(options)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def refresh_digest(self, db):
+        """Recompute url_digest after the URL or its options changed."""
+        url_digest = self.digest(
+            self.original_url,
+            self.password,
+            self.expiration_hours,
+            self.redirect_type,
+        )
+        if url_digest == self.url_digest:
+            return
+        if (
+            shard_for(url_digest) != shard_for(self.code)
+            or ShortenedURL.objects.using(db)
+            .filter(url_digest=url_digest)
+            .exclude(pk=self.pk)
+            .exists()
+        ):
+            # Shortening the URL again looks for the link on the shard of the
+            # digest, and finds the link that already has it
+            url_digest = None
+        self.url_digest = url_digest
+
+    def insert_or_fetch(self):
+        """
+        Insert this link, or load the existing link for the same URL and
+        options into it, with a single INSERT ... ON CONFLICT ... RETURNING
+        statement. An existing link that has expired takes this link's
+        expiration. Returns True if this link was inserted. Raises CodeTaken
+        if another link, e.g. an imported one, already has this code.
+        """
+        if self.url_digest is None:
+            self.url_digest = self.digest(
+                self.original_url,
+                self.password,
+                self.expiration_hours,
+                self.redirect_type,
+            )
+        db = router.db_for_write(ShortenedURL, instance=self)
+        connection = connections[db]
+        if connection.vendor not in UPSERT_VENDORS:
+            return self._insert_or_fetch_fallback(db)
+
+        fields = [f for f in self._meta.concrete_fields if not f.primary_key]
+        params = [
+            f.get_db_prep_save(f.pre_save(self, add=True), connection) for f in fields
+        ]
+        quote = connection.ops.quote_name
+        table = quote(self._meta.db_table)
+        expiration_at = quote("expiration_at")
+        sql = (
+            f"INSERT INTO {table} ({', '.join(quote(f.column) for f in fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(fields))}) "
+            f"ON CONFLICT ({quote('url_digest')}) DO UPDATE SET {expiration_at} = "
+            f"CASE WHEN {table}.{expiration_at} < %s "
+            f"THEN excluded.{expiration_at} ELSE {table}.{expiration_at} END "
+            "RETURNING *"
+        )
+        now = self._meta.get_field("expiration_at").get_db_prep_value(
+            timezone.now(), connection
+        )
+        try:
+            with transaction.atomic(using=db):
+                (stored,) = ShortenedURL.objects.db_manager(db).raw(sql, params + [now])
+        except IntegrityError:
+            # Only url_digest conflicts are resolved by the statement
+            self._check_code(db)
+            raise
+        return self._load_stored(stored)
+
+    def _insert_or_fetch_fallback(self, db):
+        try:
+            with transaction.atomic(using=db):
+                super().save(using=db)
+        except IntegrityError:
+            existing = ShortenedURL.objects.using(db).filter(url_digest=self.url_digest)
+            existing.filter(expiration_at__lt=timezone.now()).update(
+                expiration_at=self.expiration_at
+            )
+            stored = existing.first()
+            if stored is None:
+                self._check_code(db)
+                raise
+            return self._load_stored(stored)
+        return self._load_stored(self)
+
+    def _check_code(self, db):
+        if ShortenedURL.objects.using(db).filter(code=self.code).exists():
+            raise CodeTaken(f"The short code {self.code} is already taken.")
+
+    def _load_stored(self, stored):
+        inserted = stored.code == self.code
+        for field in self._meta.concrete_fields:
+            setattr(self, field.attname, getattr(stored, field.attname))
+        self._state.adding = False
+        self._state.db = stored._state.db
+        if inserted:
+            code_filter.add(self.code)
+        # The existing link may have been expired and cached as such
+        resolve_cache.invalidate(self.code)
+        return inserted
 
     # Delete operation
     @classmethod
     def delete_by_short_url(cls, short_url):
-        """Delete a ShortenedURL based on short_url."""
+        """Delete a ShortenedURL based on short_url or its code."""
+        code = cls.code_from_short_url(short_url)
         try:
-            record = cls.objects.get(short_url=short_url)
+            record = cls.objects.for_code(code).get(code=code)
             record.delete()
         except cls.DoesNotExist:
             pass
+        resolve_cache.invalidate(code)
 
     def update_visits(self):
-        """Increment the visit count for the shortened URL."""
-        self.visits = F("visits") + 1
-        with transaction.atomic():
-            super().save(update_fields=["visits"])
+        """
+        Increment the visit count for the shortened URL. The increment is
+        buffered by visit_counter and written back in batches.
+        """
+        visit_counter.increment(self.code)
 
     def is_expired(self):
         """Check if the shortened URL has expired."""
@@ -63,12 +312,145 @@ class ShortenedURL(models.Model):
 
 class AccessLog(models.Model):
     short_url = models.ForeignKey(ShortenedURL, on_delete=models.CASCADE)
-    accessed_at = models.DateTimeField(auto_now_add=True)
+    # Set when the visit happens, not when the buffered row is written
+    accessed_at = models.DateTimeField(default=timezone.now)
     user_agent = models.CharField(max_length=200)
     ip_address = models.GenericIPAddressField()
+    referrer = models.CharField(max_length=200, blank=True, default="")
+
+    objects = ShardedManager()
 
     def __str__(self):
         return f"{self.short_url} - {self.ip_address} - {self.access_date}"
 
     class Meta:
         verbose_name_plural = "Access logs"
+        indexes = [
+            # Serves per-link analytics pages ordered by time
+            models.Index(
+                fields=["short_url", "accessed_at"], name="accesslog_link_time_idx"
+            ),
+            # Serves compaction, which moves logs out month by month
+            models.Index(fields=["accessed_at"], name="accesslog_time_idx"),
+        ]
+
+
+class AccessLogSegment(models.Model):
+    """
+    Access logs of one link during one month, compacted out of AccessLog by
+    manage.py compact_access_logs. `data` holds the logs column by column,
+    see urlshortenerapp.segments.
+    """
+
+    short_url = models.ForeignKey(ShortenedURL, on_delete=models.CASCADE)
+    # Start of the month, UTC
+    month = models.DateTimeField()
+    first_accessed_at = models.DateTimeField()
+    last_accessed_at = models.DateTimeField()
+    count = models.IntegerField()
+    data = models.BinaryField()
+    compacted_at = models.DateTimeField(default=timezone.now)
+
+    objects = ShardedManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["short_url", "month"], name="accesslogseg_link_month"),
+        ]
+
+    def __str__(self):
+        return f"{self.short_url} - {self.month:%Y-%m} - {self.count} logs"
+
+
+class ClickRollup(models.Model):
+    """Clicks of one link during one time bucket, maintained incrementally."""
+
+    short_url = models.ForeignKey(ShortenedURL, on_delete=models.CASCADE)
+    bucket = models.DateTimeField()
+    clicks = models.IntegerField(default=0)
+    # Approximate distinct IPs, estimated from ip_sketch, a HyperLogLog
+    # sketch of the bucket's IPs, see urlshortenerapp.hll
+    unique_ips = models.IntegerField(default=0)
+    ip_sketch = models.BinaryField(default=bytes)
+    # Referrer -> clicks for the most frequent referrers only
+    top_referrers = models.JSONField(default=dict)
+
+    objects = ShardedManager()
+
+    class Meta:
+        abstract = True
+        unique_together = ["short_url", "bucket"]
+
+    def __str__(self):
+        return f"{self.short_url} - {self.bucket} - {self.clicks}"
+
+
+class HourlyClickRollup(ClickRollup):
+    pass
+
+
+class DailyClickRollup(ClickRollup):
+    pass
+
+
+class VisitorSketch(models.Model):
+    """
+    HyperLogLog sketch of the IPs that ever visited a link, maintained with
+    its rollups, and the distinct visitors it estimates.
+    """
+
+    short_url = models.OneToOneField(
+        ShortenedURL, on_delete=models.CASCADE, related_name="visitor_sketch"
+    )
+    unique_visitors = models.IntegerField(default=0)
+    sketch = models.BinaryField(default=bytes)
+
+    objects = ShardedManager()
+
+    def __str__(self):
+        return f"{self.short_url} - {self.unique_visitors} visitors"
+
+
+class LinkCopy(models.Model):
+    """
+    Link copied to its shard by rebalance_shards, stored on that shard until
+    the original is pruned. Access logs after `access_log_id` and visits
+    beyond `visits` were recorded on the original after the copy.
+    """
+
+    code = models.CharField(max_length=16, unique=True)
+    source = models.CharField(max_length=100)
+    access_log_id = models.BigIntegerField(default=0)
+    visits = models.IntegerField(default=0)
+    copied_at = models.DateTimeField(default=timezone.now)
+
+    objects = ShardedManager()
+
+    def __str__(self):
+        return f"{self.code} (copied from {self.source})"
+
+
+class CodeSequence(models.Model):
+    """Counter from which workers lease blocks of short code IDs."""
+
+    name = models.CharField(max_length=50, primary_key=True)
+    next_block = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.next_block}"
+
+
+class ArchivedURL(models.Model):
+    """Expired link moved out of ShortenedURL by the expiry reaper."""
+
+    code = models.CharField(max_length=16, db_index=True)
+    original_url = models.URLField(max_length=400)
+    created_at = models.DateTimeField()
+    expiration_at = models.DateTimeField()
+    visits = models.IntegerField(default=0)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    objects = ShardedManager()
+
+    def __str__(self):
+        return f"{self.original_url} -> {self.code} (archived)"
@@ -0,0 +1,155 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+TOO_MANY_REQUESTS = "Too many requests, retry later."
+
+
+def retry_after(wait):
+    """Retry-After header value for a wait of `wait` seconds."""
+    return str(max(1, math.ceil(wait)))
+
+
+class RateLimiter:
+    """
+    Per-client request rate limits of routes, kept in memory by each worker.
+
+    `limits` maps a route to (rate, burst): a client may send `burst`
+    requests at once, then `rate` requests per second. Each route is a
+    token bucket per client, stored as a single float, the time its bucket
+    will be full again (the generic cell rate algorithm). Full buckets are
+    equivalent to no bucket, sweep() forgets them every `sweep_interval`
+    seconds. At most `max_clients` clients are tracked per route. When a
+    sweep does not make room for a new client, the least recently seen one
+    is forgotten.
+
+    Clients are told apart by IP address, or by the value of the
+    `key_header` request header when it is one of `api_keys`. Unknown keys
+    are ignored, or clients could send a new one with every request.
+
+    check() takes no lock, concurrent requests of a client may be let
+    through where only one of them should. Workers limit separately.
+    """
+
+    def __init__(
+        self,
+        limits,
+        sweep_interval=60,
+        max_clients=100000,
+        key_header=None,
+        api_keys=(),
+    ):
+        self.sweep_interval = sweep_interval
+        self.max_clients = max_clients
+        self.api_keys = frozenset(api_keys)
+        # The header as a WSGI environ key and as an ASGI header name
+        self.key_environ = key_header and "HTTP_" + key_header.upper().replace("-", "_")
+        self.key_asgi = key_header and key_header.lower().encode()
+        # route -> (seconds per request, seconds of burst, {client: full at})
+        # with clients from the least to the most recently seen
+        self._routes = {
+            route: (1 / rate, burst / rate, OrderedDict())
+            for route, (rate, burst) in limits.items()
+        }
+        self._lock = threading.Lock()
+        self._sweep_at = time.monotonic() + sweep_interval
+        self._swept_at = 0.0
+        self.limited = 0
+        self.evicted = 0
+        self.sweeps = 0
+
+    def client_from_environ(self, environ):
+        """Client of a WSGI environ or of Django's request.META."""
+        api_key = environ.get(self.key_environ) if self.key_environ else None
+        if api_key in self.api_keys:
+            return f"key:{api_key}"
+        return environ.get("REMOTE_ADDR", "")
+
+    def client_from_scope(self, scope, headers):
+        """Client of an ASGI request, given its headers as a dict."""
+        api_key = headers.get(self.key_asgi) if self.key_asgi else None
+        if api_key is not None:
+            api_key = api_key.decode("latin-1")
+            if api_key in self.api_keys:
+                return f"key:{api_key}"
+        client = scope.get("client")
+        return client[0] if client else ""
+
+    def check(self, route, client, now=None):
+        """
+        Count a request of `client` to `route`. Returns 0 if it is allowed,
+        else the seconds until it would be.
+        """
+        limit = self._routes.get(route)
+        if limit is None:
+            return 0
+        interval, burst, clients = limit
+        if now is None:
+            now = time.monotonic()
+        # Taken out to be put back last, as the most recently seen
+        seen = clients.pop(client, None)
+        if seen is None and len(clients) >= self.max_clients:
+            self._make_room(clients, now)
+        full_at = (now if seen is None else max(seen, now)) + interval
+        wait = full_at - now - burst
+        if wait > 0:
+            if seen is not None:
+                clients[client] = seen
+            self.limited += 1
+            return wait
+        clients[client] = full_at
+        if now >= self._sweep_at:
+            self.sweep(now)
+        return 0
+
+    def _make_room(self, clients, now):
+        # A full table of active clients is swept at most once a second
+        if now - self._swept_at >= 1:
+            self.sweep(now)
+        while len(clients) >= self.max_clients:
+            try:
+                clients.popitem(last=False)
+            except KeyError:
+                break
+            self.evicted += 1
+
+    def sweep(self, now=None):
+        """Forget clients whose buckets are full. Returns how many."""
+        if now is None:
+            now = time.monotonic()
+        forgotten = 0
+        with self._lock:
+            self._sweep_at = now + self.sweep_interval
+            self._swept_at = now
+            for _, _, clients in self._routes.values():
+                # list() copies the items without letting other threads in
+                idle = [
+                    client
+                    for client, full_at in list(clients.items())
+                    if full_at <= now
+                ]
+                for client in idle:
+                    clients.pop(client, None)
+                forgotten += len(idle)
+            self.sweeps += 1
+        return forgotten
+
+    def stats(self):
+        return {
+            "clients": sum(len(clients) for _, _, clients in self._routes.values()),
+            "limited": self.limited,
+            "evicted": self.evicted,
+            "sweeps": self.sweeps,
+        }
+
+
+rate_limiter = RateLimiter(
+    limits=settings.RATE_LIMITS if settings.RATE_LIMIT_ENABLED else {},
+    sweep_interval=settings.RATE_LIMIT_SWEEP_INTERVAL,
+    max_clients=settings.RATE_LIMIT_MAX_CLIENTS,
+    key_header=settings.RATE_LIMIT_KEY_HEADER,
+    api_keys=settings.RATE_LIMIT_API_KEYS,
+)
@@ -0,0 +1,169 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, transaction
+from django.utils import timezone
+
+from .cache import resolve_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryReaper:
+    """
+    Deletes, or archives to ArchivedURL, links that expired more than
+    `grace_period` seconds ago, together with their access logs and rollups.
+
+    Work is done in transactions of at most `batch_size` rows with a pause of
+    `batch_pause` seconds between them, so the reaper never holds the write
+    lock for long. With an `interval`, start() runs it every `interval`
+    seconds in a background thread.
+    """
+
+    def __init__(self, interval, batch_size, batch_pause, grace_period, archive):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.grace_period = grace_period
+        self.archive = archive
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.runs = 0
+        self.reaped_links = 0
+        self.reaped_access_logs = 0
+        self.last_run = None
+
+    def reap(self, max_batches=None, now=None):
+        """
+        Reap expired links until none are left or `max_batches` batches of
+        links have been reaped. Returns the metrics of the run.
+        """
+        start = time.monotonic()
+        cutoff = (now or timezone.now()) - timedelta(seconds=self.grace_period)
+        run = {"links": 0, "archived": 0, "access_logs": 0, "batches": 0}
+        for shard in settings.SHARD_DATABASES:
+            while not self._stopped and (
+                max_batches is None or run["batches"] < max_batches
+            ):
+                links, archived, access_logs = self.reap_batch(cutoff, shard)
+                if not links:
+                    break
+                run["batches"] += 1
+                run["links"] += links
+                run["archived"] += archived
+                run["access_logs"] += access_logs
+                time.sleep(self.batch_pause)
+        run["seconds"] = round(time.monotonic() - start, 3)
+
+        self.runs += 1
+        self.reaped_links += run["links"]
+        self.reaped_access_logs += run["access_logs"]
+        self.last_run = run
+        return run
+
+    def reap_batch(self, cutoff, shard=DEFAULT_DB_ALIAS):
+        """
+        Reap up to `batch_size` links of the database `shard` that expired
+        before `cutoff`. Returns the number of links reaped, archived and
+        access logs deleted.
+        """
+        from .models import AccessLog, ArchivedURL, ShortenedURL
+
+        access_log_rows = AccessLog.objects.using(shard)
+        expired = ShortenedURL.objects.using(shard).filter(expiration_at__lt=cutoff)
+        links = list(expired.order_by("expiration_at")[: self.batch_size])
+        if not links:
+            return 0, 0, 0
+        ids = [link.pk for link in links]
+
+        # A popular link can have millions of access logs, delete them in
+        # batches of their own before the links
+        access_logs = 0
+        while True:
+            log_ids = list(
+                access_log_rows.filter(short_url_id__in=ids).values_list(
+                    "id", flat=True
+                )[: self.batch_size]
+            )
+            if not log_ids:
+                break
+            access_logs += access_log_rows.filter(id__in=log_ids).delete()[0]
+            time.sleep(self.batch_pause)
+
+        archived = 0
+        with transaction.atomic(using=shard):
+            if self.archive:
+                # Archived on the link's shard, like the rest of its rows
+                archived = len(
+                    ArchivedURL.objects.using(shard).bulk_create(
+                        ArchivedURL(
+                            code=link.code,
+                            original_url=link.original_url,
+                            created_at=link.created_at,
+                            expiration_at=link.expiration_at,
+                            visits=link.visits,
+                        )
+                        for link in links
+                    )
+                )
+            # Deletes the remaining logs and the rollups through the cascade
+            expired.filter(pk__in=ids).delete()
+        for link in links:
+            resolve_cache.invalidate(link.code)
+        return len(links), archived, access_logs
+
+    def start(self):
+        """Run the reaper every `interval` seconds, if an interval is set."""
+        if not self.interval or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="expiry-reaper", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        """Stop the background thread after its current batch."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "reaped_links": self.reaped_links,
+            "reaped_access_logs": self.reaped_access_logs,
+            "last_run": self.last_run,
+        }
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            if self._stopped:
+                break
+            try:
+                run = self.reap()
+                logger.info("Reaped %(links)d expired links in %(seconds)ss", run)
+            except Exception:
+                logger.exception("Failed to reap expired links")
+            finally:
+                close_old_connections()
+
+
+expiry_reaper = ExpiryReaper(
+    interval=settings.REAPER_INTERVAL,
+    batch_size=settings.REAPER_BATCH_SIZE,
+    batch_pause=settings.REAPER_BATCH_PAUSE,
+    grace_period=settings.REAPER_GRACE_PERIOD,
+    archive=settings.REAPER_ARCHIVE,
+)
@@ -0,0 +1,229 @@
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from . import rollups
+from .models import (
+    AccessLog,
+    AccessLogSegment,
+    ArchivedURL,
+    DailyClickRollup,
+    HourlyClickRollup,
+    LinkCopy,
+    ShortenedURL,
+    VisitorSketch,
+)
+from .routers import shard_for
+
+# Rows of a link copied along with it, by their foreign key to the link
+LINK_ROWS = [
+    AccessLog,
+    AccessLogSegment,
+    HourlyClickRollup,
+    DailyClickRollup,
+    VisitorSketch,
+]
+
+
+def copy_fields(instance, **overrides):
+    """Unsaved copy of a model instance without its primary key."""
+    fields = {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+        if not field.primary_key
+    }
+    fields.update(overrides)
+    return type(instance)(**fields)
+
+
+class ShardRebalancer:
+    """
+    Moves links to the shard their code hashes to under the current
+    SHARD_DATABASES, in two steps so that workers still using the old list
+    keep finding them: copy() copies misplaced links, with their access
+    logs, rollups and archived copies, to their new shard. Once every worker
+    uses the new list, prune() copies over the visits recorded on the old
+    copies in the meantime, then deletes them from the shards they were
+    copied from.
+    """
+
+    def __init__(self, batch_size=500, dry_run=False):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+
+    def batches(self, queryset):
+        """Yield the rows of a queryset in lists of `batch_size`."""
+        batch = []
+        for row in queryset.iterator(chunk_size=self.batch_size):
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def misplaced(self, model, shard):
+        """Yield batches of rows of `model` on `shard` that belong elsewhere."""
+        last_pk = 0
+        while True:
+            rows = list(
+                model.objects.using(shard)
+                .filter(pk__gt=last_pk)
+                .order_by("pk")[: self.batch_size]
+            )
+            if not rows:
+                return
+            last_pk = rows[-1].pk
+            batch = [row for row in rows if shard_for(row.code) != shard]
+            if batch:
+                yield batch
+
+    def copy(self):
+        """Copy misplaced links to their shard. Returns the metrics of the run."""
+        start = time.monotonic()
+        run = {"links": 0, "rows": 0, "archived": 0}
+        for shard in settings.SHARD_DATABASES:
+            for links in self.misplaced(ShortenedURL, shard):
+                for link in links:
+                    rows = self.copy_link(link, shard_for(link.code))
+                    if rows is not None:
+                        run["links"] += 1
+                        run["rows"] += rows
+            for archived in self.misplaced(ArchivedURL, shard):
+                for row in archived:
+                    target = ArchivedURL.objects.using(shard_for(row.code))
+                    if target.filter(code=row.code).exists():
+                        continue
+                    if not self.dry_run:
+                        target.bulk_create([copy_fields(row)])
+                    run["archived"] += 1
+        run["seconds"] = round(time.monotonic() - start, 3)
+        return run
+
+    def copy_link(self, link, target):
+        """
+        Copy a link and its rows to the shard `target`. Returns the number of
+        rows copied with it, or None if the link is already there.
+        """
+        links = ShortenedURL.objects.using(target)
+        if links.filter(code=link.code).exists():
+            return None
+        if self.dry_run:
+            return 0
+        url_digest = link.url_digest
+        if url_digest is not None and (
+            shard_for(url_digest) != target
+            or links.filter(url_digest=url_digest).exists()
+        ):
+            # Shortening the URL again looks for the link on the shard of the
+            # digest, so the digest is only kept if that is the new shard
+            url_digest = None
+        source = link._state.db
+        rows = 0
+        # The source transaction reads the access logs and the rollups they
+        # were counted in from one snapshot
+        with transaction.atomic(using=target), transaction.atomic(using=source):
+            copy = copy_fields(link, url_digest=url_digest)
+            copy.save(using=target)
+            # prune() copies the access logs and visits recorded after these
+            access_log_id = (
+                AccessLog.objects.using(source)
+                .filter(short_url_id=link.pk)
+                .order_by("-pk")
+                .values_list("pk", flat=True)
+                .first()
+            )
+            LinkCopy.objects.using(target).create(
+                code=link.code,
+                source=source,
+                access_log_id=access_log_id or 0,
+                visits=link.visits,
+            )
+            for model in LINK_ROWS:
+                source_rows = model.objects.using(source).filter(short_url_id=link.pk)
+                if model is AccessLog:
+                    source_rows = source_rows.filter(pk__lte=access_log_id or 0)
+                for batch in self.batches(source_rows.order_by("pk")):
+                    rows += len(
+                        model.objects.using(target).bulk_create(
+                            [copy_fields(row, short_url_id=copy.pk) for row in batch]
+                        )
+                    )
+        return rows
+
+    def catch_up(self, link):
+        """
+        Copy the access logs, with their rollups, and the visits recorded on
+        a link since it was copied to its shard. Returns the number of access
+        logs copied.
+        """
+        target = shard_for(link.code)
+        record = LinkCopy.objects.using(target).filter(code=link.code).first()
+        if record is None:
+            # Copied before copies were recorded
+            return 0
+        copy = ShortenedURL.objects.using(target).get(code=link.code)
+        logs = AccessLog.objects.using(link._state.db).filter(
+            short_url_id=link.pk, pk__gt=record.access_log_id
+        )
+        copied = 0
+        with transaction.atomic(using=target):
+            for batch in self.batches(logs.order_by("pk")):
+                AccessLog.objects.using(target).bulk_create(
+                    [copy_fields(row, short_url_id=copy.pk) for row in batch]
+                )
+                rollups.record(
+                    (
+                        (copy.pk, row.ip_address, row.referrer, row.accessed_at)
+                        for row in batch
+                    ),
+                    using=target,
+                )
+                record.access_log_id = batch[-1].pk
+                copied += len(batch)
+            if link.visits > record.visits:
+                ShortenedURL.objects.using(target).filter(pk=copy.pk).update(
+                    visits=F("visits") + link.visits - record.visits
+                )
+                record.visits = link.visits
+            # Running prune again after a failure does not copy them twice
+            record.save(using=target)
+        return copied
+
+    def prune(self):
+        """
+        Delete links, with their rows, and archived copies from the shards
+        they do not belong to, once they have been copied to their own. What
+        was recorded on the links since the copy is copied over first.
+        Returns the metrics of the run.
+        """
+        start = time.monotonic()
+        run = {"links": 0, "archived": 0, "caught_up": 0}
+        for shard in settings.SHARD_DATABASES:
+            for model, key in [(ShortenedURL, "links"), (ArchivedURL, "archived")]:
+                for rows in self.misplaced(model, shard):
+                    copied = [
+                        row
+                        for row in rows
+                        if model.objects.using(shard_for(row.code))
+                        .filter(code=row.code)
+                        .exists()
+                    ]
+                    if copied and not self.dry_run:
+                        if model is ShortenedURL:
+                            for link in copied:
+                                run["caught_up"] += self.catch_up(link)
+                        # Deletes the links' access logs and rollups too
+                        model.objects.using(shard).filter(
+                            pk__in=[row.pk for row in copied]
+                        ).delete()
+                        if model is ShortenedURL:
+                            for link in copied:
+                                LinkCopy.objects.using(shard_for(link.code)).filter(
+                                    code=link.code
+                                ).delete()
+                    run[key] += len(copied)
+        run["seconds"] = round(time.monotonic() - start, 3)
+        return run
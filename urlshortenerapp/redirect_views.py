@@ -0,0 +1,40 @@
+"""
+Views that do without DRF, so that redirect-only nodes (SERVER_PROFILE
+"redirect") do not import it. See urlshortener.redirect_urls.
+"""
+
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET, require_safe
+
+from .metrics import metrics as process_metrics
+from .visits import VisitDenied, record_visit, redirect_response, resolve_visit
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# Visits the fast path passes through on redirect-only nodes, e.g. HEAD
+# requests. Answers like views.visit_shortened_url, the swagger UI aside.
+@require_safe
+def visit(request, short_url):
+    try:
+        shortened_url = resolve_visit(short_url, request.GET.get("password"))
+        record_visit(
+            shortened_url,
+            request.META.get("REMOTE_ADDR", ""),
+            request.META.get("HTTP_USER_AGENT", ""),
+            request.META.get("HTTP_REFERER", ""),
+        )
+        status, headers = redirect_response(
+            shortened_url, request.headers.get("If-None-Match", "")
+        )
+        return HttpResponse(status=status, headers=dict(headers))
+    except VisitDenied as e:
+        return JsonResponse({"error": e.error}, status=e.status)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+# Prometheus scrape target, plain text instead of a DRF response
+@require_GET
+def metrics(request):
+    return HttpResponse(process_metrics.render(), content_type=METRICS_CONTENT_TYPE)
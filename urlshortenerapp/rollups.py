@@ -0,0 +1,226 @@
+from collections import Counter, defaultdict
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .hll import HyperLogLog, hash_value
+from .models import (
+    AccessLog,
+    AccessLogSegment,
+    DailyClickRollup,
+    HourlyClickRollup,
+    VisitorSketch,
+)
+from .segments import decode
+
+# Referrers kept per bucket, the least frequent ones are dropped on merge
+TOP_REFERRERS_KEPT = 20
+
+
+def hour_bucket(accessed_at):
+    return accessed_at.astimezone(dt_timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    )
+
+
+def day_bucket(accessed_at):
+    return hour_bucket(accessed_at).replace(hour=0)
+
+
+ROLLUPS = [(HourlyClickRollup, hour_bucket), (DailyClickRollup, day_bucket)]
+
+
+class RollupDelta:
+    """Clicks, IP hashes and referrers accumulated for one rollup row."""
+
+    __slots__ = ("clicks", "ip_hashes", "referrers")
+
+    def __init__(self):
+        self.clicks = 0
+        self.ip_hashes = set()
+        self.referrers = Counter()
+
+
+def add_hashes(data, hashes):
+    """Add IP hashes to a stored sketch. Returns it and its estimate."""
+    sketch = HyperLogLog.from_bytes(data, settings.HLL_PRECISION)
+    for hashed in hashes:
+        sketch.add_hash(hashed)
+    return sketch.to_bytes(), sketch.count()
+
+
+def accumulate(entries):
+    """
+    Group (short_url_id, ip_address, referrer, accessed_at) entries into
+    deltas keyed by (rollup model, short_url_id, bucket).
+    """
+    deltas = defaultdict(RollupDelta)
+    for short_url_id, ip_address, referrer, accessed_at in entries:
+        hashed = hash_value(ip_address)
+        for model, bucket_of in ROLLUPS:
+            delta = deltas[model, short_url_id, bucket_of(accessed_at)]
+            delta.clicks += 1
+            delta.ip_hashes.add(hashed)
+            if referrer:
+                delta.referrers[referrer] += 1
+    return deltas
+
+
+def locked_rows(model, keys, key_of, using):
+    """
+    Rows of `model` with the given keys on the shard `using`, created empty
+    where missing, locked in key order so that concurrent writers cannot
+    deadlock. Returns {key: row}.
+    """
+    rows = model.objects.using(using)
+    keys = sorted(keys)
+    # Rows another writer creates first are left to it
+    rows.bulk_create(
+        [model(**dict(zip(key_of, key))) for key in keys], ignore_conflicts=True
+    )
+    filters = {
+        f"{field}__in": {key[i] for key in keys} for i, field in enumerate(key_of)
+    }
+    locked = rows.select_for_update().filter(**filters).order_by(*key_of)
+    wanted = set(keys)
+    by_key = {}
+    for row in locked:
+        key = tuple(getattr(row, field) for field in key_of)
+        if key in wanted:
+            by_key[key] = row
+    return by_key
+
+
+def upsert(model, rows, key_of, fields, using):
+    """
+    Write `fields` of rows in one INSERT ... ON CONFLICT DO UPDATE
+    statement per batch, much cheaper to build than bulk_update()'s CASE.
+    """
+    model.objects.using(using).bulk_create(
+        [
+            model(**{field: getattr(row, field) for field in (*key_of, *fields)})
+            for row in rows
+        ],
+        update_conflicts=True,
+        unique_fields=[field.removesuffix("_id") for field in key_of],
+        update_fields=fields,
+    )
+
+
+def apply(deltas, using=DEFAULT_DB_ALIAS):
+    """
+    Merge deltas into the rollup tables and visitor sketches of the shard
+    `using`, with a few queries per table whatever the number of rows.
+    """
+    by_model = defaultdict(dict)
+    visitors = defaultdict(set)
+    for (model, short_url_id, bucket), delta in deltas.items():
+        by_model[model][short_url_id, bucket] = delta
+        if model is DailyClickRollup:
+            visitors[short_url_id] |= delta.ip_hashes
+    with transaction.atomic(using=using):
+        for model, model_deltas in by_model.items():
+            rollups = locked_rows(
+                model, model_deltas, ("short_url_id", "bucket"), using
+            )
+            for key, delta in model_deltas.items():
+                rollup = rollups[key]
+                referrers = Counter(rollup.top_referrers) + delta.referrers
+                rollup.clicks += delta.clicks
+                rollup.ip_sketch, rollup.unique_ips = add_hashes(
+                    rollup.ip_sketch, delta.ip_hashes
+                )
+                rollup.top_referrers = dict(referrers.most_common(TOP_REFERRERS_KEPT))
+            upsert(
+                model,
+                rollups.values(),
+                ("short_url_id", "bucket"),
+                ["clicks", "ip_sketch", "unique_ips", "top_referrers"],
+                using,
+            )
+
+        sketches = locked_rows(
+            VisitorSketch, [(pk,) for pk in visitors], ("short_url_id",), using
+        )
+        for (short_url_id,), sketch in sketches.items():
+            sketch.sketch, sketch.unique_visitors = add_hashes(
+                sketch.sketch, visitors[short_url_id]
+            )
+        upsert(
+            VisitorSketch,
+            sketches.values(),
+            ("short_url_id",),
+            ["sketch", "unique_visitors"],
+            using,
+        )
+
+
+def record(entries, using=DEFAULT_DB_ALIAS):
+    """Roll up freshly ingested access log entries of the shard `using`."""
+    apply(accumulate(entries), using)
+
+
+def backfill(chunk_size=5000, since=None):
+    """
+    Rebuild the rollups from AccessLog rows, `chunk_size` rows at a time,
+    shard by shard. With `since`, only buckets from that day on are rebuilt.
+    Yields the number of rows processed after each chunk.
+    """
+    for shard in settings.SHARD_DATABASES:
+        yield from backfill_shard(shard, chunk_size, since)
+
+
+def backfill_shard(shard, chunk_size=5000, since=None):
+    logs = AccessLog.objects.using(shard)
+    if since is not None:
+        since = day_bucket(since)
+        logs = logs.filter(accessed_at__gte=since)
+    with transaction.atomic(using=shard):
+        for model, _ in ROLLUPS:
+            rollups = model.objects.using(shard)
+            if since is not None:
+                rollups = rollups.filter(bucket__gte=since)
+            rollups.delete()
+        # Adding logs to a sketch again changes nothing, a partial rebuild
+        # keeps the visitors of the buckets it does not touch
+        if since is None:
+            VisitorSketch.objects.using(shard).delete()
+        # Rows ingested from now on are rolled up by the ingestion path
+        max_id = (
+            AccessLog.objects.using(shard)
+            .order_by("-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+    if max_id is None:
+        return
+    logs = logs.filter(id__lte=max_id)
+
+    last_id = 0
+    while True:
+        chunk = list(
+            logs.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "short_url_id", "ip_address", "referrer", "accessed_at")[
+                :chunk_size
+            ]
+        )
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        record((row[1:] for row in chunk), using=shard)
+        yield len(chunk)
+
+    # Logs compacted out of AccessLog, one segment at a time
+    compacted = AccessLogSegment.objects.using(shard)
+    if since is not None:
+        compacted = compacted.filter(last_accessed_at__gte=since)
+    for link_id, data in compacted.values_list("short_url_id", "data").iterator():
+        rows = [
+            (link_id, row["ip_address"], row["referrer"], row["accessed_at"])
+            for row in decode(data)
+            if since is None or row["accessed_at"] >= since
+        ]
+        record(rows, using=shard)
+        yield len(rows)
@@ -0,0 +1,147 @@
+import contextvars
+import itertools
+import time
+import zlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Models whose rows are spread over the shards by short code, and whose
+# reads may be served by a replica. Everything else, e.g. the short code
+# sequence, sessions and users, only lives on the primary.
+SHARDED_MODELS = {
+    "urlshortenerapp.shortenedurl",
+    "urlshortenerapp.accesslog",
+    "urlshortenerapp.accesslogsegment",
+    "urlshortenerapp.hourlyclickrollup",
+    "urlshortenerapp.dailyclickrollup",
+    "urlshortenerapp.visitorsketch",
+    "urlshortenerapp.archivedurl",
+    "urlshortenerapp.linkcopy",
+}
+
+REPLICA_MODELS = SHARDED_MODELS
+
+# Set on responses to requests that wrote, keeps the client on the primary
+PIN_COOKIE = "primary_pin"
+
+
+class PinState:
+    """Until when reads stay on the primary, and whether a write happened."""
+
+    __slots__ = ("until", "wrote")
+
+    def __init__(self, until=0.0):
+        self.until = until
+        self.wrote = False
+
+
+# Mutable state in a context variable: threads and tasks each get their
+# own, and sync_to_async copies of a request's context share it
+_pin = contextvars.ContextVar("replica_pin")
+
+
+def _state():
+    try:
+        return _pin.get()
+    except LookupError:
+        state = PinState()
+        _pin.set(state)
+        return state
+
+
+def begin_request(pinned):
+    """Start a request, on the primary if the client recently wrote."""
+    until = time.monotonic() + settings.REPLICA_PIN_SECONDS if pinned else 0.0
+    return _pin.set(PinState(until))
+
+
+def end_request(token):
+    _pin.reset(token)
+
+
+def is_pinned():
+    return _state().until > time.monotonic()
+
+
+def wrote():
+    """Whether the current request wrote to the primary."""
+    return _state().wrote
+
+
+def shard_for(key):
+    """Alias of the shard database holding the link with short code `key`."""
+    shards = settings.SHARD_DATABASES
+    if len(shards) == 1:
+        return shards[0]
+    return shards[zlib.crc32(key.encode()) % len(shards)]
+
+
+class ShardRouter:
+    """
+    Sends saves, deletes and related lookups of sharded model instances to
+    the shard of their link. Queries without an instance cannot be routed by
+    code, they name their shard with ShardedManager.for_code() or using().
+    Anything on "default" is left to the routers after this one.
+    """
+
+    def shard_of(self, model, instance):
+        if instance is None or model._meta.label_lower not in SHARDED_MODELS:
+            return None
+        code = getattr(instance, "code", None)
+        if code is None:
+            link = instance._state.fields_cache.get("short_url")
+            code = link.code if link is not None else None
+        if code is not None:
+            shard = shard_for(code)
+        else:
+            # A row read from a replica belongs to the primary
+            shard = instance._state.db
+        return shard if shard in settings.SHARD_DATABASES[1:] else None
+
+    def db_for_read(self, model, **hints):
+        return self.shard_of(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self.shard_of(model, hints.get("instance"))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Every shard has every table, unused ones stay empty
+        return None
+
+
+class ReplicaRouter:
+    """
+    Sends reads of REPLICA_MODELS round-robin to REPLICA_DATABASES, and
+    everything else to the primary. A write pins the current request or
+    thread to the primary for REPLICA_PIN_SECONDS.
+    """
+
+    def __init__(self, replicas=None):
+        if replicas is None:
+            replicas = settings.REPLICA_DATABASES
+        self.replicas = list(replicas)
+        self._next_replica = itertools.cycle(self.replicas)
+
+    def db_for_read(self, model, **hints):
+        if (
+            not self.replicas
+            or model._meta.label_lower not in REPLICA_MODELS
+            or is_pinned()
+        ):
+            return DEFAULT_DB_ALIAS
+        return next(self._next_replica)
+
+    def db_for_write(self, model, **hints):
+        state = _state()
+        state.wrote = True
+        state.until = time.monotonic() + settings.REPLICA_PIN_SECONDS
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their tables from the primary
+        return db not in self.replicas
@@ -0,0 +1,142 @@
+"""
+OpenAPI documentation of the views, for the swagger UI.
+
+Kept out of views.py so that workers do not import drf_yasg at startup.
+urlshortener.swagger_urls imports this module, which attaches the
+documentation to the views, on the first request to /swagger/.
+"""
+
+from drf_yasg import openapi
+from drf_yasg.utils import swagger_auto_schema
+
+from . import views
+from .serializers import ShortenedURLSerializer
+
+swagger_auto_schema(method="GET", responses={200: "OK"})(views.home)
+
+swagger_auto_schema(
+    method="POST",
+    request_body=ShortenedURLSerializer,
+    responses={
+        200: "Already shortened with the same options",
+        201: "Created",
+        400: "Bad Request",
+        422: "Unprocessable Entity",
+        500: "Internal Server Error",
+    },
+)(views.shorten_url)
+
+swagger_auto_schema(
+    method="POST",
+    request_body=openapi.Schema(
+        type=openapi.TYPE_ARRAY,
+        items=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                "original_url": openapi.Schema(type=openapi.TYPE_STRING),
+                "expiration_hours": openapi.Schema(type=openapi.TYPE_INTEGER),
+                "password": openapi.Schema(type=openapi.TYPE_STRING),
+            },
+        ),
+    ),
+    responses={
+        200: "One NDJSON result line per item",
+        400: "Bad Request",
+        422: "Unprocessable Entity",
+        500: "Internal Server Error",
+    },
+)(views.shorten_url_bulk)
+
+swagger_auto_schema(
+    method="GET",
+    responses={
+        200: "Success",
+        301: "Redirect",
+        302: "Redirect",
+        304: "Not Modified",
+        307: "Redirect",
+        308: "Redirect",
+        404: "Not Found",
+        403: "Forbidden",
+    },
+)(views.visit_shortened_url)
+
+swagger_auto_schema(
+    method="GET",
+    manual_parameters=[
+        openapi.Parameter(
+            "limit",
+            openapi.IN_QUERY,
+            description=f"Logs per page (max {views.ANALYTICS_MAX_PAGE_SIZE})",
+            type=openapi.TYPE_INTEGER,
+        ),
+        openapi.Parameter(
+            "cursor",
+            openapi.IN_QUERY,
+            description="next_cursor of the previous page",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "aggregate",
+            openapi.IN_QUERY,
+            description="Add clicks per 'hour' or 'day', top IPs and user agents",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "from",
+            openapi.IN_QUERY,
+            description="Start of the aggregate range (ISO 8601)",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "to",
+            openapi.IN_QUERY,
+            description="End of the aggregate range, exclusive (ISO 8601)",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "stream",
+            openapi.IN_QUERY,
+            description="Stream every log as NDJSON instead of paginating",
+            type=openapi.TYPE_BOOLEAN,
+        ),
+    ],
+    responses={200: "Analytics Data", 404: "Not Found", 500: "Internal Server Error"},
+)(views.analytics)
+
+swagger_auto_schema(
+    method="GET",
+    manual_parameters=[
+        openapi.Parameter(
+            "code",
+            openapi.IN_QUERY,
+            description="Short code or short URL, every link if omitted (staff only)",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "from",
+            openapi.IN_QUERY,
+            description="Start of the range (ISO 8601)",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "to",
+            openapi.IN_QUERY,
+            description="End of the range, exclusive (ISO 8601)",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "output",
+            openapi.IN_QUERY,
+            description="'csv' (default) or 'ndjson'",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "gzip",
+            openapi.IN_QUERY,
+            description="Compress the export with gzip",
+            type=openapi.TYPE_BOOLEAN,
+        ),
+    ],
+    responses={200: "Access logs", 403: "Forbidden", 404: "Not Found"},
+)(views.export_access_logs)
@@ -0,0 +1,263 @@
+"""
+Compacted access logs.
+
+A segment holds up to ACCESS_LOG_SEGMENT_ROWS access logs of one link
+during one month, stored column by column and zlib-compressed:
+
+    version (1 byte) | header length (4 bytes) | JSON header |
+    accessed_at deltas | id deltas | ip_address | user_agent | referrer
+
+Timestamps (microseconds since the epoch) and ids are delta-encoded int64
+arrays. Text columns are uint32 indexes into dictionaries kept in the
+header, with the number of logs of each dictionary value, so that top
+values are counted without decoding the columns. Integers are
+little-endian.
+"""
+
+import json
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from itertools import accumulate
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import AccessLog, AccessLogSegment
+
+FORMAT_VERSION = 1
+
+PREAMBLE = struct.Struct("<BI")
+
+DICTIONARY_COLUMNS = ["ip_address", "user_agent", "referrer"]
+
+COMPRESSION_LEVEL = 6
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def month_bucket(moment):
+    return moment.astimezone(dt_timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def log_position(row):
+    """Order of access logs in analytics, by time then id."""
+    return row["accessed_at"], row["id"]
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode(rows):
+    """
+    Pack (id, accessed_at, ip_address, user_agent, referrer) rows, ordered
+    by accessed_at then id, into a segment.
+    """
+    timestamps = array("q")
+    ids = array("q")
+    dictionaries = {name: {} for name in DICTIONARY_COLUMNS}
+    indexes = {name: array("I") for name in DICTIONARY_COLUMNS}
+    counts = {name: [] for name in DICTIONARY_COLUMNS}
+    previous_timestamp = previous_id = 0
+    for log_id, accessed_at, *values in rows:
+        timestamp = (accessed_at - EPOCH) // timedelta(microseconds=1)
+        timestamps.append(timestamp - previous_timestamp)
+        ids.append(log_id - previous_id)
+        previous_timestamp, previous_id = timestamp, log_id
+        for name, value in zip(DICTIONARY_COLUMNS, values):
+            index = dictionaries[name].setdefault(value, len(dictionaries[name]))
+            if index == len(counts[name]):
+                counts[name].append(0)
+            counts[name][index] += 1
+            indexes[name].append(index)
+
+    header = json.dumps(
+        {
+            "count": len(timestamps),
+            "dictionaries": {name: list(dictionaries[name]) for name in dictionaries},
+            "counts": counts,
+        }
+    ).encode()
+    parts = [PREAMBLE.pack(FORMAT_VERSION, len(header)), header]
+    parts += [_little_endian(timestamps), _little_endian(ids)]
+    parts += [_little_endian(indexes[name]) for name in DICTIONARY_COLUMNS]
+    return zlib.compress(b"".join(parts), COMPRESSION_LEVEL)
+
+
+def _read_header(raw):
+    version, header_length = PREAMBLE.unpack_from(raw)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unknown access log segment version {version}")
+    end = PREAMBLE.size + header_length
+    return json.loads(raw[PREAMBLE.size : end]), end
+
+
+def decode(data):
+    """Unpack a segment into access log dicts, oldest first."""
+    raw = zlib.decompress(data)
+    header, offset = _read_header(raw)
+    count = header["count"]
+
+    def column(typecode):
+        nonlocal offset
+        values = array(typecode)
+        end = offset + count * values.itemsize
+        values.frombytes(raw[offset:end])
+        if sys.byteorder == "big":
+            values.byteswap()
+        offset = end
+        return values
+
+    timestamps = accumulate(column("q"))
+    ids = accumulate(column("q"))
+    columns = [
+        [header["dictionaries"][name][index] for index in column("I")]
+        for name in DICTIONARY_COLUMNS
+    ]
+    return [
+        {
+            "id": log_id,
+            "accessed_at": EPOCH + timedelta(microseconds=timestamp),
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "referrer": referrer,
+        }
+        for log_id, timestamp, ip_address, user_agent, referrer in zip(
+            ids, timestamps, *columns
+        )
+    ]
+
+
+def value_counts(data, field):
+    """Logs per value of a text column, read from the header only."""
+    header, _ = _read_header(zlib.decompress(data))
+    return dict(zip(header["dictionaries"][field], header["counts"][field]))
+
+
+def segments_of(shortened_url):
+    return AccessLogSegment.objects.for_code(shortened_url.code).filter(
+        short_url=shortened_url
+    )
+
+
+def archived_logs(shortened_url, before=None):
+    """
+    Yield the compacted access logs of a link newest first, only those
+    before the (accessed_at, id) position `before` if given. Decodes one
+    month at a time, since segments of different months never overlap.
+    """
+    segments = segments_of(shortened_url)
+    if before is not None:
+        segments = segments.filter(first_accessed_at__lte=before[0])
+    months = segments.order_by("-month").values_list("month", flat=True).distinct()
+    for month in months:
+        rows = []
+        for data in segments.filter(month=month).values_list("data", flat=True):
+            rows.extend(decode(data))
+        rows.sort(key=log_position, reverse=True)
+        for row in rows:
+            if before is None or log_position(row) < before:
+                yield row
+
+
+def archived_value_counts(shortened_url, field):
+    """Compacted access logs of a link per value of `field`."""
+    counts = Counter()
+    for data in segments_of(shortened_url).values_list("data", flat=True):
+        counts.update(value_counts(data, field))
+    return counts
+
+
+class AccessLogCompactor:
+    """
+    Moves access logs of months that ended more than `retention_days` days
+    ago from AccessLog into AccessLogSegment rows of at most `segment_rows`
+    logs, one link and month at a time. Each segment is written and its
+    logs deleted in one transaction, so a run can be interrupted and
+    resumed. Logs arriving late for a compacted month go into a new segment
+    on the next run.
+    """
+
+    def __init__(self, retention_days, segment_rows):
+        self.retention_days = retention_days
+        self.segment_rows = segment_rows
+
+    def compact(self, now=None):
+        """Compact every month before the retention window. Returns metrics."""
+        start = time.monotonic()
+        cutoff = month_bucket(
+            (now or timezone.now()) - timedelta(days=self.retention_days)
+        )
+        run = {"months": 0, "segments": 0, "logs": 0, "bytes": 0}
+        for shard in settings.SHARD_DATABASES:
+            old_logs = AccessLog.objects.using(shard).filter(accessed_at__lt=cutoff)
+            while True:
+                oldest = (
+                    old_logs.order_by("accessed_at")
+                    .values_list("accessed_at", flat=True)
+                    .first()
+                )
+                if oldest is None:
+                    break
+                self.compact_month(shard, month_bucket(oldest), run)
+                run["months"] += 1
+        run["seconds"] = round(time.monotonic() - start, 3)
+        return run
+
+    def compact_month(self, shard, month, run):
+        logs = AccessLog.objects.using(shard).filter(
+            accessed_at__gte=month, accessed_at__lt=next_month(month)
+        )
+        link_ids = logs.order_by().values_list("short_url_id", flat=True).distinct()
+        for link_id in list(link_ids):
+            link_logs = logs.filter(short_url_id=link_id)
+            while True:
+                with transaction.atomic(using=shard):
+                    rows = list(
+                        link_logs.order_by("accessed_at", "id").values_list(
+                            "id", "accessed_at", "ip_address", "user_agent", "referrer"
+                        )[: self.segment_rows]
+                    )
+                    if not rows:
+                        break
+                    data = encode(rows)
+                    AccessLogSegment.objects.using(shard).create(
+                        short_url_id=link_id,
+                        month=month,
+                        first_accessed_at=rows[0][1],
+                        last_accessed_at=rows[-1][1],
+                        count=len(rows),
+                        data=data,
+                    )
+                    # The rows read, by position rather than a huge IN list
+                    last_id, last_accessed_at = rows[-1][0], rows[-1][1]
+                    link_logs.filter(
+                        Q(accessed_at__lt=last_accessed_at)
+                        | Q(accessed_at=last_accessed_at, id__lte=last_id)
+                    ).delete()
+                run["segments"] += 1
+                run["logs"] += len(rows)
+                run["bytes"] += len(data)
+
+
+access_log_compactor = AccessLogCompactor(
+    retention_days=settings.ACCESS_LOG_RETENTION_DAYS,
+    segment_rows=settings.ACCESS_LOG_SEGMENT_ROWS,
+)
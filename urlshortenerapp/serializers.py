@@ -1,13 +1,32 @@
-import hashlib
+from collections import defaultdict
 from datetime import timedelta
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
+from django.db import router, transaction
+from django.db.models import Case, F, Value, When
 from django.utils import timezone
 from rest_framework import serializers
 
-from .models import AccessLog, ShortenedURL
+from .allocators import get_allocator
+from .bloom import code_filter
+from .cache import resolve_cache
+from .models import (
+    DEFAULT_REDIRECT_TYPE,
+    SHORT_CODE_RE,
+    AccessLog,
+    CodeTaken,
+    ShortenedURL,
+)
+from .routers import shard_for
+
+# Codes allocated at most to find one on the shard of a new link's digest.
+# Codes of other shards are skipped, with 4 shards 1 in 10^8 links misses.
+SHARD_ALLOCATION_ATTEMPTS = 64
+
+# Codes allocated at most for a new link whose code another link has
+CODE_ALLOCATION_ATTEMPTS = 8
 
 
 class ShortenedURLSerializer(serializers.ModelSerializer):
@@ -15,14 +34,22 @@ class ShortenedURLSerializer(serializers.ModelSerializer):
         model = ShortenedURL
         fields = [
             "original_url",
+            "code",
             "short_url",
             "created_at",
             "expiration_hours",
             "expiration_at",
             "visits",
             "password",
+            "redirect_type",
+        ]
+        read_only_fields = [
+            "code",
+            "short_url",
+            "created_at",
+            "expiration_at",
+            "visits",
         ]
-        read_only_fields = ["short_url", "created_at", "expiration_at", "visits"]
 
     @classmethod
     def validate_url(cls, value):
@@ -36,10 +63,45 @@ class ShortenedURLSerializer(serializers.ModelSerializer):
             raise ValidationError("The input URL is not well-formed.")
         return value
 
+    @classmethod
+    def validate_code(cls, value):
+        """
+        Validate that the provided short code only uses code characters.
+        Much cheaper than validate_url, so used on the redirect path.
+        """
+        if not SHORT_CODE_RE.fullmatch(value):
+            raise ValidationError("The short URL is not well-formed.")
+        return value
+
     def create(self, validated_data):
         """
         Override the create method to handle the `created_at`, `expiration_at`,
-        and `short_url` fields manually and call the model's save method.
+        and `short_url` fields manually. Returns the existing link if the URL
+        was already shortened with the same options.
+        """
+        instance, _ = self.create_or_fetch(validated_data)
+        return instance
+
+    def create_or_fetch(self, validated_data):
+        """
+        Return the new or existing link and whether it was created. Codes
+        taken by other links, e.g. imported ones, are replaced by new ones.
+        """
+        instance = self.build_instance(validated_data)
+        for attempt in range(1, CODE_ALLOCATION_ATTEMPTS):
+            try:
+                return instance, instance.insert_or_fetch()
+            except CodeTaken:
+                # A deterministic allocator gives a URL the same code again
+                instance.code = self.generate_code(
+                    f"{instance.original_url}#{attempt}", shard_for(instance.url_digest)
+                )
+        return instance, instance.insert_or_fetch()
+
+    def build_instance(self, validated_data):
+        """
+        Build an unsaved ShortenedURL with `created_at`, `expiration_at` and
+        `code` filled in.
         """
         if not validated_data.get("created_at"):
             validated_data["created_at"] = timezone.now()
@@ -52,34 +114,100 @@ class ShortenedURLSerializer(serializers.ModelSerializer):
             )
         validated_data["expiration_at"] = expiration_at
 
-        # Generate the short URL
-        if not validated_data.get("short_url"):
-            validated_data["short_url"] = self.generate_short_url(
-                validated_data["original_url"]
+        url_digest = ShortenedURL.digest(
+            validated_data["original_url"],
+            validated_data.get("password"),
+            expiration_hours,
+            validated_data.get("redirect_type", DEFAULT_REDIRECT_TYPE),
+        )
+        # Generate the short code, on the shard of the digest so that
+        # shortening the URL again finds the link on the same shard
+        if not validated_data.get("code"):
+            validated_data["code"] = self.generate_code(
+                validated_data["original_url"], shard_for(url_digest)
             )
 
-        # call save method of model
-        instance = ShortenedURL(**validated_data)
-        instance.save()
+        return ShortenedURL(url_digest=url_digest, **validated_data)
 
-        return instance
+    @classmethod
+    def create_many(cls, items):
+        """
+        Validate a batch of items and insert the valid ones with a single
+        bulk_create. Returns one result dict per item, in order.
+        """
+        results = []
+        instances = []
+        for item in items:
+            if not isinstance(item, dict):
+                results.append(
+                    {
+                        "status": 400,
+                        "errors": {
+                            "non_field_errors": ["Each item must be a JSON object."]
+                        },
+                    }
+                )
+                continue
+            serializer = cls(data=item)
+            if not serializer.is_valid():
+                results.append({"status": 400, "errors": serializer.errors})
+                continue
+            try:
+                instance = serializer.build_instance(serializer.validated_data)
+            except ValidationError as e:
+                results.append(
+                    {"status": 422, "errors": {"non_field_errors": e.messages}}
+                )
+                continue
+            instances.append(instance)
+            results.append(instance)
+
+        stored = insert_or_fetch_many(instances)
+        return [
+            (
+                result
+                if isinstance(result, dict)
+                else cls.bulk_result(result, stored.get(result.url_digest))
+            )
+            for result in results
+        ]
 
-    def generate_short_url(self, original_url):
+    @staticmethod
+    def bulk_result(instance, stored):
+        if stored is None:
+            # Not inserted and not a duplicate: the short code was taken
+            return {
+                "status": 409,
+                "errors": {"non_field_errors": ["The short code is already taken."]},
+            }
+        code, expiration_at = stored
+        return {
+            "status": 201 if code == instance.code else 200,
+            "original_url": instance.original_url,
+            "short_url": f"{settings.BASE_URL}/{code}",
+            "expiration_at": expiration_at,
+        }
+
+    def generate_code(self, original_url, shard=None):
         """
-        Generate a unique short URL identifier (e.g., 'abc123') based on the original URL.
+        Generate a unique short code (e.g., 'abc123') for the original URL,
+        if possible one stored on `shard`. The full short URL is built from
+        BASE_URL when rendered.
         """
         if not original_url.startswith("http"):
             raise ValidationError("The original URL must start with 'http' or 'https'.")
 
-        # Use SHA-256 to hash the URL and generate the short URL
-        url_hash = hashlib.sha256(original_url.encode()).hexdigest()
-
-        short_url_id = url_hash[
-            :8
-        ]  # Shorten to the first 8 characters (can be adjusted for scalability)
-        short_url = f"{settings.BASE_URL}/{short_url_id}"
-
-        return short_url
+        # Allocate the code with the configured SHORT_CODE_ALLOCATOR
+        allocator = get_allocator()
+        code = allocator.allocate(original_url)
+        for _ in range(SHARD_ALLOCATION_ATTEMPTS):
+            if shard is None or shard_for(code) == shard:
+                break
+            # Skip codes of other shards, unless the allocator is deterministic
+            previous, code = code, allocator.allocate(original_url)
+            if code == previous:
+                break
+        return code
 
 
 class AccessLogSerializer(serializers.ModelSerializer):
@@ -100,3 +228,52 @@ class AccessLogSerializer(serializers.ModelSerializer):
         representation = super().to_representation(instance)
         representation["short_url"] = str(instance.short_url)
         return representation
+
+
+def insert_or_fetch_many(instances):
+    """
+    Bulk version of ShortenedURL.insert_or_fetch(). Inserts the links whose
+    digest is new, extends the expired ones among the existing links, and
+    returns {url_digest: (code, expiration_at)} for every stored link.
+    """
+    by_shard = defaultdict(list)
+    for instance in instances:
+        by_shard[router.db_for_write(ShortenedURL, instance=instance)].append(instance)
+    stored = {}
+    for db, shard_instances in by_shard.items():
+        stored.update(insert_or_fetch_shard(db, shard_instances))
+    return stored
+
+
+def insert_or_fetch_shard(db, instances):
+    links = ShortenedURL.objects.using(db)
+    with transaction.atomic(using=db):
+        links.bulk_create(instances, ignore_conflicts=True)
+        digests = [instance.url_digest for instance in instances]
+        expired = links.filter(url_digest__in=digests, expiration_at__lt=timezone.now())
+        expired.update(
+            expiration_at=Case(
+                *[
+                    When(
+                        url_digest=instance.url_digest,
+                        then=Value(instance.expiration_at),
+                    )
+                    for instance in instances
+                ],
+                default=F("expiration_at"),
+            )
+        )
+        stored = {
+            digest: (code, expiration_at)
+            for digest, code, expiration_at in links.filter(
+                url_digest__in=digests
+            ).values_list("url_digest", "code", "expiration_at")
+        }
+    for instance in instances:
+        code = stored.get(instance.url_digest, (None,))[0]
+        if code == instance.code:
+            code_filter.add(code)
+        elif code is not None:
+            # Existing link, possibly cached as expired
+            resolve_cache.invalidate(code)
+    return stored
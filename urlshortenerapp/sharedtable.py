@@ -0,0 +1,435 @@
+"""
+Key-value table shared by the processes of a host through a memory-mapped
+file, and a Django cache backend on top of it.
+
+Layout, little-endian:
+
+    header (64 bytes) | slots | arena
+
+The header holds a magic number, the number of slots (a power of two), the
+size of the arena, the arena bytes used, the slots used and a stale flag.
+Each slot is
+
+    sequence (8 bytes) | key hash (8) | record offset (8) | expires at (8)
+
+where expires at is a Unix time as a double, 0 for never. A slot points at
+a record `key length (4) | value length (4) | key | value` in the arena.
+Slots are probed linearly from the key hash. Records are appended and never
+changed, so a record that was reached through a slot stays valid.
+
+Readers take no lock. A writer makes the sequence of a slot odd while it
+changes the slot and even again after, and a reader that sees an odd or
+changed sequence reads the slot again. Writers, of any process, take an
+flock() on a lock file next to the table. When the slots or the arena run
+out, the writer copies the live entries into a new file, renames it over
+the table and flags the old file as stale, which makes readers map the new
+one.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import random
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+MAGIC = b"URLSHT01"
+
+# magic, slots, arena size, arena used, slots used, stale
+HEADER = struct.Struct("<8sQQQQQ")
+HEADER_SIZE = 64
+ARENA_USED_OFFSET = 24
+SLOTS_USED_OFFSET = 32
+STALE_OFFSET = 40
+
+SLOT = struct.Struct("<QQQd")
+RECORD = struct.Struct("<II")
+WORD = struct.Struct("<Q")
+
+# Record offsets of slots that were never used and of deleted entries.
+# Records start after the header, so neither is a real offset.
+EMPTY = 0
+DELETED = 1
+
+NEVER = 0.0
+
+# Used slots, deleted ones included, that trigger a rebuild
+MAX_LOAD = 0.7
+
+# A rebuild keeps at most this fraction of the slots and of the arena, the
+# entries expiring last, so that it is not needed again right away
+REBUILD_FILL = 0.5
+
+# Times a reader retries a slot that is being written before giving up
+READ_ATTEMPTS = 100
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def create(path, slots, arena_bytes, entries=()):
+    """
+    Write a table file of `slots` slots holding `entries`, (key, value,
+    expires) tuples, to a temporary file and rename it to `path`.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    size = HEADER_SIZE + slots * SLOT.size + arena_bytes
+    with open(tmp_path, "w+b") as f:
+        # Sparse: pages are only allocated as entries are written
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as mapping:
+            HEADER.pack_into(mapping, 0, MAGIC, slots, arena_bytes, 0, 0, 0)
+            table = Mapping(mapping)
+            for key, value, expires in entries:
+                position, state = table.find(key)
+                table.publish(
+                    position, key_hash(key), table.append(key, value), expires
+                )
+                if state == EMPTY:
+                    table.set_word(SLOTS_USED_OFFSET, table.slots_used + 1)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+
+
+class Mapping:
+    """Reads and writes the table in one mapping of its file."""
+
+    def __init__(self, mapping):
+        magic, slots, arena_size, *_ = HEADER.unpack_from(mapping)
+        if magic != MAGIC:
+            raise ValueError("Not a shared table file")
+        self.mapping = mapping
+        self.slots = slots
+        self.mask = slots - 1
+        self.arena_start = HEADER_SIZE + slots * SLOT.size
+        self.arena_end = self.arena_start + arena_size
+
+    def word(self, offset):
+        return WORD.unpack_from(self.mapping, offset)[0]
+
+    def set_word(self, offset, value):
+        WORD.pack_into(self.mapping, offset, value)
+
+    @property
+    def stale(self):
+        return self.word(STALE_OFFSET) != 0
+
+    @property
+    def arena_used(self):
+        return self.word(ARENA_USED_OFFSET)
+
+    @property
+    def slots_used(self):
+        return self.word(SLOTS_USED_OFFSET)
+
+    def read_slot(self, position):
+        """Consistent (hash, offset, expires) of a slot, or None if contended."""
+        mapping = self.mapping
+        for _ in range(READ_ATTEMPTS):
+            sequence, hashed, offset, expires = SLOT.unpack_from(mapping, position)
+            if not sequence & 1 and WORD.unpack_from(mapping, position)[0] == sequence:
+                return hashed, offset, expires
+        return None
+
+    def read_record(self, offset):
+        key_length, value_length = RECORD.unpack_from(self.mapping, offset)
+        start = offset + RECORD.size
+        middle = start + key_length
+        return self.mapping[start:middle], self.mapping[middle : middle + value_length]
+
+    def lookup(self, key):
+        """Return the (value, expires) of `key`, or None. Takes no lock."""
+        hashed = key_hash(key)
+        index = hashed & self.mask
+        for _ in range(self.slots):
+            slot = self.read_slot(HEADER_SIZE + index * SLOT.size)
+            if slot is None or slot[1] == EMPTY:
+                return None
+            slot_hash, offset, expires = slot
+            if offset != DELETED and slot_hash == hashed:
+                record_key, value = self.read_record(offset)
+                if record_key == key:
+                    return value, expires
+            index = (index + 1) & self.mask
+        return None
+
+    def find(self, key):
+        """
+        Position of the slot of `key` and its state: the record offset if
+        the key is there, else EMPTY or DELETED for the slot to put it in.
+        Writers only.
+        """
+        hashed = key_hash(key)
+        index = hashed & self.mask
+        free = None
+        for _ in range(self.slots):
+            position = HEADER_SIZE + index * SLOT.size
+            _, slot_hash, offset, _ = SLOT.unpack_from(self.mapping, position)
+            if offset == EMPTY:
+                return (free, DELETED) if free is not None else (position, EMPTY)
+            if offset == DELETED:
+                if free is None:
+                    free = position
+            elif slot_hash == hashed and self.read_record(offset)[0] == key:
+                return position, offset
+            index = (index + 1) & self.mask
+        return free, DELETED
+
+    def fits(self, key, value):
+        size = RECORD.size + len(key) + len(value)
+        return self.arena_start + self.arena_used + size <= self.arena_end
+
+    def append(self, key, value):
+        offset = self.arena_start + self.arena_used
+        RECORD.pack_into(self.mapping, offset, len(key), len(value))
+        start = offset + RECORD.size
+        self.mapping[start : start + len(key)] = key
+        self.mapping[start + len(key) : start + len(key) + len(value)] = value
+        self.set_word(
+            ARENA_USED_OFFSET, self.arena_used + RECORD.size + len(key) + len(value)
+        )
+        return offset
+
+    def publish(self, position, hashed, offset, expires):
+        # Odd while the slot is written, readers retry until it is even. A
+        # writer that died mid-write left it odd already.
+        sequence = self.word(position) | 1
+        self.set_word(position, sequence)
+        SLOT.pack_into(self.mapping, position, sequence, hashed, offset, expires)
+        self.set_word(position, sequence + 1)
+
+    def entries(self, now):
+        """Yield the (key, value, expires) of unexpired entries. Writers only."""
+        for index in range(self.slots):
+            _, _, offset, expires = SLOT.unpack_from(
+                self.mapping, HEADER_SIZE + index * SLOT.size
+            )
+            if offset in (EMPTY, DELETED) or (expires and expires <= now):
+                continue
+            key, value = self.read_record(offset)
+            yield key, value, expires
+
+
+class SharedTable:
+    """
+    The table in the file at `path`, created with `slots` slots (rounded up
+    to a power of two) and an `arena_bytes` string arena if it does not
+    exist yet. An existing file keeps its own sizes.
+    """
+
+    def __init__(self, path, slots=1 << 16, arena_bytes=64 << 20):
+        self.path = str(path)
+        self.slots = 1 << max(4, (slots - 1).bit_length())
+        self.arena_bytes = arena_bytes
+        self._table = None
+        # Reentrant, _open() creates the file under it from _writing()
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_pid = None
+        self.rebuilds = 0
+
+    def _current(self):
+        table = self._table
+        if table is None or table.stale:
+            table = self._open()
+        return table
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            with self._lock, self._file_lock():
+                if not os.path.exists(self.path):
+                    create(self.path, self.slots, self.arena_bytes)
+            fd = os.open(self.path, os.O_RDWR)
+        try:
+            # The mapping outlives the descriptor, and the file if it is
+            # replaced. Old mappings are left to the garbage collector, as
+            # other threads may still be reading them.
+            self._table = Mapping(mmap.mmap(fd, 0))
+        finally:
+            os.close(fd)
+        return self._table
+
+    @contextmanager
+    def _file_lock(self):
+        # flock() locks belong to the open file, which a forked worker would
+        # share with its parent: open one per process
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(f"{self.path}.lock", "a+b")
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _writing(self):
+        with self._lock, self._file_lock():
+            table = self._current()
+            yield table
+
+    def get(self, key):
+        """Value of `key`, None if missing or expired. Takes no lock."""
+        found = self._current().lookup(key)
+        if found is None:
+            return None
+        value, expires = found
+        if expires and expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, expires=NEVER, only_new=False):
+        """
+        Store `value` for `key` until the Unix time `expires`. With
+        `only_new`, an unexpired value is kept and False returned.
+        """
+        with self._writing() as table:
+            arena_size = table.arena_end - table.arena_start
+            if RECORD.size + len(key) + len(value) > arena_size * REBUILD_FILL:
+                return False
+            position, state = table.find(key)
+            if only_new and state not in (EMPTY, DELETED):
+                stored_expires = SLOT.unpack_from(table.mapping, position)[3]
+                if not stored_expires or stored_expires > time.time():
+                    return False
+            if not table.fits(key, value) or (
+                state == EMPTY and table.slots_used + 1 > table.slots * MAX_LOAD
+            ):
+                table = self._rebuild(table, key, value)
+                position, state = table.find(key)
+            table.publish(position, key_hash(key), table.append(key, value), expires)
+            if state == EMPTY:
+                table.set_word(SLOTS_USED_OFFSET, table.slots_used + 1)
+            return True
+
+    def touch(self, key, expires=NEVER):
+        with self._writing() as table:
+            position, state = table.find(key)
+            if state in (EMPTY, DELETED):
+                return False
+            table.publish(position, key_hash(key), state, expires)
+            return True
+
+    def delete(self, key):
+        with self._writing() as table:
+            position, state = table.find(key)
+            if state in (EMPTY, DELETED):
+                return False
+            table.publish(position, key_hash(key), DELETED, NEVER)
+            return True
+
+    def clear(self):
+        with self._writing() as table:
+            self._replace(table, [])
+
+    def _rebuild(self, table, key, value):
+        """Compact the table, keeping room for one more entry."""
+        now = time.time()
+        entries = [entry for entry in table.entries(now) if entry[0] != key]
+        # Keep the entries that expire last. Entries come in slot order, and
+        # ties must not keep the first slots only: the table would fill up
+        # around them.
+        random.shuffle(entries)
+        entries.sort(key=lambda entry: entry[2] or float("inf"), reverse=True)
+        arena_size = table.arena_end - table.arena_start
+        budget = arena_size * REBUILD_FILL - RECORD.size - len(key) - len(value)
+        kept = []
+        for entry in entries[: int(table.slots * REBUILD_FILL)]:
+            budget -= RECORD.size + len(entry[0]) + len(entry[1])
+            if budget < 0:
+                break
+            kept.append(entry)
+        self.rebuilds += 1
+        return self._replace(table, kept)
+
+    def _replace(self, table, entries):
+        create(self.path, table.slots, table.arena_end - table.arena_start, entries)
+        table.set_word(STALE_OFFSET, 1)
+        return self._open()
+
+    def stats(self):
+        table = self._current()
+        return {
+            "slots": table.slots,
+            "slots_used": table.slots_used,
+            "arena_bytes": table.arena_end - table.arena_start,
+            "arena_used": table.arena_used,
+            "rebuilds": self.rebuilds,
+        }
+
+
+# One table per file and process, shared by the threads' cache backends
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def shared_table(path, slots, arena_bytes):
+    with _tables_lock:
+        table = _tables.get(path)
+        if table is None:
+            table = _tables[path] = SharedTable(path, slots, arena_bytes)
+        return table
+
+
+class SharedMemoryCache(BaseCache):
+    """
+    Django cache backend storing pickled values in a SharedTable, so that
+    every worker of a host sees the same entries. LOCATION is the path of
+    the table file, OPTIONS may set SLOTS and ARENA_BYTES. It is a cache:
+    when the table is full, the entries expiring first are dropped.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._table = shared_table(
+            location,
+            options.get("SLOTS", 1 << 16),
+            options.get("ARENA_BYTES", 64 << 20),
+        )
+
+    def _expires(self, timeout):
+        expires = self.get_backend_timeout(timeout)
+        return NEVER if expires is None else expires
+
+    def _key(self, key, version):
+        return self.make_and_validate_key(key, version=version).encode()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return self._table.set(
+            self._key(key, version), value, self._expires(timeout), only_new=True
+        )
+
+    def get(self, key, default=None, version=None):
+        value = self._table.get(self._key(key, version))
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        expires = self._expires(timeout)
+        if expires != NEVER and expires <= time.time():
+            self._table.delete(key)
+            return
+        self._table.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._table.touch(self._key(key, version), self._expires(timeout))
+
+    def delete(self, key, version=None):
+        return self._table.delete(self._key(key, version))
+
+    def has_key(self, key, version=None):
+        return self._table.get(self._key(key, version)) is not None
+
+    def clear(self):
+        self._table.clear()
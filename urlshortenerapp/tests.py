@@ -1,10 +1,73 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from wsgiref.util import setup_testing_defaults
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.test import TestCase
-from django.urls import reverse
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, connections
+from django.db.models import F
+from django.db.utils import ConnectionHandler
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve, reverse
+from django.utils import timezone
 from rest_framework import status
 
-from .models import AccessLog, ShortenedURL
+from .accesslogs import (
+    DROP_NEWEST,
+    DROP_OLDEST,
+    UNKNOWN_IP,
+    AccessLogBuffer,
+    access_log_buffer,
+)
+from .allocators import CounterAllocator, HashAllocator
+from .bloom import BloomFilter, CodeFilter
+from .cache import ResolveCache, resolve_cache
+from .counters import VisitCounter, visit_counter
+from .fastpath import AsyncRedirectApp, RedirectApp
+from .hll import HyperLogLog, merged
+from .imports import LinkImporter, secondary_indexes
+from .metrics import Metrics
+from .middleware import MetricsMiddleware
+from .models import (
+    AccessLog,
+    AccessLogSegment,
+    ArchivedURL,
+    DailyClickRollup,
+    HourlyClickRollup,
+    LinkCopy,
+    ShortenedURL,
+    VisitorSketch,
+)
+from .ratelimit import RateLimiter
+from .reaper import ExpiryReaper
+from .rebalance import ShardRebalancer
+from .routers import (
+    PIN_COOKIE,
+    ReplicaRouter,
+    ShardRouter,
+    begin_request,
+    end_request,
+    shard_for,
+)
+from .segments import AccessLogCompactor, decode, encode, value_counts
 from .serializers import ShortenedURLSerializer
+from .sharedtable import SharedMemoryCache, SharedTable
 
 
 class URLShortenerTests(TestCase):
@@ -82,3 +145,1825 @@ class URLShortenerTests(TestCase):
             response = self.client.get(f"/analytics/nonexistenturl")
         except:
             self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ResolveCacheTests(TestCase):
+
+    def setUp(self):
+        resolve_cache.clear()
+        self.code = "cache123"
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com",
+            code=self.code,
+            expiration_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def test_resolve_hits_cache_after_first_load(self):
+        hits = resolve_cache.hits
+        with self.assertNumQueries(1):
+            resolve_cache.resolve(self.code)
+        with self.assertNumQueries(0):
+            link = resolve_cache.resolve(self.code)
+        self.assertEqual(link.original_url, "https://example.com")
+        self.assertEqual(resolve_cache.stats()["hits"], hits + 1)
+
+    def test_delete_invalidates_cache(self):
+        resolve_cache.resolve(self.code)
+        ShortenedURL.delete_by_short_url(self.shortened_url.short_url)
+        self.assertIsNone(resolve_cache.get(self.code))
+
+    def test_lru_eviction(self):
+        cache = ResolveCache(max_entries=1, ttl=60)
+        cache.put(self.shortened_url)
+        other = ShortenedURL(pk=-1, original_url="https://other.com", code="other")
+        cache.put(other)
+        self.assertIsNone(cache.get(self.code))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expired_links_are_cached_briefly(self):
+        self.shortened_url.expiration_at = timezone.now() - timedelta(hours=1)
+        cache = ResolveCache(max_entries=10, ttl=60, expired_ttl=5)
+        link = cache.put(self.shortened_url)
+        self.assertTrue(link.is_expired())
+        self.assertLessEqual(link.deadline - time.monotonic(), 5)
+
+
+class VisitCounterTests(TestCase):
+
+    def setUp(self):
+        self.counter = VisitCounter(flush_interval=3600, flush_threshold=1000)
+        self.addCleanup(self.counter.shutdown)
+        self.first = ShortenedURL.objects.create(
+            original_url="https://first.com", short_url="first"
+        )
+        self.second = ShortenedURL.objects.create(
+            original_url="https://second.com", short_url="second"
+        )
+
+    def test_increments_are_buffered_until_flush(self):
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                self.counter.increment("first")
+            self.counter.increment("second")
+        self.assertEqual(self.counter.pending("first"), 3)
+
+        self.assertEqual(self.counter.flush(), 4)
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual(self.first.visits, 3)
+        self.assertEqual(self.second.visits, 1)
+        self.assertEqual(self.counter.pending("first"), 0)
+
+    def test_zero_interval_writes_through(self):
+        counter = VisitCounter(flush_interval=0, flush_threshold=1000)
+        counter.increment("first")
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.visits, 1)
+
+
+class AccessLogBufferTests(TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com", short_url="logged"
+        )
+
+    def make_buffer(self, max_size=100, drop_policy=DROP_NEWEST):
+        buffer = AccessLogBuffer(
+            max_size=max_size,
+            batch_size=2,
+            flush_interval=3600,
+            drop_policy=drop_policy,
+            spool_dir=self.spool_dir,
+        )
+        self.addCleanup(buffer.shutdown)
+        return buffer
+
+    def test_entries_are_written_in_batches_on_flush(self):
+        buffer = self.make_buffer()
+        accessed_at = timezone.now() - timedelta(minutes=5)
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                buffer.submit(
+                    self.shortened_url.pk, "127.0.0.1", "test", accessed_at=accessed_at
+                )
+        self.assertEqual(buffer.flush(), 3)
+        logs = AccessLog.objects.filter(short_url=self.shortened_url)
+        self.assertEqual(logs.count(), 3)
+        self.assertEqual(logs.first().accessed_at, accessed_at)
+
+    def test_drop_policies(self):
+        newest = self.make_buffer(max_size=1)
+        self.assertTrue(newest.submit(self.shortened_url.pk, "10.0.0.1", "test"))
+        self.assertFalse(newest.submit(self.shortened_url.pk, "10.0.0.2", "test"))
+        oldest = self.make_buffer(max_size=1, drop_policy=DROP_OLDEST)
+        oldest.submit(self.shortened_url.pk, "10.0.0.1", "test")
+        oldest.submit(self.shortened_url.pk, "10.0.0.2", "test")
+        oldest.flush()
+        self.assertEqual(newest.stats()["dropped"], 1)
+        self.assertEqual(oldest.stats()["dropped"], 1)
+        self.assertEqual(AccessLog.objects.get().ip_address, "10.0.0.2")
+
+    def test_drain_command_loads_spooled_entries(self):
+        buffer = self.make_buffer()
+        buffer.spill(
+            [
+                (
+                    self.shortened_url.pk,
+                    "127.0.0.1",
+                    "test",
+                    "",
+                    timezone.now(),
+                    "default",
+                )
+            ]
+        )
+        with mock.patch.object(access_log_buffer, "spool_dir", buffer.spool_dir):
+            call_command("drain_access_logs", stdout=StringIO())
+        self.assertEqual(AccessLog.objects.count(), 1)
+        self.assertEqual(list(buffer.spool_dir.iterdir()), [])
+
+    def test_failed_drain_does_not_write_batches_twice(self):
+        buffer = self.make_buffer()
+        now = timezone.now()
+        buffer.spill(
+            [
+                (self.shortened_url.pk, f"10.0.0.{i}", "test", "", now, "default")
+                for i in range(5)
+            ]
+        )
+        write = buffer._write
+        calls = []
+
+        def failing_write(batch):
+            calls.append(batch)
+            if len(calls) == 2:
+                raise DatabaseError("connection lost")
+            write(batch)
+
+        with mock.patch.object(buffer, "_write", failing_write):
+            with self.assertRaises(DatabaseError):
+                buffer.drain_spool()
+        self.assertEqual(AccessLog.objects.count(), 2)
+        self.assertEqual(buffer.drain_spool(), 3)
+        self.assertEqual(
+            sorted(AccessLog.objects.values_list("ip_address", flat=True)),
+            [f"10.0.0.{i}" for i in range(5)],
+        )
+        self.assertEqual(list(buffer.spool_dir.iterdir()), [])
+
+    def refusing_write(self, buffer, ip_address):
+        write = buffer._write
+
+        def refusing(batch):
+            if any(entry[1] == ip_address for entry in batch):
+                raise IntegrityError("refused")
+            write(batch)
+
+        return mock.patch.object(buffer, "_write", refusing)
+
+    def test_missing_client_addresses_are_written(self):
+        buffer = self.make_buffer()
+        buffer.submit(self.shortened_url.pk, "", None, referrer=None)
+        buffer.submit(self.shortened_url.pk, None, "test")
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(
+            list(AccessLog.objects.values_list("ip_address", flat=True)),
+            [UNKNOWN_IP, UNKNOWN_IP],
+        )
+
+    def test_refused_entries_do_not_spill_their_batch(self):
+        buffer = self.make_buffer()
+        for i in range(4):
+            buffer.submit(self.shortened_url.pk, f"10.0.0.{i}", "test")
+        with self.refusing_write(buffer, "10.0.0.1"):
+            self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(
+            sorted(AccessLog.objects.values_list("ip_address", flat=True)),
+            ["10.0.0.0", "10.0.0.2", "10.0.0.3"],
+        )
+        self.assertEqual(buffer.stats()["rejected"], 1)
+        self.assertEqual(buffer.stats()["spilled"], 0)
+
+    def test_drain_moves_invalid_lines_aside(self):
+        buffer = self.make_buffer()
+        now = timezone.now()
+        buffer.spill(
+            [
+                (self.shortened_url.pk, f"10.0.0.{i}", "test", "", now, "default")
+                for i in range(3)
+            ]
+        )
+        later = self.make_buffer()
+        later.spill([(self.shortened_url.pk, "10.0.0.9", "test", "", now, "default")])
+        spool_file = min(buffer.spool_dir.glob("accesslogs-*.ndjson"))
+        with open(spool_file, "a") as spool:
+            spool.write('{"short_url_id": "x"}\nnot json\n')
+        with self.refusing_write(buffer, "10.0.0.1"):
+            self.assertEqual(buffer.drain_spool(), 3)
+        self.assertEqual(
+            sorted(AccessLog.objects.values_list("ip_address", flat=True)),
+            ["10.0.0.0", "10.0.0.2", "10.0.0.9"],
+        )
+        (rejected,) = buffer.spool_dir.iterdir()
+        self.assertEqual(rejected.name, f"rejected-{spool_file.name}")
+        lines = rejected.read_text().splitlines()
+        self.assertEqual(lines[:2], ['{"short_url_id": "x"}', "not json"])
+        self.assertEqual(json.loads(lines[2])["ip_address"], "10.0.0.1")
+        self.assertEqual(buffer.drain_spool(), 0)
+
+
+class BulkShortenTests(TestCase):
+
+    def read_results(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = b"".join(response.streaming_content).decode()
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_bulk_shorten_json_array(self):
+        data = [
+            {"original_url": "https://one.com"},
+            {"original_url": "not_a_valid_url"},
+            {"original_url": "https://two.com", "expiration_hours": 2},
+        ]
+        response = self.client.post(
+            "/shorten/bulk", data, content_type="application/json"
+        )
+        results = self.read_results(response)
+        self.assertEqual([r["index"] for r in results], [0, 1, 2])
+        self.assertEqual([r["status"] for r in results], [201, 400, 201])
+        self.assertIn("original_url", results[1]["errors"])
+        self.assertEqual(ShortenedURL.objects.count(), 2)
+
+    def test_bulk_shorten_ndjson_in_batches(self):
+        lines = [json.dumps({"original_url": f"https://{i}.com"}) for i in range(5)]
+        body = "\n".join(lines + ["{not json"]) + "\n"
+        with self.settings(BULK_SHORTEN_BATCH_SIZE=2):
+            response = self.client.post(
+                "/shorten/bulk", body, content_type="application/x-ndjson"
+            )
+            results = self.read_results(response)
+        self.assertEqual([r["status"] for r in results], [201] * 5 + [400])
+        self.assertEqual(ShortenedURL.objects.count(), 5)
+
+    def test_bulk_shorten_rejects_non_array(self):
+        response = self.client.post(
+            "/shorten/bulk",
+            {"original_url": "https://one.com"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+class IdempotentShortenTests(TestCase):
+
+    def shorten(self, **data):
+        return self.client.post(
+            "/shorten",
+            {"original_url": "https://example.com/same", **data},
+            content_type="application/json",
+        )
+
+    def test_same_url_and_options_return_the_same_link(self):
+        first = self.shorten()
+        second = self.shorten()
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.json()["short_url"], second.json()["short_url"])
+        self.assertNotIn("url_digest", second.json())
+        # Different options make a different link
+        self.assertEqual(self.shorten(password="secret").status_code, 201)
+        self.assertEqual(self.shorten(expiration_hours=2).status_code, 201)
+        self.assertEqual(ShortenedURL.objects.count(), 3)
+
+    def test_expired_link_is_extended(self):
+        code = self.shorten().json()["code"]
+        ShortenedURL.objects.filter(code=code).update(
+            expiration_at=timezone.now() - timedelta(hours=1)
+        )
+        response = self.shorten()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["code"], code)
+        self.assertFalse(ShortenedURL.objects.get(code=code).is_expired())
+
+    def test_bulk_returns_existing_links(self):
+        existing = self.shorten().json()["short_url"]
+        data = [
+            {"original_url": "https://example.com/same"},
+            {"original_url": "https://example.com/new"},
+            {"original_url": "https://example.com/new"},
+        ]
+        response = self.client.post(
+            "/shorten/bulk", data, content_type="application/json"
+        )
+        body = b"".join(response.streaming_content).decode()
+        results = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([r["status"] for r in results], [200, 201, 200])
+        self.assertEqual(results[0]["short_url"], existing)
+        self.assertEqual(results[1]["short_url"], results[2]["short_url"])
+        self.assertEqual(ShortenedURL.objects.count(), 2)
+
+    def test_save_updates_existing_links(self):
+        link = ShortenedURL.objects.create(original_url="https://a.com", code="upd")
+        link.password = "secret"
+        link.save()
+        self.assertEqual(ShortenedURL.objects.get(code="upd").password, "secret")
+
+    def test_taken_codes_are_replaced(self):
+        allocator = HashAllocator(length=8)
+        ShortenedURL.objects.create(
+            original_url="https://imported.com",
+            code=allocator.allocate("https://example.com/same"),
+        )
+        with mock.patch("urlshortenerapp.serializers.get_allocator") as get_allocator:
+            get_allocator.return_value = allocator
+            for vendors in [("sqlite",), ()]:
+                with mock.patch("urlshortenerapp.models.UPSERT_VENDORS", vendors):
+                    response = self.shorten(expiration_hours=len(vendors) + 1)
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+                link = ShortenedURL.objects.get(code=response.json()["code"])
+                self.assertEqual(link.original_url, "https://example.com/same")
+
+    def test_edited_links_are_found_by_their_new_url(self):
+        code = self.shorten().json()["code"]
+        link = ShortenedURL.objects.get(code=code)
+        link.original_url = "https://example.com/edited"
+        link.save()
+        response = self.shorten(original_url="https://example.com/edited")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["code"], code)
+        # The old URL makes a new link
+        self.assertEqual(self.shorten().status_code, status.HTTP_201_CREATED)
+        # Editing a link to the options of another one leaves it without a
+        # digest, the other link keeps being returned
+        link.original_url = "https://example.com/same"
+        link.save(update_fields=["original_url"])
+        link.refresh_from_db()
+        self.assertIsNone(link.url_digest)
+        self.assertNotEqual(self.shorten().json()["code"], code)
+
+
+class CodeAllocatorTests(TestCase):
+
+    def test_counter_codes_are_unique_across_workers(self):
+        workers = [CounterAllocator(length=6, block_size=3) for _ in range(2)]
+        codes = [worker.allocate() for _ in range(10) for worker in workers]
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertTrue(all(len(code) == 6 and code.isalnum() for code in codes))
+
+    def test_counter_leases_blocks(self):
+        allocator = CounterAllocator(length=8, block_size=100)
+        allocator.allocate()
+        with self.assertNumQueries(0):
+            for _ in range(99):
+                allocator.allocate()
+
+    def test_counter_raises_when_code_space_is_exhausted(self):
+        allocator = CounterAllocator(length=1, block_size=100)
+        for _ in range(62):
+            allocator.allocate()
+        with self.assertRaises(OverflowError):
+            allocator.allocate()
+
+    def test_hash_allocator_is_deterministic(self):
+        allocator = HashAllocator(length=8)
+        self.assertEqual(
+            allocator.allocate("https://example.com"),
+            allocator.allocate("https://example.com"),
+        )
+
+
+class ShortCodeTests(TestCase):
+
+    def test_short_url_is_rendered_from_code(self):
+        shortened_url = ShortenedURL(short_url=f"{settings.BASE_URL}/abc123")
+        self.assertEqual(shortened_url.code, "abc123")
+        self.assertEqual(shortened_url.short_url, f"{settings.BASE_URL}/abc123")
+
+    def test_malformed_code_is_rejected_without_lookup(self):
+        with self.assertNumQueries(0):
+            response = self.client.get("/bad.code!/")
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_analytics_accepts_bare_code(self):
+        ShortenedURL.objects.create(original_url="https://example.com", code="bare1")
+        response = self.client.get("/analytics/bare1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["short_url"], f"{settings.BASE_URL}/bare1")
+
+
+class AnalyticsTests(TestCase):
+
+    def setUp(self):
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com", code="stats1"
+        )
+        start = timezone.now().replace(minute=0, second=0, microsecond=0)
+        AccessLog.objects.bulk_create(
+            AccessLog(
+                short_url=self.shortened_url,
+                ip_address=f"10.0.0.{i % 2}",
+                user_agent="test",
+                accessed_at=start - timedelta(minutes=40 * i),
+            )
+            for i in range(5)
+        )
+        call_command("backfill_rollups", stdout=StringIO())
+
+    def test_cursor_pagination_walks_every_log_once(self):
+        seen = []
+        cursor = ""
+        while True:
+            response = self.client.get(
+                "/analytics/stats1", {"limit": 2, "cursor": cursor}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.json()
+            self.assertLessEqual(len(data["logs"]), 2)
+            seen.extend(log["accessed_at"] for log in data["logs"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+    def test_aggregates(self):
+        response = self.client.get("/analytics/stats1", {"aggregate": "hour"})
+        data = response.json()
+        self.assertEqual(sum(bucket["clicks"] for bucket in data["clicks"]), 5)
+        self.assertEqual(data["top_ips"][0], {"ip_address": "10.0.0.0", "clicks": 3})
+        self.assertEqual(data["top_user_agents"][0]["clicks"], 5)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/analytics/stats1", {"cursor": "nope"})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_stream_mode(self):
+        response = self.client.get("/analytics/stats1", {"stream": "1"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])["user_agent"], "test")
+
+
+class ClickRollupTests(TestCase):
+
+    def setUp(self):
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com", code="rolled"
+        )
+        self.buffer = AccessLogBuffer(
+            max_size=100,
+            batch_size=100,
+            flush_interval=3600,
+            drop_policy=DROP_NEWEST,
+            spool_dir=tempfile.gettempdir(),
+        )
+        self.addCleanup(self.buffer.shutdown)
+        self.accessed_at = timezone.now().replace(minute=30)
+        for ip_address, referrer in [
+            ("10.0.0.1", "https://news.com"),
+            ("10.0.0.1", "https://news.com"),
+            ("10.0.0.2", ""),
+        ]:
+            self.buffer.submit(
+                self.shortened_url.pk,
+                ip_address,
+                "test",
+                referrer,
+                accessed_at=self.accessed_at,
+            )
+
+    def test_rollups_are_updated_on_ingestion(self):
+        self.buffer.flush()
+        hourly = HourlyClickRollup.objects.get(short_url=self.shortened_url)
+        daily = DailyClickRollup.objects.get(short_url=self.shortened_url)
+        self.assertEqual(
+            hourly.bucket, self.accessed_at.replace(minute=0, second=0, microsecond=0)
+        )
+        self.assertEqual((hourly.clicks, daily.clicks), (3, 3))
+        self.assertEqual(hourly.unique_ips, 2)
+        self.assertEqual(hourly.top_referrers, {"https://news.com": 2})
+
+    def test_rollups_are_written_in_bulk(self):
+        links = ShortenedURL.objects.bulk_create(
+            [
+                ShortenedURL(original_url="https://example.com", code=f"bulk{i}")
+                for i in range(50)
+            ]
+        )
+        for i in range(100):
+            self.buffer.submit(
+                links[i % 50].pk,
+                f"10.1.0.{i}",
+                "test",
+                "",
+                accessed_at=self.accessed_at,
+            )
+        with CaptureQueriesContext(connection) as queries:
+            self.buffer.flush()
+        # Creating, locking and updating the rows of each table
+        tables = ["hourlyclickrollup", "dailyclickrollup", "visitorsketch"]
+        for table in tables:
+            table_queries = [query for query in queries if table in query["sql"]]
+            self.assertEqual(len(table_queries), 3, table)
+        self.assertEqual(HourlyClickRollup.objects.get(short_url=links[0]).clicks, 2)
+        self.assertEqual(
+            VisitorSketch.objects.get(short_url=links[0]).unique_visitors, 2
+        )
+
+    def test_backfill_rebuilds_the_same_rollups(self):
+        self.buffer.flush()
+        HourlyClickRollup.objects.update(clicks=0)
+        call_command("backfill_rollups", chunk_size=2, stdout=StringIO())
+        hourly = HourlyClickRollup.objects.get(short_url=self.shortened_url)
+        self.assertEqual((hourly.clicks, hourly.unique_ips), (3, 2))
+
+    def test_analytics_reads_rollups(self):
+        self.buffer.flush()
+        response = self.client.get("/analytics/rolled", {"aggregate": "day"})
+        data = response.json()
+        self.assertEqual(data["clicks"][0]["clicks"], 3)
+        self.assertEqual(
+            data["top_referrers"], [{"referrer": "https://news.com", "clicks": 2}]
+        )
+
+    def test_unique_visitors(self):
+        self.buffer.flush()
+        self.buffer.submit(
+            self.shortened_url.pk,
+            "10.0.0.3",
+            "test",
+            "",
+            accessed_at=self.accessed_at - timedelta(days=1),
+        )
+        self.buffer.flush()
+        sketch = VisitorSketch.objects.get(short_url=self.shortened_url)
+        self.assertEqual(sketch.unique_visitors, 3)
+
+        response = self.client.get("/analytics/rolled", {"aggregate": "day"})
+        data = response.json()
+        self.assertEqual(data["unique_visitors"], 3)
+        self.assertEqual([bucket["unique_ips"] for bucket in data["clicks"]], [1, 2])
+        self.assertEqual(data["unique_ips"], 3)
+        self.assertNotIn("ip_sketch", data["clicks"][0])
+
+        VisitorSketch.objects.all().delete()
+        call_command("backfill_rollups", stdout=StringIO())
+        sketch = VisitorSketch.objects.get(short_url=self.shortened_url)
+        self.assertEqual(sketch.unique_visitors, 3)
+
+
+class HyperLogLogTests(TestCase):
+
+    def test_estimate_is_within_the_standard_error(self):
+        sketch = HyperLogLog(12)
+        for i in range(50000):
+            sketch.add(f"10.0.{i}")
+        # Three standard errors of 1.6%
+        self.assertAlmostEqual(sketch.count(), 50000, delta=50000 * 0.05)
+
+    def test_small_counts_are_exact_and_sparse(self):
+        sketch = HyperLogLog(12)
+        for i in range(100):
+            sketch.add(f"10.0.{i % 20}")
+        data = sketch.to_bytes()
+        self.assertLess(len(data), 100)
+        self.assertEqual(HyperLogLog.from_bytes(data, 12).count(), 20)
+        self.assertEqual(HyperLogLog(12).to_bytes(), b"")
+
+    def test_merge_counts_the_union(self):
+        first, second = HyperLogLog(12), HyperLogLog(12)
+        for i in range(3000):
+            first.add(f"10.0.{i}")
+        for i in range(2000, 6000):
+            second.add(f"10.0.{i}")
+        union = merged([first.to_bytes(), b"", second.to_bytes()], 12)
+        self.assertAlmostEqual(union.count(), 6000, delta=6000 * 0.05)
+
+    def test_sketches_of_different_precisions_merge_at_the_lower(self):
+        fine, coarse = HyperLogLog(14), HyperLogLog(10)
+        for i in range(5000):
+            fine.add(f"10.0.{i}")
+            coarse.add(f"10.0.{i}")
+        folded = HyperLogLog.from_bytes(fine.to_bytes(), 10)
+        self.assertEqual(folded.registers, coarse.registers)
+        union = merged([coarse.to_bytes(), fine.to_bytes()], 12)
+        self.assertEqual(union.precision, 10)
+        self.assertEqual(union.count(), coarse.count())
+
+
+class WriteThroughMixin:
+    """Write visits and access logs synchronously in the test transaction."""
+
+    def setUp(self):
+        super().setUp()
+        resolve_cache.clear()
+        for patcher in [
+            mock.patch.object(visit_counter, "flush_interval", 0),
+            mock.patch.object(access_log_buffer, "flush_interval", 0),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class RedirectAppTests(WriteThroughMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.passed_through = []
+        self.app = RedirectApp(self.django_app)
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com/caf\u00e9",
+            code="fast1",
+            expiration_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def django_app(self, environ, start_response):
+        self.passed_through.append(environ["PATH_INFO"])
+        start_response("200 OK", [])
+        return [b"django"]
+
+    def call(self, path, query="", **headers):
+        environ = {
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "REMOTE_ADDR": "127.0.0.1",
+            **headers,
+        }
+        setup_testing_defaults(environ)
+        response = {}
+
+        def start_response(status, response_headers):
+            response["status"] = int(status.split()[0])
+            response["headers"] = dict(response_headers)
+
+        # Like the test client, keep the test transaction's connection open
+        with mock.patch("urlshortenerapp.fastpath.close_old_connections"):
+            response["body"] = b"".join(self.app(environ, start_response))
+        return response
+
+    def test_redirect_is_answered_without_django(self):
+        response = self.call("/fast1/")
+        self.assertEqual(response["status"], status.HTTP_302_FOUND)
+        self.assertEqual(
+            response["headers"]["Location"], "https://example.com/caf%C3%A9"
+        )
+        self.assertEqual(self.passed_through, [])
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 1)
+        self.assertEqual(
+            AccessLog.objects.filter(short_url=self.shortened_url).count(), 1
+        )
+
+    def test_errors_match_the_view(self):
+        ShortenedURL.objects.create(
+            original_url="https://example.com", code="locked", password="secret"
+        )
+        self.assertEqual(self.call("/locked/", "password=nope")["status"], 403)
+        self.assertEqual(self.call("/locked/", "password=secret")["status"], 302)
+        response = self.call("/missing/")
+        self.assertEqual(response["status"], status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            json.loads(response["body"]), {"error": "Shortened URL not found"}
+        )
+
+    def test_rate_limit(self):
+        limiter = RateLimiter({"visit_shortened_url": (1, 2)})
+        with mock.patch("urlshortenerapp.fastpath.rate_limiter", limiter):
+            self.assertEqual(self.call("/fast1/")["status"], 302)
+            self.assertEqual(self.call("/missing/")["status"], 404)
+            response = self.call("/fast1/")
+            self.assertEqual(response["status"], 429)
+            self.assertEqual(response["headers"]["Retry-After"], "1")
+            other = self.call("/fast1/", REMOTE_ADDR="10.0.0.2")
+            self.assertEqual(other["status"], 302)
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 2)
+
+    def test_conditional_requests(self):
+        etag = self.call("/fast1/")["headers"]["ETag"]
+        response = self.call("/fast1/", HTTP_IF_NONE_MATCH=f"W/{etag}")
+        self.assertEqual(response["status"], status.HTTP_304_NOT_MODIFIED)
+        self.assertNotIn("Location", response["headers"])
+        # The client's cached redirect was followed, a visit all the same
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 2)
+        response = self.call("/fast1/", HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response["status"], status.HTTP_302_FOUND)
+
+    def test_other_requests_pass_through(self):
+        self.call("/swagger/")
+        self.call("/admin/")
+        self.call("/fast1")
+        self.call("/fast1/", HTTP_REFERER="http://localhost:8000/swagger/")
+        self.assertEqual(
+            self.passed_through, ["/swagger/", "/admin/", "/fast1", "/fast1/"]
+        )
+
+
+class AsyncRedirectAppTests(WriteThroughMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.passed_through = []
+        self.app = AsyncRedirectApp(self.django_app)
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com/async",
+            code="async1",
+            expiration_at=timezone.now() + timedelta(hours=1),
+        )
+
+    async def django_app(self, scope, receive, send):
+        self.passed_through.append(scope["path"])
+
+    async def call(self, path, query=b"", method="GET", headers=()):
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query,
+            "headers": list(headers),
+            "client": ("127.0.0.1", 50000),
+        }
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        # Like the test client, keep the test transaction's connection open
+        with mock.patch("urlshortenerapp.fastpath.close_old_connections"):
+            await self.app(scope, None, send)
+        if not messages:
+            return None
+        return {
+            "status": messages[0]["status"],
+            "headers": dict(messages[0]["headers"]),
+            "body": messages[1]["body"],
+        }
+
+    async def test_rate_limit(self):
+        limiter = RateLimiter(
+            {"visit_shortened_url": (1, 1)}, key_header="X-Api-Key", api_keys=["k1"]
+        )
+        with mock.patch("urlshortenerapp.fastpath.rate_limiter", limiter):
+            self.assertEqual((await self.call("/async1/"))["status"], 302)
+            response = await self.call("/async1/")
+            self.assertEqual(response["status"], 429)
+            self.assertEqual(response["headers"][b"retry-after"], b"1")
+            response = await self.call("/async1/", headers=[(b"x-api-key", b"k1")])
+            self.assertEqual(response["status"], 302)
+
+    async def test_redirect_on_the_event_loop(self):
+        response = await self.call("/async1/", headers=[(b"user-agent", b"test")])
+        self.assertEqual(response["status"], status.HTTP_302_FOUND)
+        self.assertEqual(response["headers"][b"location"], b"https://example.com/async")
+        await sync_to_async(self.shortened_url.refresh_from_db)()
+        self.assertEqual(self.shortened_url.visits, 1)
+        log = await AccessLog.objects.aget(short_url=self.shortened_url)
+        self.assertEqual((log.ip_address, log.user_agent), ("127.0.0.1", "test"))
+
+    async def test_errors_and_pass_through(self):
+        response = await self.call("/missing/")
+        self.assertEqual(response["status"], status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            json.loads(response["body"]), {"error": "Shortened URL not found"}
+        )
+        await self.call("/admin/")
+        await self.call("/async1/", method="POST")
+        await self.call("/async1/", headers=[(b"referer", b"http://x/swagger/")])
+        self.assertEqual(self.passed_through, ["/admin/", "/async1/", "/async1/"])
+
+
+class ExpiryReaperTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.reaper = ExpiryReaper(
+            interval=0, batch_size=2, batch_pause=0, grace_period=3600, archive=False
+        )
+        self.expired = [
+            ShortenedURL.objects.create(
+                original_url=f"https://example.com/{i}",
+                code=f"old{i}",
+                expiration_at=now - timedelta(days=2),
+                visits=i,
+            )
+            for i in range(3)
+        ]
+        for link in self.expired:
+            AccessLog.objects.bulk_create(
+                AccessLog(short_url=link, ip_address="127.0.0.1", user_agent="ua")
+                for _ in range(3)
+            )
+        # Within the grace period, still live and never expiring
+        for code, expiration_at in [
+            ("recent", now - timedelta(minutes=5)),
+            ("live", now + timedelta(days=1)),
+            ("forever", None),
+        ]:
+            ShortenedURL.objects.create(
+                original_url="https://example.com",
+                code=code,
+                expiration_at=expiration_at,
+            )
+
+    def test_reaps_expired_links_in_batches(self):
+        resolve_cache.resolve("old0")
+        run = self.reaper.reap()
+        self.assertEqual(
+            (run["links"], run["access_logs"], run["batches"], run["archived"]),
+            (3, 9, 2, 0),
+        )
+        self.assertEqual(
+            sorted(ShortenedURL.objects.values_list("code", flat=True)),
+            ["forever", "live", "recent"],
+        )
+        self.assertFalse(AccessLog.objects.exists())
+        self.assertIsNone(resolve_cache.get("old0"))
+        self.assertEqual(self.reaper.stats()["reaped_links"], 3)
+
+    def test_max_batches_and_archive(self):
+        self.reaper.archive = True
+        run = self.reaper.reap(max_batches=1)
+        self.assertEqual((run["links"], run["archived"]), (2, 2))
+        self.assertEqual(
+            sorted(ArchivedURL.objects.values_list("code", "visits")),
+            [("old0", 0), ("old1", 1)],
+        )
+        self.assertEqual(ShortenedURL.objects.count(), 4)
+
+    def test_command(self):
+        out = StringIO()
+        call_command("reap_expired_links", "--pause", "0", "--archive", stdout=out)
+        self.assertIn("Reaped 3 expired links (3 archived)", out.getvalue())
+        self.assertEqual(ArchivedURL.objects.count(), 3)
+
+
+class CodeFilterTests(TestCase):
+
+    def setUp(self):
+        resolve_cache.clear()
+        self.code_filter = CodeFilter(
+            enabled=True,
+            false_positive_rate=0.01,
+            max_bytes=1024 * 1024,
+            sync_interval=3600,
+            rebuild_interval=3600,
+        )
+        for module in ["cache", "models"]:
+            patcher = mock.patch(
+                f"urlshortenerapp.{module}.code_filter", self.code_filter
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        ShortenedURL.objects.create(original_url="https://example.com", code="known")
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01, 1024 * 1024)
+        for i in range(1000):
+            bloom.add(f"code{i}")
+        self.assertTrue(all(f"code{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertLess(bloom.false_positive_rate(), 0.03)
+        # The memory budget wins over the false positive rate
+        self.assertEqual(len(BloomFilter(10**6, 0.01, 1024).bits), 1024)
+
+    def test_unknown_codes_404_without_a_query(self):
+        self.code_filter.rebuild()
+        with self.assertNumQueries(0):
+            with self.assertRaises(Http404):
+                resolve_cache.resolve("unknown")
+        self.assertEqual(resolve_cache.resolve("known").code, "known")
+        ShortenedURL.objects.create(original_url="https://example.com", code="new")
+        self.assertEqual(resolve_cache.resolve("new").code, "new")
+        self.assertEqual(self.code_filter.stats()["rejected"], 1)
+
+    def test_codes_from_other_workers_are_synced(self):
+        self.code_filter.rebuild()
+        # Inserted without going through this worker's save()
+        ShortenedURL.objects.bulk_create(
+            [ShortenedURL(original_url="https://example.com", code="elsewhere")]
+        )
+        self.assertFalse(self.code_filter.might_exist("elsewhere"))
+        self.code_filter.sync()
+        self.assertTrue(self.code_filter.might_exist("elsewhere"))
+        self.assertFalse(self.code_filter.might_exist("unknown"))
+
+    def test_sync_reads_rows_committed_out_of_order(self):
+        self.code_filter.rebuild()
+        self.code_filter.sync()
+        max_pk = ShortenedURL.objects.order_by("-pk").first().pk
+        self.assertEqual(self.code_filter._max_pk["default"], max_pk)
+        with mock.patch.object(self.code_filter, "_filter") as bloom:
+            self.code_filter.sync()
+            bloom.add.assert_not_called()
+
+        ShortenedURL.objects.bulk_create(
+            [ShortenedURL(pk=max_pk + 2, original_url="https://a.com", code="later")]
+        )
+        self.code_filter.sync()
+        self.assertEqual(self.code_filter._holes["default"].keys(), {max_pk + 1})
+        # The transaction that took the lower key commits last
+        ShortenedURL.objects.bulk_create(
+            [ShortenedURL(pk=max_pk + 1, original_url="https://a.com", code="slow")]
+        )
+        self.code_filter.sync()
+        self.assertTrue(self.code_filter.might_exist("slow"))
+        self.assertEqual(self.code_filter._holes["default"], {})
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.metrics = Metrics(buckets=[0.01, 0.1, 1], directory=self.directory)
+        for target in [
+            "urlshortenerapp.middleware.metrics",
+            "urlshortenerapp.redirect_views.process_metrics",
+        ]:
+            patcher = mock.patch(target, self.metrics)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_requests_are_instrumented(self):
+        self.client.post(
+            "/shorten",
+            {"original_url": "https://example.com"},
+            content_type="application/json",
+        )
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        text = response.content.decode()
+        self.assertIn(
+            'urlshortener_http_requests_total{route="shorten_url",method="POST",'
+            'status="201"} 1',
+            text,
+        )
+        self.assertIn(
+            'urlshortener_http_request_duration_seconds_count{route="shorten_url"} 1',
+            text,
+        )
+        self.assertRegex(
+            text, r'urlshortener_db_queries_total\{route="shorten_url"\} \d+'
+        )
+        self.assertIn("urlshortener_http_requests_in_flight 1", text)
+        self.assertIn("urlshortener_resolve_cache_hits_total", text)
+
+    def test_queries_on_every_database_are_counted(self):
+        databases = ConnectionHandler(
+            {
+                alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+                for alias in ["default", "replica1", "shard1"]
+            }
+        )
+        self.addCleanup(databases.close_all)
+
+        def view(request):
+            for alias in ["replica1", "shard1", "shard1"]:
+                with databases[alias].cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            return HttpResponse()
+
+        request = RequestFactory().get("/")
+        request.resolver_match = None
+        with mock.patch("urlshortenerapp.middleware.connections", databases):
+            MetricsMiddleware(view)(request)
+        text = self.metrics.render()
+        self.assertIn('urlshortener_db_queries_total{route="unmatched"} 3', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for seconds in [0.005, 0.05, 0.5, 5]:
+            self.metrics.observe_request("home", "GET", 200, seconds)
+        text = self.metrics.render()
+        for le, count in [("0.01", 1), ("0.1", 2), ("1", 3), ("+Inf", 4)]:
+            self.assertIn(
+                "urlshortener_http_request_duration_seconds_bucket"
+                f'{{route="home",le="{le}"}} {count}',
+                text,
+            )
+        self.assertIn(
+            'urlshortener_http_request_duration_seconds_sum{route="home"} 5.555', text
+        )
+
+    def test_workers_are_added_up(self):
+        self.metrics.observe_request("home", "GET", 200, 0.001)
+        other = Metrics(buckets=[0.01, 0.1, 1], directory=self.directory)
+        other.observe_request("home", "GET", 200, 0.001)
+        other.inc("http_requests_in_flight", value=2)
+        for pid, name in [(os.getppid(), "live"), (2**22 + 1, "exited")]:
+            snapshot = other.snapshot()
+            snapshot["pid"] = pid
+            with open(os.path.join(self.directory, f"metrics-{name}.json"), "w") as f:
+                json.dump(snapshot, f)
+        text = self.metrics.render()
+        self.assertIn(
+            'urlshortener_http_requests_total{route="home",method="GET",status="200"} 3',
+            text,
+        )
+        # Only the live worker's requests are still in flight
+        self.assertIn("urlshortener_http_requests_in_flight 2", text)
+
+
+class ReplicaRouterTests(TestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter(replicas=["replica1", "replica2"])
+        self.addCleanup(end_request, begin_request(pinned=False))
+
+    def test_reads_go_round_robin_to_replicas(self):
+        self.assertEqual(
+            [self.router.db_for_read(ShortenedURL) for _ in range(3)],
+            ["replica1", "replica2", "replica1"],
+        )
+        self.assertEqual(self.router.db_for_read(AccessLog), "replica2")
+        # Models outside the app, like sessions, stay on the primary
+        self.assertEqual(self.router.db_for_read(Session), "default")
+
+    def test_reads_follow_writes_to_the_primary(self):
+        self.assertEqual(self.router.db_for_write(ShortenedURL), "default")
+        self.assertEqual(self.router.db_for_read(ShortenedURL), "default")
+        with self.settings(REPLICA_PIN_SECONDS=0):
+            self.router.db_for_write(ShortenedURL)
+            self.assertEqual(self.router.db_for_read(ShortenedURL), "replica1")
+
+    def test_pin_cookie_pins_the_request(self):
+        token = begin_request(pinned=True)
+        self.addCleanup(end_request, token)
+        self.assertEqual(self.router.db_for_read(ShortenedURL), "default")
+
+    def test_writes_set_the_pin_cookie(self):
+        response = self.client.post(
+            "/shorten",
+            {"original_url": "https://example.com"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.cookies[PIN_COOKIE]["max-age"], 5)
+        response = self.client.get(reverse("home"))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+
+class ShardingTests(TestCase):
+    shards = ["default", "shard1", "shard2"]
+
+    def test_codes_spread_evenly_over_shards(self):
+        with self.settings(SHARD_DATABASES=self.shards):
+            counts = Counter(shard_for(f"code{i}") for i in range(3000))
+            self.assertEqual(shard_for("abc"), shard_for("abc"))
+        self.assertEqual(set(counts), set(self.shards))
+        self.assertTrue(all(count > 800 for count in counts.values()))
+
+    def test_instances_are_written_to_their_shard(self):
+        router = ShardRouter()
+        with self.settings(SHARD_DATABASES=self.shards):
+            codes = {shard_for(f"code{i}"): f"code{i}" for i in range(20)}
+            link = ShortenedURL(code=codes["shard2"])
+            self.assertEqual(router.db_for_write(ShortenedURL, instance=link), "shard2")
+            log = AccessLog(short_url=link)
+            self.assertEqual(router.db_for_write(AccessLog, instance=log), "shard2")
+            # "default" is left to ReplicaRouter
+            link = ShortenedURL(code=codes["default"])
+            self.assertIsNone(router.db_for_write(ShortenedURL, instance=link))
+
+    def test_codes_are_allocated_on_the_shard_of_the_digest(self):
+        with self.settings(SHARD_DATABASES=self.shards):
+            for i in range(10):
+                instance = ShortenedURLSerializer().build_instance(
+                    {"original_url": f"https://example.com/{i}"}
+                )
+                self.assertEqual(
+                    shard_for(instance.code), shard_for(instance.url_digest)
+                )
+
+    def test_all_shards_merges_rows_in_order(self):
+        now = timezone.now()
+        for i in range(3):
+            ShortenedURL.objects.create(
+                original_url=f"https://example.com/{i}",
+                code=f"merge{i}",
+                created_at=now,
+                expiration_at=now + timedelta(hours=1),
+            )
+        # The same database listed twice stands in for two shards
+        with self.settings(SHARD_DATABASES=["default", "default"]):
+            links = ShortenedURL.objects.all_shards().order_by("-code")
+            self.assertEqual(links.count(), 6)
+            self.assertEqual(
+                [link.code for link in links[1:4]], ["merge2", "merge1", "merge1"]
+            )
+            self.assertEqual(ShortenedURL.objects.count(), 3)
+
+
+# An empty shard to rebalance links to. Test databases are created once the
+# tests are loaded, so it gets one like "default".
+connections.settings.setdefault("spare", {**connections.settings["default"]})
+
+
+class ShardRebalanceTests(TestCase):
+    databases = {"default", "spare"}
+
+    def setUp(self):
+        with self.settings(SHARD_DATABASES=["default", "spare"]):
+            self.code = next(
+                f"move{i}" for i in range(100) if shard_for(f"move{i}") == "spare"
+            )
+        self.link = ShortenedURL.objects.create(
+            original_url="https://example.com", code=self.code
+        )
+        self.buffer = AccessLogBuffer(
+            max_size=100,
+            batch_size=100,
+            flush_interval=3600,
+            drop_policy=DROP_NEWEST,
+            spool_dir=tempfile.gettempdir(),
+        )
+        self.addCleanup(self.buffer.shutdown)
+
+    def visit(self, ip_address):
+        """A visit recorded by a worker that still uses the old shards."""
+        self.buffer.submit(self.link.pk, ip_address, "test", shard="default")
+        self.buffer.flush()
+        ShortenedURL.objects.filter(pk=self.link.pk).update(visits=F("visits") + 1)
+
+    def test_visits_between_copy_and_prune_are_kept(self):
+        self.visit("10.0.0.1")
+        self.visit("10.0.0.2")
+        with self.settings(SHARD_DATABASES=["default", "spare"]):
+            rebalancer = ShardRebalancer()
+            self.assertEqual(rebalancer.copy()["rows"], 5)
+            self.visit("10.0.0.3")
+            self.assertEqual(rebalancer.prune()["caught_up"], 1)
+            self.assertEqual(rebalancer.prune()["links"], 0)
+        copy = ShortenedURL.objects.using("spare").get(code=self.code)
+        self.assertEqual(copy.visits, 3)
+        self.assertEqual(
+            sorted(
+                AccessLog.objects.using("spare").values_list("ip_address", flat=True)
+            ),
+            ["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+        )
+        rollup = DailyClickRollup.objects.using("spare").get()
+        self.assertEqual((rollup.clicks, rollup.unique_ips), (3, 3))
+        sketch = VisitorSketch.objects.using("spare").get()
+        self.assertEqual(sketch.unique_visitors, 3)
+        self.assertFalse(ShortenedURL.objects.filter(code=self.code).exists())
+        self.assertFalse(LinkCopy.objects.using("spare").exists())
+
+
+class AccessLogCompactionTests(TestCase):
+
+    def setUp(self):
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com", code="compact"
+        )
+        self.now = timezone.now()
+        old = self.now - timedelta(days=200)
+        ages = [old, old, old - timedelta(days=40), self.now - timedelta(hours=1)]
+        ages += [self.now - timedelta(hours=2), old + timedelta(seconds=1)]
+        AccessLog.objects.bulk_create(
+            AccessLog(
+                short_url=self.shortened_url,
+                ip_address=f"10.0.0.{i % 3}",
+                user_agent=f"agent {i % 2} \u2603",
+                referrer="https://ref.example.com" if i % 2 else "",
+                accessed_at=accessed_at,
+            )
+            for i, accessed_at in enumerate(ages)
+        )
+        self.compactor = AccessLogCompactor(retention_days=90, segment_rows=2)
+
+    def test_segments_round_trip(self):
+        rows = list(
+            AccessLog.objects.order_by("accessed_at", "id").values_list(
+                "id", "accessed_at", "ip_address", "user_agent", "referrer"
+            )
+        )
+        data = encode(rows)
+        self.assertEqual(
+            [tuple(row.values()) for row in decode(data)],
+            [tuple(row) for row in rows],
+        )
+        self.assertEqual(
+            value_counts(data, "ip_address"),
+            {"10.0.0.0": 2, "10.0.0.1": 2, "10.0.0.2": 2},
+        )
+
+    def test_old_months_are_compacted(self):
+        run = self.compactor.compact(now=self.now)
+        self.assertEqual(run["logs"], 4)
+        self.assertEqual(AccessLog.objects.count(), 2)
+        segments = AccessLogSegment.objects.all()
+        self.assertEqual(sum(segment.count for segment in segments), 4)
+        # Two months, one of them split in two segments of at most 2 logs
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(self.compactor.compact(now=self.now)["logs"], 0)
+
+    def test_analytics_read_compacted_logs(self):
+        expected = self.client.get("/analytics/compact", {"aggregate": "day"}).json()
+        self.compactor.compact(now=self.now)
+
+        seen = []
+        cursor = ""
+        while cursor is not None:
+            data = self.client.get(
+                "/analytics/compact", {"limit": 2, "cursor": cursor}
+            ).json()
+            seen.extend(data["logs"])
+            cursor = data["next_cursor"]
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(
+            [log["accessed_at"] for log in seen],
+            sorted((log["accessed_at"] for log in seen), reverse=True),
+        )
+        response = self.client.get("/analytics/compact", {"stream": "1"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], seen)
+
+        data = self.client.get("/analytics/compact", {"aggregate": "day"}).json()
+        self.assertEqual(data["top_ips"], expected["top_ips"])
+        self.assertEqual(data["top_user_agents"], expected["top_user_agents"])
+
+    def test_backfill_reads_compacted_logs(self):
+        self.compactor.compact(now=self.now)
+        call_command("backfill_rollups", stdout=StringIO())
+        self.assertEqual(
+            sum(DailyClickRollup.objects.values_list("clicks", flat=True)), 6
+        )
+
+
+class LinkImportTests(WriteThroughMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        ShortenedURL.objects.create(
+            original_url="https://old.example.com", code="taken"
+        )
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def import_links(self, path, *args):
+        stdout = StringIO()
+        call_command("import_links", path, *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def test_import_csv(self):
+        path = self.write(
+            "links.csv",
+            "original_url,code,expiration_at\n"
+            "HTTPS://Example.COM/Path,abc,2030-01-01T00:00:00Z\n"
+            "https://example.org,def,\n"
+            "not a url,ghi,\n"
+            "https://example.net,taken,\n"
+            "https://example.net,bad code!,\n",
+        )
+        rejects = os.path.join(self.directory, "rejects.ndjson")
+        output = self.import_links(path, "--batch-size", "2", "--rejects", rejects)
+        self.assertIn("Imported 2 links from 5 records", output)
+
+        link = ShortenedURL.objects.get(code="abc")
+        self.assertEqual(link.original_url, "https://example.com/Path")
+        self.assertEqual(link.expiration_at.year, 2030)
+        self.assertIsNone(ShortenedURL.objects.get(code="def").expiration_at)
+        self.assertEqual(
+            ShortenedURL.objects.get(code="taken").original_url,
+            "https://old.example.com",
+        )
+        with open(rejects) as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual([reject["record"] for reject in rejected], [2, 4])
+        response = self.client.get("/abc/")
+        self.assertEqual(response["Location"], "https://example.com/Path")
+
+    def test_impossible_dates_are_rejected(self):
+        path = self.write(
+            "links.csv",
+            "original_url,code,expiration_at\n"
+            "https://example.com,good1,2030-01-01T00:00:00Z\n"
+            "https://example.com,bad1,2030-02-30T00:00:00\n"
+            "https://example.com,bad2,1e20\n"
+            "https://example.com,good2,\n",
+        )
+        rejects = os.path.join(self.directory, "rejects.ndjson")
+        output = self.import_links(path, "--rejects", rejects)
+        self.assertIn("Imported 2 links from 4 records", output)
+        self.assertEqual(
+            set(
+                ShortenedURL.objects.filter(code__startswith="good").values_list(
+                    "code", flat=True
+                )
+            ),
+            {"good1", "good2"},
+        )
+        with open(rejects) as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual([reject["record"] for reject in rejected], [1, 2])
+        self.assertIn("expiration_at is not a valid timestamp", rejected[0]["error"])
+
+    def test_non_string_fields_are_rejected(self):
+        path = self.write(
+            "links.ndjson",
+            '{"original_url": "https://example.com", "code": 12345}\n'
+            '{"original_url": ["https://example.com"], "code": "bad2"}\n'
+            '{"original_url": "https://example.com", "code": "good1"}\n',
+        )
+        rejects = os.path.join(self.directory, "rejects.ndjson")
+        output = self.import_links(path, "--rejects", rejects)
+        self.assertIn("Imported 1 links from 3 records", output)
+        with open(rejects) as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual([reject["record"] for reject in rejected], [0, 1])
+        self.assertIn("code is not a string", rejected[0]["error"])
+        self.assertIn("original_url is not a string", rejected[1]["error"])
+
+    def test_import_ndjson_with_default_expiry(self):
+        path = self.write(
+            "links.ndjson",
+            '{"original_url": "https://example.com", "code": "nd1"}\n'
+            "{not json\n"
+            '{"original_url": "https://example.org", "code": "nd2"}\n',
+        )
+        self.import_links(path, "--default-hours", "48")
+        link = ShortenedURL.objects.get(code="nd2")
+        self.assertGreater(link.expiration_at, timezone.now() + timedelta(hours=47))
+        self.assertEqual(ShortenedURL.objects.filter(code__startswith="nd").count(), 2)
+
+    def test_resume_from_checkpoint(self):
+        lines = [f"https://example.com/{i},r{i}" for i in range(10)]
+        path = self.write("links.csv", "original_url,code\n" + "\n".join(lines))
+        importer = LinkImporter(batch_size=4)
+        batches = importer.run(
+            [
+                {"original_url": url, "code": code}
+                for url, code in (line.split(",") for line in lines)
+            ]
+        )
+        # Interrupted after the first batch
+        checkpoint = next(batches)
+        batches.close()
+        self.assertEqual(checkpoint["inserted"], 4)
+        with open(f"{path}.checkpoint", "w") as f:
+            json.dump(checkpoint, f)
+        ShortenedURL.objects.filter(code="r0").delete()
+
+        output = self.import_links(path, "--batch-size", "4")
+        self.assertIn("Resuming after record 4", output)
+        self.assertIn("Imported 10 links from 10 records", output)
+        # Records before the checkpoint are not read again
+        self.assertFalse(ShortenedURL.objects.filter(code="r0").exists())
+        self.assertEqual(ShortenedURL.objects.filter(code__startswith="r").count(), 9)
+
+        self.import_links(path, "--restart")
+        self.assertTrue(ShortenedURL.objects.filter(code="r0").exists())
+
+    def test_secondary_indexes(self):
+        indexes = secondary_indexes("default")
+        self.assertIn(["expiration_at"], [index.fields for index in indexes])
+        # Unique constraints are kept, they reject duplicate codes
+        self.assertNotIn(["code"], [index.fields for index in indexes])
+
+
+class AccessLogExportTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.links = [
+            ShortenedURL.objects.create(original_url="https://example.com", code=code)
+            for code in ["exp1", "exp2"]
+        ]
+        AccessLog.objects.bulk_create(
+            AccessLog(
+                short_url=self.links[i % 2],
+                ip_address=f"10.0.0.{i}",
+                user_agent='agent, "quoted"',
+                referrer="",
+                accessed_at=self.now - timedelta(days=days),
+            )
+            for i, days in enumerate([1, 2, 3, 200, 201])
+        )
+        # The two oldest logs move to segments
+        AccessLogCompactor(retention_days=90, segment_rows=10).compact(now=self.now)
+
+    def export(self, **params):
+        response = self.client.get("/export", params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def test_export_link_as_csv(self):
+        rows = list(csv.DictReader(self.export(code="exp1").decode().splitlines()))
+        self.assertEqual(
+            [row["ip_address"] for row in rows], ["10.0.0.4", "10.0.0.2", "10.0.0.0"]
+        )
+        self.assertEqual({row["code"] for row in rows}, {"exp1"})
+        self.assertEqual(rows[0]["user_agent"], 'agent, "quoted"')
+
+        since = (self.now - timedelta(days=2, hours=12)).isoformat()
+        rows = list(
+            csv.DictReader(
+                self.export(code="exp1", **{"from": since}).decode().splitlines()
+            )
+        )
+        self.assertEqual([row["ip_address"] for row in rows], ["10.0.0.0"])
+
+    def test_export_gzip_and_ndjson(self):
+        plain = self.export(code="exp2", output="ndjson")
+        self.assertEqual(
+            gzip.decompress(self.export(code="exp2", output="ndjson", gzip="1")), plain
+        )
+        rows = [json.loads(line) for line in plain.decode().splitlines()]
+        self.assertEqual([row["ip_address"] for row in rows], ["10.0.0.3", "10.0.0.1"])
+
+    def test_export_every_link_requires_staff(self):
+        self.assertEqual(self.client.get("/export").status_code, 403)
+        self.assertEqual(self.client.get("/export", {"code": "nope"}).status_code, 404)
+        staff = User.objects.create_user("staff", password="secret", is_staff=True)
+        self.client.force_login(staff)
+        rows = list(csv.DictReader(self.export().decode().splitlines()))
+        self.assertEqual(len(rows), 5)
+
+    def test_export_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "logs.ndjson.gz")
+        until = (self.now - timedelta(days=100)).date().isoformat()
+        call_command(
+            "export_access_logs",
+            "--format",
+            "ndjson",
+            "--to",
+            until,
+            "--output",
+            path,
+            stdout=StringIO(),
+        )
+        with gzip.open(path, "rt") as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(sorted(row["code"] for row in rows), ["exp1", "exp2"])
+
+
+class CacheableRedirectTests(WriteThroughMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shortened_url = ShortenedURL.objects.create(
+            original_url="https://example.com",
+            code="cached",
+            expiration_at=timezone.now() + timedelta(seconds=100),
+            redirect_type=301,
+        )
+
+    def test_redirects_are_not_cached_by_default(self):
+        response = self.client.get("/cached/")
+        self.assertEqual(response.status_code, status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(response["Location"], "https://example.com")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+        response = self.client.get("/cached/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 2)
+
+    @override_settings(REDIRECT_MAX_AGE=3600)
+    def test_max_age_is_bounded_by_expiry(self):
+        max_age = self.client.get("/cached/")["Cache-Control"]
+        self.assertRegex(max_age, r"^public, max-age=(100|99)$")
+
+        ShortenedURL.objects.create(
+            original_url="https://example.com", code="forever", expiration_at=None
+        )
+        response = self.client.get("/forever/")
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response["Cache-Control"], "public, max-age=3600")
+
+        ShortenedURL.objects.create(
+            original_url="https://example.com", code="secret", password="pw"
+        )
+        response = self.client.get("/secret/", {"password": "pw"})
+        self.assertEqual(response["Cache-Control"], "private, no-store")
+
+    def test_redirect_type_is_a_shortening_option(self):
+        data = {"original_url": "https://example.org", "redirect_type": 308}
+        permanent = self.client.post("/shorten", data, content_type="application/json")
+        self.assertEqual(permanent.json()["redirect_type"], 308)
+        temporary = self.client.post(
+            "/shorten",
+            {"original_url": "https://example.org"},
+            content_type="application/json",
+        )
+        self.assertEqual(temporary.json()["redirect_type"], 302)
+        self.assertNotEqual(permanent.json()["code"], temporary.json()["code"])
+        self.assertEqual(
+            self.client.get(f"/{permanent.json()['code']}/").status_code,
+            status.HTTP_308_PERMANENT_REDIRECT,
+        )
+
+    def test_import_edge_logs(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "edge.csv")
+        with open(path, "w") as f:
+            f.write(
+                "path,accessed_at,ip_address,user_agent,referrer,cache_status\n"
+                "/cached/,2025-03-01T10:00:00Z,10.0.0.1,agent,,HIT\n"
+                "/cached/?utm=x,1740823200,10.0.0.2,agent,,hit\n"
+                "/cached/,2025-03-01T10:00:00Z,10.0.0.3,agent,,MISS\n"
+                "/gone/,2025-03-01T10:00:00Z,10.0.0.4,agent,,HIT\n"
+                "/cached/,yesterday,10.0.0.5,agent,,HIT\n"
+            )
+        stdout = StringIO()
+        call_command("import_edge_logs", path, stdout=stdout)
+        self.assertIn("Recorded 2 cached visits from 5 records", stdout.getvalue())
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 2)
+        logs = AccessLog.objects.filter(short_url=self.shortened_url)
+        self.assertEqual(
+            sorted(log.accessed_at.isoformat() for log in logs),
+            ["2025-03-01T10:00:00+00:00"] * 2,
+        )
+        self.assertEqual(
+            HourlyClickRollup.objects.get(short_url=self.shortened_url).clicks, 2
+        )
+
+        # Already imported
+        call_command("import_edge_logs", path, stdout=StringIO())
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 2)
+
+    def test_corrupt_edge_log_timestamps_are_rejected(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "edge.ndjson")
+        rejects = os.path.join(directory, "rejects.ndjson")
+        with open(path, "w") as f:
+            for accessed_at in [
+                "2025-02-30T10:00:00Z",
+                1e300,
+                "2025-03-01T10:00:00Z",
+            ]:
+                record = {
+                    "path": "/cached/",
+                    "accessed_at": accessed_at,
+                    "ip_address": "10.0.0.1",
+                    "cache_status": "HIT",
+                }
+                f.write(json.dumps(record) + "\n")
+        call_command("import_edge_logs", path, rejects=rejects, stdout=StringIO())
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 1)
+        with open(rejects) as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual([reject["record"] for reject in rejected], [0, 1])
+
+    def test_non_string_edge_log_codes_are_rejected(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "edge.ndjson")
+        rejects = os.path.join(directory, "rejects.ndjson")
+        with open(path, "w") as f:
+            for record in [
+                {"code": 12345},
+                {"path": ["/cached/"]},
+                {"code": "cached", "user_agent": {"name": "bot"}},
+                {"code": "cached"},
+            ]:
+                record.update(accessed_at="2025-03-01T10:00:00Z", cache_status="HIT")
+                f.write(json.dumps(record) + "\n")
+        call_command("import_edge_logs", path, rejects=rejects, stdout=StringIO())
+        self.shortened_url.refresh_from_db()
+        self.assertEqual(self.shortened_url.visits, 1)
+        with open(rejects) as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual([reject["record"] for reject in rejected], [0, 1, 2])
+        self.assertIn("code is not a string", rejected[0]["error"])
+
+
+class SharedTableTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "links.table")
+
+    def test_get_set_delete(self):
+        table = SharedTable(self.path, slots=16, arena_bytes=4096)
+        self.assertIsNone(table.get(b"a"))
+        table.set(b"a", b"1")
+        table.set(b"b", b"2", expires=time.time() - 1)
+        table.set(b"a", b"3")
+        self.assertEqual(table.get(b"a"), b"3")
+        self.assertIsNone(table.get(b"b"))
+        self.assertTrue(table.delete(b"a"))
+        self.assertIsNone(table.get(b"a"))
+        self.assertFalse(table.set(b"big", b"x" * 4096))
+
+    def test_other_processes_see_writes(self):
+        table = SharedTable(self.path, slots=16, arena_bytes=4096)
+        table.set(b"mine", b"1")
+        script = (
+            "import sys; from urlshortenerapp.sharedtable import SharedTable; "
+            "t = SharedTable(sys.argv[1]); "
+            "assert t.get(b'mine') == b'1'; "
+            "[t.set(b'k%d' % i, b'v' * 100) for i in range(100)]"
+        )
+        subprocess.run(
+            [sys.executable, "-c", script, self.path],
+            check=True,
+            cwd=settings.BASE_DIR,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": "urlshortener.settings"},
+        )
+        # The other process rebuilt the table, more than once
+        self.assertEqual(table.get(b"k99"), b"v" * 100)
+        self.assertLessEqual(table.stats()["slots_used"], 16 * 0.7)
+
+    def test_rebuild_keeps_entries_expiring_last(self):
+        table = SharedTable(self.path, slots=16, arena_bytes=1 << 16)
+        now = time.time()
+        for i in range(11):
+            table.set(b"k%d" % i, b"v", expires=now + 100 + i)
+        table.set(b"last", b"v", expires=now + 1000)
+        self.assertEqual(table.rebuilds, 1)
+        self.assertIsNone(table.get(b"k0"))
+        self.assertEqual(table.get(b"k10"), b"v")
+        self.assertEqual(table.get(b"last"), b"v")
+
+    def test_cache_backend(self):
+        cache = SharedMemoryCache(self.path, {"OPTIONS": {"SLOTS": 64}})
+        cache.set("key", {"a": 1})
+        self.assertEqual(cache.get("key"), {"a": 1})
+        self.assertFalse(cache.add("key", 2))
+        self.assertTrue(cache.add("other", 2))
+        self.assertEqual(cache.incr("other"), 3)
+        cache.set("gone", 1, timeout=0)
+        self.assertFalse(cache.has_key("gone"))
+        # Another thread's backend instance shares the table
+        self.assertEqual(SharedMemoryCache(self.path, {}).get("other"), 3)
+        cache.clear()
+        self.assertIsNone(cache.get("key"))
+
+    def test_workers_share_loaded_links(self):
+        link = ShortenedURL.objects.create(
+            original_url="https://example.com", code="shared"
+        )
+        caches = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "links": {
+                "BACKEND": "urlshortenerapp.sharedtable.SharedMemoryCache",
+                "LOCATION": self.path,
+            },
+        }
+        with override_settings(CACHES=caches):
+            first = ResolveCache(max_entries=10, ttl=60, shared="links")
+            second = ResolveCache(max_entries=10, ttl=60, shared="links")
+            first.resolve("shared")
+            with self.assertNumQueries(0):
+                self.assertEqual(second.resolve("shared").pk, link.pk)
+            self.assertEqual(second.shared_hits, 1)
+
+            first.invalidate("shared")
+            second.clear()
+            self.assertIsNone(second.get_shared("shared"))
+
+
+class StartupTests(WriteThroughMixin, TestCase):
+
+    def loaded_modules(self, modules, profile="full"):
+        """Which of `modules` a fresh process imports to route a visit."""
+        script = (
+            "import sys, django; django.setup(); "
+            "from django.urls import resolve; resolve('/abc/'); "
+            "print(' '.join(str(name in sys.modules) for name in sys.argv[1:]))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", script, *modules],
+            check=True,
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            env={
+                **os.environ,
+                "DJANGO_SETTINGS_MODULE": "urlshortener.settings",
+                "SERVER_PROFILE": profile,
+            },
+        ).stdout
+        return dict(zip(modules, [value == "True" for value in output.split()]))
+
+    def test_swagger_and_admin_load_on_first_request(self):
+        modules = ["drf_yasg.openapi", "urlshortenerapp.admin", "rest_framework"]
+        self.assertEqual(
+            self.loaded_modules(modules),
+            {
+                "drf_yasg.openapi": False,
+                "urlshortenerapp.admin": False,
+                "rest_framework": True,
+            },
+        )
+        self.assertFalse(
+            self.loaded_modules(modules, profile="redirect")["rest_framework"]
+        )
+
+        response = self.client.get("/swagger/", {"format": "openapi"})
+        self.assertEqual(response.status_code, 200)
+        schema = json.loads(response.content)
+        parameters = schema["paths"]["/analytics/{short_url}"]["get"]["parameters"]
+        self.assertIn("cursor", [parameter["name"] for parameter in parameters])
+        self.assertIn("201", schema["paths"]["/shorten"]["post"]["responses"])
+
+        response = self.client.get("/admin/urlshortenerapp/shortenedurl/")
+        self.assertRedirects(
+            response,
+            "/admin/login/?next=/admin/urlshortenerapp/shortenedurl/",
+            fetch_redirect_response=False,
+        )
+
+    @override_settings(ROOT_URLCONF="urlshortener.redirect_urls")
+    def test_redirect_profile_only_serves_visits_and_metrics(self):
+        ShortenedURL.objects.create(original_url="https://example.com", code="slim1")
+        response = self.client.head("/slim1/")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "https://example.com")
+        self.assertEqual(ShortenedURL.objects.get(code="slim1").visits, 1)
+        self.assertEqual(self.client.get("/unknown/").status_code, 404)
+        self.assertEqual(self.client.post("/slim1/").status_code, 405)
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        for path in ["/shorten", "/export", "/analytics/slim1"]:
+            with self.assertRaises(Resolver404):
+                resolve(path)
+
+
+class RateLimitTests(WriteThroughMixin, TestCase):
+
+    def test_token_bucket(self):
+        limiter = RateLimiter({"route": (2, 3)})
+        for _ in range(3):
+            self.assertEqual(limiter.check("route", "a", now=100), 0)
+        self.assertEqual(limiter.check("route", "a", now=100), 0.5)
+        self.assertEqual(limiter.check("route", "a", now=100.25), 0.25)
+        self.assertEqual(limiter.check("route", "a", now=100.5), 0)
+        self.assertEqual(limiter.check("route", "b", now=100.5), 0)
+        self.assertEqual(limiter.check("other", "a", now=100.5), 0)
+        self.assertEqual(limiter.stats()["limited"], 2)
+
+    def test_sweep_forgets_full_buckets(self):
+        limiter = RateLimiter({"route": (1, 5)}, sweep_interval=60, max_clients=2)
+        limiter.check("route", "a", now=100)
+        limiter.check("route", "b", now=100)
+        limiter.check("route", "a", now=100.2)
+        # No bucket is full yet, the least recently seen client makes room
+        self.assertEqual(limiter.check("route", "c", now=100.5), 0)
+        self.assertEqual(limiter.stats()["evicted"], 1)
+        self.assertEqual(list(limiter._routes["route"][2]), ["a", "c"])
+        # Full tables are swept at most once a second
+        limiter.check("route", "d", now=100.9)
+        self.assertEqual(limiter.stats()["sweeps"], 1)
+        self.assertEqual(limiter.stats()["evicted"], 2)
+        # The buckets of "c" and "d" are full at 101.9
+        self.assertEqual(limiter.check("route", "e", now=102), 0)
+        self.assertEqual(limiter.stats()["clients"], 1)
+        self.assertEqual(limiter.stats()["evicted"], 2)
+        self.assertEqual(limiter.sweep(now=1000), 1)
+        self.assertEqual(limiter.stats()["clients"], 0)
+
+    def test_clients_spraying_new_ones_stay_limited(self):
+        limiter = RateLimiter({"route": (1, 1)}, max_clients=10)
+        self.assertEqual(limiter.check("route", "a", now=100), 0)
+        for i in range(100):
+            limiter.check("route", f"spray{i}", now=100)
+            self.assertGreater(limiter.check("route", "a", now=100), 0)
+
+    def test_views_answer_429(self):
+        limiter = RateLimiter(
+            {"shorten_url": (0.1, 1), "visit_shortened_url": (1, 1)},
+            key_header="X-Api-Key",
+            api_keys=["k1"],
+        )
+        with mock.patch("urlshortenerapp.middleware.rate_limiter", limiter):
+            data = {"original_url": "https://example.com"}
+            response = self.client.post("/shorten", data, "application/json")
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post("/shorten", data, "application/json")
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], "10")
+            # Unknown keys are not clients of their own
+            response = self.client.post(
+                "/shorten", data, "application/json", HTTP_X_API_KEY="forged"
+            )
+            self.assertEqual(response.status_code, 429)
+            response = self.client.post(
+                "/shorten", data, "application/json", HTTP_X_API_KEY="k1"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # Routes without a limit are not counted
+            for _ in range(3):
+                self.assertEqual(self.client.get("/metrics").status_code, 200)
+            code = response.json()["short_url"].rstrip("/").rsplit("/", 1)[-1]
+            self.assertEqual(self.client.get(f"/{code}/").status_code, 302)
+            self.assertEqual(self.client.get(f"/{code}/").status_code, 429)
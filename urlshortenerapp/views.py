@@ -1,19 +1,31 @@
+import json
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.forms.models import model_to_dict
-from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, render
 from django.views.decorators.csrf import csrf_exempt
-from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 
-from .models import AccessLog, ShortenedURL
+from . import analytics as analytics_service
+from . import exports
+from .counters import visit_counter
+from .models import CodeTaken, ShortenedURL
 from .serializers import ShortenedURLSerializer
+from .visits import VisitDenied, record_visit, redirect_response, resolve_visit
 
 
-@swagger_auto_schema(method="GET", responses={200: "OK"})
 @api_view(["GET"])
 def home(request):
     return render(request, "urlshortenerapp/home.html")
@@ -21,16 +33,6 @@ def home(request):
 
 # POST request to create a new shortened URL
 @csrf_exempt
-@swagger_auto_schema(
-    method="POST",
-    request_body=ShortenedURLSerializer,
-    responses={
-        201: "Created",
-        400: "Bad Request",
-        422: "Unprocessable Entity",
-        500: "Internal Server Error",
-    },
-)
 @api_view(["POST"])
 def shorten_url(request):
     try:
@@ -38,12 +40,22 @@ def shorten_url(request):
             # Deserialize the request data using ShortenedURLSerializer
             serializer = ShortenedURLSerializer(data=request.data)
             if serializer.is_valid():
-                shortened_url = serializer.create(serializer.validated_data)
-                response = model_to_dict(shortened_url, exclude=["id", "password"])
-                response.update({"created_at": shortened_url.created_at})
+                shortened_url, created = serializer.create_or_fetch(
+                    serializer.validated_data
+                )
+                response = model_to_dict(
+                    shortened_url, exclude=["id", "password", "url_digest"]
+                )
+                response.update(
+                    {
+                        "short_url": shortened_url.short_url,
+                        "created_at": shortened_url.created_at,
+                    }
+                )
+                # Shortening the same URL with the same options is idempotent
                 return JsonResponse(
                     response,
-                    status=status.HTTP_201_CREATED,
+                    status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
                 )
 
             else:
@@ -51,6 +63,73 @@ def shorten_url(request):
                     serializer.errors, status=status.HTTP_400_BAD_REQUEST
                 )
 
+    except ValidationError as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    except CodeTaken as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+    except Exception as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def iter_ndjson(stream):
+    """Yield one decoded item per non-empty line, None for malformed lines."""
+    for line in stream or ():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def bulk_shorten_results(items):
+    """Create the items in batches and yield one NDJSON result line per item."""
+    batch_size = settings.BULK_SHORTEN_BATCH_SIZE
+    batch = []
+    offset = 0
+    for item in items:
+        batch.append(item)
+        if len(batch) < batch_size:
+            continue
+        yield from _encode_bulk_results(batch, offset)
+        offset += len(batch)
+        batch = []
+    if batch:
+        yield from _encode_bulk_results(batch, offset)
+
+
+def _encode_bulk_results(batch, offset):
+    results = ShortenedURLSerializer.create_many(batch)
+    for index, result in enumerate(results, start=offset):
+        yield json.dumps({"index": index, **result}, cls=DjangoJSONEncoder) + "\n"
+
+
+# POST request to create many shortened URLs at once
+@csrf_exempt
+@api_view(["POST"])
+def shorten_url_bulk(request):
+    try:
+        # NDJSON bodies are read line by line while results are streamed back
+        if request.content_type == NDJSON_CONTENT_TYPE:
+            items = iter_ndjson(request.stream)
+        else:
+            items = request.data
+            if not isinstance(items, list):
+                raise ValidationError("Expected a JSON array or an NDJSON body.")
+        return StreamingHttpResponse(
+            bulk_shorten_results(items), content_type=NDJSON_CONTENT_TYPE
+        )
+
+    except ParseError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except ValidationError as e:
         return JsonResponse(
             {"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY
@@ -71,46 +150,21 @@ def log_access_to_url(request, shortened_url):
     # Fetch the user's IP address
     ip_address = request.META.get("REMOTE_ADDR", "")
     user_agent = request.META.get("HTTP_USER_AGENT", "")
+    referrer = request.META.get("HTTP_REFERER", "")
 
-    # save access log entry
-    AccessLog.objects.create(
-        short_url=shortened_url, ip_address=ip_address, user_agent=user_agent
-    )
+    # Count the visit and queue the access log, both written in batches
+    record_visit(shortened_url, ip_address, user_agent, referrer)
 
 
-# GET request to visit the shortened URL
+# GET request to visit the shortened URL. Production traffic is normally
+# answered by urlshortenerapp.fastpath.RedirectApp before reaching Django, this
+# view serves swagger and anything the fast path passes through.
 @csrf_exempt
-@swagger_auto_schema(
-    method="GET",
-    responses={
-        200: "Success",
-        301: "Redirect",
-        302: "Redirect",
-        404: "Not Found",
-        403: "Forbidden",
-    },
-)
 @api_view(["GET"])
 def visit_shortened_url(request, short_url):
     try:
-        short_url = settings.BASE_URL + "/" + short_url
-        ShortenedURLSerializer.validate_url(short_url)
-        shortened_url = get_object_or_404(ShortenedURL, short_url=short_url)
-        if shortened_url.is_expired():
-            return JsonResponse(
-                {"error": "This URL has expired, Please create a new shortened URL"},
-                status=status.HTTP_403_FORBIDDEN,
-            )
-        # If the URL has a password, check if the user has provided the correct password
-        if shortened_url.password:
-            entered_password = request.GET.get("password")
-            if not entered_password or entered_password != shortened_url.password:
-                return JsonResponse(
-                    {"error": "Password required or incorrect password"}, status=403
-                )
-        # Update the access count
-        shortened_url.update_visits()
-        # Log the access
+        # Served from the per-worker resolve cache, hits skip the database
+        shortened_url = resolve_visit(short_url, request.GET.get("password"))
         log_access_to_url(request, shortened_url)
         user_agent = request.headers.get("Referer", "")
         if "swagger" in user_agent:
@@ -122,48 +176,95 @@ def visit_shortened_url(request, short_url):
                 },
                 status=status.HTTP_200_OK,
             )
-        return HttpResponseRedirect(shortened_url.original_url)
-    except Http404:
-        return JsonResponse(
-            {"error": "Shortened URL not found"}, status=status.HTTP_404_NOT_FOUND
-        )
-    except ValidationError as e:
-        return JsonResponse(
-            {"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        status_code, headers = redirect_response(
+            shortened_url, request.headers.get("If-None-Match", "")
         )
+        return HttpResponse(status=status_code, headers=dict(headers))
+    except VisitDenied as e:
+        return JsonResponse({"error": e.error}, status=e.status)
     except Exception as e:
         return JsonResponse(
             {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
 
+def parse_datetime_param(request, name):
+    """Parse an optional ISO 8601 query parameter, assuming UTC if naive."""
+    return exports.parse_bound(request.GET.get(name), name)
+
+
+ANALYTICS_PAGE_SIZE = 100
+
+ANALYTICS_MAX_PAGE_SIZE = 1000
+
+
 # GET request to view the analytics of the shortened URL
 @csrf_exempt
-@swagger_auto_schema(
-    method="GET",
-    responses={200: "Analytics Data", 404: "Not Found", 500: "Internal Server Error"},
-)
 @api_view(["GET"])
 def analytics(request, short_url):
     try:
-        ShortenedURLSerializer.validate_url(short_url)
-        shortened_url = get_object_or_404(ShortenedURL, short_url=short_url)
-        # Gather analytics data
-        access_logs = AccessLog.objects.filter(short_url=shortened_url)
-        logs = [
-            {"ip_address": log.ip_address, "accessed_at": log.accessed_at}
-            for log in access_logs
-        ]
+        # Accept the full short URL as well as the bare code
+        code = ShortenedURL.code_from_short_url(short_url)
+        ShortenedURLSerializer.validate_code(code)
+        shortened_url = get_object_or_404(
+            ShortenedURL.objects.for_code(code), code=code
+        )
 
-        return JsonResponse(
-            {
-                "original_url": shortened_url.original_url,
-                "short_url": shortened_url.short_url,
-                "access_count": shortened_url.visits,
-                "logs": logs,
-            },
-            status=status.HTTP_200_OK,
+        # Streaming mode keeps memory flat however many logs the link has
+        if request.GET.get("stream") in ("1", "true"):
+            return StreamingHttpResponse(
+                analytics_service.stream_logs(shortened_url),
+                content_type=NDJSON_CONTENT_TYPE,
+            )
+
+        try:
+            limit = int(request.GET.get("limit", ANALYTICS_PAGE_SIZE))
+        except ValueError:
+            raise ValidationError("limit must be an integer.")
+        limit = max(1, min(limit, ANALYTICS_MAX_PAGE_SIZE))
+        logs, next_cursor = analytics_service.paginate_logs(
+            shortened_url, request.GET.get("cursor"), limit
         )
+        data = {
+            "original_url": shortened_url.original_url,
+            "short_url": shortened_url.short_url,
+            "access_count": shortened_url.visits
+            + visit_counter.pending(shortened_url.code),
+            "unique_visitors": analytics_service.unique_visitors(shortened_url),
+            "logs": logs,
+            "next_cursor": next_cursor,
+        }
+
+        granularity = request.GET.get("aggregate")
+        if granularity:
+            buckets = analytics_service.clicks_per_bucket(
+                shortened_url,
+                granularity,
+                parse_datetime_param(request, "from"),
+                parse_datetime_param(request, "to"),
+            )
+            data.update(
+                {
+                    "clicks": [
+                        {
+                            "bucket": bucket["bucket"],
+                            "clicks": bucket["clicks"],
+                            "unique_ips": bucket["unique_ips"],
+                        }
+                        for bucket in buckets
+                    ],
+                    "unique_ips": analytics_service.unique_ips(buckets),
+                    "top_referrers": analytics_service.top_referrers(buckets),
+                    "top_ips": analytics_service.top_values(
+                        shortened_url, "ip_address"
+                    ),
+                    "top_user_agents": analytics_service.top_values(
+                        shortened_url, "user_agent"
+                    ),
+                }
+            )
+
+        return JsonResponse(data, status=status.HTTP_200_OK)
     except Http404:
         return JsonResponse(
             {"error": "Shortened URL not found"}, status=status.HTTP_404_NOT_FOUND
@@ -176,3 +277,49 @@ def analytics(request, short_url):
         return JsonResponse(
             {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+
+# GET request exporting raw access logs, of one link or, for staff, all links
+@csrf_exempt
+@api_view(["GET"])
+def export_access_logs(request):
+    try:
+        code = request.GET.get("code")
+        if code:
+            code = ShortenedURL.code_from_short_url(code)
+            ShortenedURLSerializer.validate_code(code)
+            get_object_or_404(ShortenedURL.objects.for_code(code), code=code)
+        elif not request.user.is_staff:
+            return JsonResponse(
+                {"error": "Exporting every link requires a staff account."},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        # Not "format", which DRF's content negotiation takes
+        format = request.GET.get("output", "csv")
+        compress = request.GET.get("gzip") in ("1", "true")
+        chunks = exports.export(
+            parse_datetime_param(request, "from"),
+            parse_datetime_param(request, "to"),
+            code,
+            format,
+            compress,
+        )
+        filename = f"access-logs-{code or 'all'}.{format}"
+        response = StreamingHttpResponse(
+            chunks,
+            content_type=(
+                "application/gzip" if compress else exports.CONTENT_TYPES[format]
+            ),
+        )
+        if compress:
+            filename += ".gz"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+    except Http404:
+        return JsonResponse(
+            {"error": "Shortened URL not found"}, status=status.HTTP_404_NOT_FOUND
+        )
+    except ValidationError as e:
+        return JsonResponse(
+            {"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
@@ -0,0 +1,123 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404
+from django.utils import timezone
+from django.utils.encoding import iri_to_uri
+from django.utils.http import parse_etags
+
+from .accesslogs import access_log_buffer
+from .cache import resolve_cache
+from .counters import visit_counter
+from .models import SHORT_CODE_RE
+from .routers import shard_for
+
+MALFORMED = "The short URL is not well-formed."
+NOT_FOUND = "Shortened URL not found"
+EXPIRED = "This URL has expired, Please create a new shortened URL"
+WRONG_PASSWORD = "Password required or incorrect password"
+
+
+class VisitDenied(Exception):
+    """A visit that must be answered with an error instead of a redirect."""
+
+    def __init__(self, status, error):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+def check_code(code):
+    # Cheap character-class check instead of running URLValidator
+    if not SHORT_CODE_RE.fullmatch(code):
+        raise VisitDenied(422, MALFORMED)
+
+
+def check_link(link, password):
+    if link.is_expired():
+        raise VisitDenied(403, EXPIRED)
+    # If the URL has a password, check the user has provided the correct one
+    if link.password and password != link.password:
+        raise VisitDenied(403, WRONG_PASSWORD)
+    return link
+
+
+def resolve_visit(code, password=None):
+    """
+    Return the CachedLink a visit to `code` redirects to, or raise
+    VisitDenied. Shared by the DRF view and the WSGI fast path.
+    """
+    check_code(code)
+    try:
+        link = resolve_cache.resolve(code)
+    except Http404:
+        raise VisitDenied(404, NOT_FOUND)
+    return check_link(link, password)
+
+
+async def aresolve_visit(code, password=None):
+    """Async version of resolve_visit() for the ASGI fast path."""
+    check_code(code)
+    try:
+        link = await resolve_cache.aresolve(code)
+    except Http404:
+        raise VisitDenied(404, NOT_FOUND)
+    return check_link(link, password)
+
+
+def cache_control(link):
+    """Cache-Control of the redirect of a link."""
+    if link.password:
+        # A cache would answer for the password in the query string
+        return "private, no-store"
+    max_age = settings.REDIRECT_MAX_AGE
+    if link.expiration_at is not None:
+        remaining = (link.expiration_at - timezone.now()).total_seconds()
+        max_age = min(max_age, int(remaining))
+    if max_age <= 0:
+        return "no-cache"
+    return f"public, max-age={max_age}"
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header with an ETag."""
+    if not if_none_match:
+        return False
+    etags = [tag.removeprefix("W/") for tag in parse_etags(if_none_match)]
+    return "*" in etags or etag in etags
+
+
+def redirect_response(link, if_none_match=""):
+    """
+    Status and headers answering a visit to `link`: its redirect, or 304 if
+    the copy the client names in If-None-Match is still current. Shared by
+    the DRF view and the fast paths.
+    """
+    headers = [("Cache-Control", cache_control(link)), ("ETag", link.etag)]
+    if etag_matches(if_none_match, link.etag):
+        return 304, headers
+    return link.redirect_type, [("Location", iri_to_uri(link.original_url))] + headers
+
+
+def record_visit(link, ip_address, user_agent, referrer, accessed_at=None):
+    """Count the visit and log the access, both buffered in memory."""
+    visit_counter.increment(link.code)
+    access_log_buffer.submit(
+        link.pk,
+        ip_address,
+        user_agent,
+        referrer,
+        accessed_at=accessed_at,
+        shard=shard_for(link.code),
+    )
+
+
+async def arecord_visit(link, ip_address, user_agent, referrer):
+    """
+    Async version of record_visit(). Handing off to the buffers never
+    blocks, only the write-through mode (a flush interval of 0) has to
+    leave the event loop to hit the database.
+    """
+    if visit_counter.flush_interval and access_log_buffer.flush_interval:
+        record_visit(link, ip_address, user_agent, referrer)
+    else:
+        await sync_to_async(record_visit)(link, ip_address, user_agent, referrer)